@@ -3,9 +3,13 @@
 from importlib import reload
 
 import functools
+import os
+import pathlib
+import threading
 
 import opscore.protocols.keys as keys
 import opscore.protocols.types as types
+from opscore.utility.qstr import qstr
 
 import astropy.io.fits as pyfits
 
@@ -13,6 +17,10 @@ import fpga.ccdFuncs as ccdFuncs
 from clocks import clockIDs
 
 import Commands.exposure as exposure
+from ccdActor.utils.combiner import FrameCombiner
+import ccdActor.utils.compression as compression
+import ccdActor.utils.fitsChecksum as fitsChecksum
+import ccdActor.utils.fitsWriter as fitsWriter
 
 reload(clockIDs)
 reload(ccdFuncs)
@@ -35,14 +43,14 @@ class CcdCmd(object):
             ('read',
              '[@(bias|dark|flat|arc|object|domeflat|test|junk)] [<nrows>] [<ncols>] [<visit>] '
              '[<exptime>] [<darktime>] [<obstime>] [<comment>] [@nope] [@swoff] [@fast] [<row0>] '
-             '[<pfsDesign>] [<metadata>]',
+             '[<pfsDesign>] [<metadata>] [@(padded|windowed)] [@preview]',
              self.read),
             ('erase', '', self.erase),
             ('clock','[<nrows>] <ncols>', self.clock),
             ('revread','[<nrows>] [<binning>]', self.revRead),
             ('clearExposure', '', self.clearExposure),
-            ('expose', '<nbias>', self.exposeBiases),
-            ('expose', '<darks>', self.exposeDarks),
+            ('expose', '<nbias> [@pipelined] [@combine] [@median]', self.exposeBiases),
+            ('expose', '<darks> [@pipelined] [@combine] [@median]', self.exposeDarks),
             ('setOffset', '<offset> <value>', self.setOffset),
             ('setOffsets', '<filename>', self.setOffsets),
             ('controlLVDS', '@(on|off)', self.controlLVDS),
@@ -50,6 +58,11 @@ class CcdCmd(object):
             ('setClocks', '[<on>] [<off>]', self.setClocks),
             ('holdClocks', '[<on>] [<off>]', self.holdClocks),
             ('setAdcMode', '@(msb|mid|lsb)', self.setAdcMode),
+            ('timings', '[<cnt>]', self.exposureTimings),
+            ('qaHistory', '[<cnt>] [<alpha>]', self.qaHistory),
+            ('benchCompression', '[<filename>] [<cnt>]', self.benchCompression),
+            ('verifyFile', '[<filename>]', self.verifyFile),
+            ('spool', '[@retry]', self.spool),
         ]
 
         # Define typed command arguments for the above commands.
@@ -74,6 +87,10 @@ class CcdCmd(object):
                                                  help='a comment to add.'),
                                         keys.Key("nbias", types.Int(),
                                                  help='number of biases to take'),
+                                        keys.Key("cnt", types.Int(),
+                                                 help='a count'),
+                                        keys.Key("alpha", types.Float(),
+                                                 help='EWMA weight of the newest value'),
                                         keys.Key("darks", types.Float()*(1,),
                                                  help='list of dark times to take'),
                                         keys.Key("offset",
@@ -131,7 +148,14 @@ class CcdCmd(object):
 
         pass
 
+    def _checkFeeFree(self):
+        """ Refuse to start an exposure while "fee bench" is changing FEE modes. """
+
+        if getattr(self.actor, 'benchingFee', False):
+            raise exposure.ExposureIsActive('the FEE is being benchmarked')
+
     def _setExposure(self, cmd, exp, doForce=False):
+        self._checkFeeFree()
         if self.actor.exposure is not None:
             if not doForce:
                 raise exposure.ExposureIsActive('an exposure is already active: %s' % (self.actor.exposure))
@@ -147,6 +171,14 @@ class CcdCmd(object):
     def closeoutExposure(self, cmd):
         self.actor.exposure = None
 
+    def _finishWrites(self, cmd, errors):
+        """Finish or fail a command once all its image files have been written. """
+
+        if errors:
+            cmd.fail('text="failed to write %d image file(s): %s"' % (len(errors), errors[0]))
+        else:
+            cmd.finish()
+
     def clearExposure(self, cmd):
         """Remove state of any existing/broken exposure. Also set FEE to idle. """
 
@@ -159,6 +191,7 @@ class CcdCmd(object):
         cmd.finish()
 
     def erase(self, cmd):
+        self._checkFeeFree()
         exp = exposure.Exposure(self.actor, None, 0,
                                 self.ccd, self.fee,
                                 self.actor.bcast)
@@ -259,6 +292,12 @@ class CcdCmd(object):
         metadata = cmdKeys['metadata'].values if 'metadata' in cmdKeys else None
         swOffTweak = 'swoff' in cmdKeys
         fast = 'fast' in cmdKeys
+        windowed = None
+        if 'windowed' in cmdKeys:
+            windowed = True
+        elif 'padded' in cmdKeys:
+            windowed = False
+        doPreview = True if 'preview' in cmdKeys else None
 
         try:
             exp = self._getExposure(cmd)
@@ -282,12 +321,14 @@ class CcdCmd(object):
             cmd.warn(f'text="wiping {row0} rows"')
             exp.wipe(cmd=cmd, nrows=row0, fast=True)
 
+        pendingWrites = fitsWriter.PendingWrites()
         exp.readout(imtype, exptime, darkTime=darktime,
                     visit=visit, obstime=obstime,
-                    nrows=nrows, ncols=ncols, row0=row0,
+                    nrows=nrows, ncols=ncols, row0=row0, windowed=windowed,
                     doFeeCards=doFeeCards, doModes=doModes,
                     pfsDesign=pfsDesign, metadata=metadata,
-                    comment=comment, doRun=doRun, fast=fast, cmd=cmd)
+                    comment=comment, doRun=doRun, fast=fast, cmd=cmd,
+                    pendingWrites=pendingWrites, doPreview=doPreview)
 
         if row0 > 0:
             haveReadTo = row0 + nrows
@@ -298,17 +339,93 @@ class CcdCmd(object):
         self.closeoutExposure(cmd=cmd)
         
         if doFinish:
-            cmd.finish()
+            pendingWrites.whenDone(functools.partial(self._finishWrites, cmd))
+
+    def _sequencePipeline(self, cmd):
+        """Return the FramePipeline for a new exposure sequence, or None.
+
+        Sequences are pipelined if the command says so or if
+        actorConfig['sequences']['pipelined'] is set.
+        """
+
+        seqConfig = self.actor.actorConfig.get('sequences', dict())
+        if not ('pipelined' in cmd.cmd.keywords or seqConfig.get('pipelined', False)):
+            return None
+
+        pipeline = exposure.FramePipeline(self.actor.fitsWriter,
+                                          maxInFlight=seqConfig.get('maxInFlight', 2))
+        cmd.inform(f'text="running pipelined sequence: {pipeline}"')
+        return pipeline
+
+    def _sequenceCombiner(self, cmd, nFrames):
+        """Return the FrameCombiner for a new exposure sequence, or None.
+
+        Sequences are combined as they are read if the command says so or
+        if actorConfig['sequences']['combine'] is set. The median spools
+        every frame to actorConfig['sequences']['spoolDir']; if that does
+        not have room for the whole sequence, the command is failed before
+        the sequence starts.
+        """
+
+        cmdKeys = cmd.cmd.keywords
+        seqConfig = self.actor.actorConfig.get('sequences', dict())
+        if not ('combine' in cmdKeys or seqConfig.get('combine', False)):
+            return None
+
+        doMedian = 'median' in cmdKeys or seqConfig.get('median', False)
+        spoolDir = os.path.expanduser(seqConfig.get('spoolDir', '~/ccdActor/combineSpool'))
+        combiner = FrameCombiner(nFrames=nFrames,
+                                 clipSigma=seqConfig.get('clipSigma', 3.0),
+                                 doMedian=doMedian,
+                                 spoolDir=spoolDir,
+                                 minFree=seqConfig.get('spoolMinFree', 1e9))
+
+        pool = getattr(self.actor.ccd, 'framePool', None)
+        if pool is not None:
+            combiner.checkSpool(pool.shape)
+
+        cmd.inform(f'text="combining sequence: {combiner}"')
+        return combiner
+
+    def _finishSequence(self, cmd, combiner, errors):
+        """Once all of a sequence's files have been written, write any combined products. """
+
+        if combiner is None:
+            self._finishWrites(cmd, errors)
+            return
+
+        def writeCombined():
+            try:
+                if combiner.n > 0:
+                    filepath, summary = combiner.write()
+                    for amp in summary:
+                        cmd.inform('combinedAmpStats=%d,%0.3f,%0.3f,%0.3f,%0.5f' %
+                                   (amp.amp, amp.level, amp.clipped, amp.noise, amp.rejected))
+                    cmd.inform(f'combinedFile={qstr(filepath)}')
+            except Exception as e:
+                cmd.warn(f'text="failed to write combined products for {combiner}: {e}"')
+            finally:
+                combiner.close()
+            self._finishWrites(cmd, errors)
+
+        thread = threading.Thread(target=writeCombined, name='combiner', daemon=True)
+        thread.start()
+
+    def _nextExposure(self, cmd, runningExp, exposures, idx,
+                      pendingWrites=None, pipeline=None, combiner=None):
+        if pendingWrites is None:
+            pendingWrites = fitsWriter.PendingWrites()
 
-    def _nextExposure(self, cmd, runningExp, exposures, idx):
         cmd.inform('text="calling for exposure %d of %s"' % (idx+1, exposures))
         if idx >= len(exposures) or (runningExp is not None and runningExp.pleaseStop):
             self.closeoutExposure(cmd)
-            cmd.finish()
+            pendingWrites.whenDone(functools.partial(self._finishSequence, cmd, combiner))
             return
 
         if runningExp is not None and runningExp != self.actor.exposure:
             cmd.warn('text="abandoning orphan sequence"')
+            if combiner is not None:
+                combiner.close()
             cmd.finish()
             return
 
@@ -319,9 +436,14 @@ class CcdCmd(object):
         cmd.inform('text="starting %d of %d: %s, %0.2f sec"' % (idx+1, len(exposures),
                                                                 thisType, thisExpTime))
         newExp = exposure.Exposure(self.actor, thisType, thisExpTime,
-                                   self.ccd, self.fee, cmd=cmd, comment=comment)
+                                   self.ccd, self.fee, cmd=cmd, comment=comment,
+                                   pipeline=pipeline, combiner=combiner)
         self._setExposure(cmd, newExp)
-        newExp.run(callback=functools.partial(self._nextExposure, cmd, newExp, exposures, idx+1))
+        newExp.run(callback=functools.partial(self._nextExposure, cmd, newExp, exposures, idx+1,
+                                              pendingWrites=pendingWrites,
+                                              pipeline=pipeline,
+                                              combiner=combiner),
+                   pendingWrites=pendingWrites)
 
     def exposeBiases(self, cmd):
         """ Take a number of complete biases. """
@@ -331,7 +453,14 @@ class CcdCmd(object):
         comment = cmdKeys['comment'].values[0] if 'comment' in cmdKeys else ''
 
         expList = [('bias',0,comment) for i in range(nbias)]
-        self._nextExposure(cmd, None, expList, 0)
+        try:
+            combiner = self._sequenceCombiner(cmd, len(expList))
+        except OSError as e:
+            cmd.fail('text=%s' % (qstr(e)))
+            return
+        self._nextExposure(cmd, None, expList, 0,
+                           pipeline=self._sequencePipeline(cmd),
+                           combiner=combiner)
 
     def exposeDarks(self, cmd):
         """ Take a list of complete darks. """
@@ -348,7 +477,130 @@ class CcdCmd(object):
             expType = 'dark' if expTime > 0 else 'bias'
             expList.append((expType, expTime, comment),)
 
-        self._nextExposure(cmd, None, expList, 0)
+        try:
+            combiner = self._sequenceCombiner(cmd, len(expList))
+        except OSError as e:
+            cmd.fail('text=%s' % (qstr(e)))
+            return
+        self._nextExposure(cmd, None, expList, 0,
+                           pipeline=self._sequencePipeline(cmd),
+                           combiner=combiner)
+
+    def exposureTimings(self, cmd):
+        """Summarize the recent per-phase exposure timings. """
+
+        cmdKeys = cmd.cmd.keywords
+        cnt = cmdKeys['cnt'].values[0] if 'cnt' in cmdKeys else None
+
+        summary = self.actor.timingHistory.summary(cnt)
+        if not summary:
+            cmd.finish('text="no exposure timings yet"')
+            return
+
+        for phase, n, p50, p95, tmax in summary:
+            cmd.inform('exposureTimingStats=%s,%d,%0.3f,%0.3f,%0.3f' % (phase, n, p50, p95, tmax))
+        cmd.finish()
+
+    def qaHistory(self, cmd):
+        """Report per-amp trends, drifts and jumps in the recent overscan QA. """
+
+        cmdKeys = cmd.cmd.keywords
+        cnt = cmdKeys['cnt'].values[0] if 'cnt' in cmdKeys else None
+        alpha = cmdKeys['alpha'].values[0] if 'alpha' in cmdKeys else 0.1
+
+        history = self.actor.qaHistory
+        trends = history.trends(cnt, alpha=alpha)
+        if trends is None:
+            cmd.finish('text="not enough QA history yet"')
+            return
+
+        for metric, metricTrends in zip(history.metrics, trends):
+            for amp, t in enumerate(metricTrends):
+                cmd.inform('qaHistory=%s,%d,%d,%0.3f,%0.3f,%0.4f,%0.3f,%0.3f,%d,%d,%0.3f' %
+                           (metric, amp, t.n, t.last, t.mean, t.slope, t.ewma, t.drift,
+                            t.nJumps, t.jumpVisit, t.jump))
+        cmd.finish('text="%s"' % (history))
+
+    def benchCompression(self, cmd):
+        """Time writing the last image file with each compression.
+
+        Reads the image back from the last file we wrote, or from the
+        given file, and writes it with every configured compression and the
+        standard ones, in the same directory, through the same writer as
+        the raw files. Runs in its own thread.
+        """
+
+        cmdKeys = cmd.cmd.keywords
+        filename = cmdKeys['filename'].values[0] if 'filename' in cmdKeys else self.actor.lastFilepath
+        nRepeat = cmdKeys['cnt'].values[0] if 'cnt' in cmdKeys else 1
+        if filename is None:
+            cmd.fail('text="no image file has been written yet"')
+            return
+
+        specs = dict(compression.BENCH_SPECS)
+        specs.update(self.actor.compressionPolicy.specs)
+
+        def runBench():
+            try:
+                im = pyfits.getdata(filename, ext=1)
+                cmd.inform(f'text="benchmarking {len(specs)} compressions of {filename}, '
+                           f'{im.shape} {im.dtype}"')
+                results = compression.benchmark(im, specs, pathlib.Path(filename).parent,
+                                                nRepeat=nRepeat, tileWriter=self.actor.tileWriter)
+            except Exception as e:
+                cmd.fail(f'text="compression benchmark failed: {e}"')
+                return
+
+            for name, writer, writeTime, rate, ratio, readTime in results:
+                cmd.inform('compressionBench=%s,%s,%0.3f,%0.1f,%0.3f,%0.3f' %
+                           (name, writer, writeTime, rate, ratio, readTime))
+            cmd.finish()
+
+        thread = threading.Thread(target=runBench, name='benchCompression', daemon=True)
+        thread.start()
+
+    def verifyFile(self, cmd):
+        """Check the FITS checksums of the last image file, or of the given file.
+
+        The file is re-read and summed independently of the writers. Runs
+        in its own thread.
+        """
+
+        cmdKeys = cmd.cmd.keywords
+        filename = cmdKeys['filename'].values[0] if 'filename' in cmdKeys else self.actor.lastFilepath
+        if filename is None:
+            cmd.fail('text="no image file has been written yet"')
+            return
+
+        def runVerify():
+            try:
+                problems = fitsChecksum.verifyFile(filename)
+            except Exception as e:
+                cmd.fail(f'text="could not verify {filename}: {e}"')
+                return
+
+            for problem in problems:
+                cmd.warn(f'text="{filename}: {problem}"')
+            if problems:
+                cmd.fail(f'text="{filename} failed checksum verification"')
+            else:
+                cmd.finish(f'text="{filename} checksums are good"')
+
+        thread = threading.Thread(target=runVerify, name='verifyFile', daemon=True)
+        thread.start()
+
+    def spool(self, cmd):
+        """Report how many files are waiting to be moved from the spool, optionally retrying failed moves now. """
+
+        mover = self.actor.fileMover
+        if mover is None:
+            cmd.fail('text="no spool is configured"')
+            return
+
+        if 'retry' in cmd.cmd.keywords:
+            mover.retryNow()
+        self.actor.reportSpoolDepth(mover.depth(), cmd=cmd)
+        cmd.finish('text="%s"' % (mover))
 
     def setOffset(self, cmd):
         """ Set a single offset. """
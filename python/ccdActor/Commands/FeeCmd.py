@@ -4,11 +4,14 @@ from collections import OrderedDict
 from importlib import reload
 
 import os.path
-import time
+import threading
 
 import opscore.protocols.keys as keys
 import opscore.protocols.types as types
 from opscore.utility.qstr import qstr
+from twisted.python import failure
+
+import ccdActor.utils.feeBench as feeBench
 
 class FeeCmd(object):
 
@@ -27,10 +30,13 @@ class FeeCmd(object):
             ('fee', 'bootstrap <pathname>', self.bootstrap),
             ('fee', 'sendImage <pathname> [@doWait] [@sendReboot]', self.sendImage),
             ('fee', 'calibrate', self.calibrate),
-            ('fee', 'status [@(serial)] [@(temps)] [@(bias)] [@(voltage)] [@(offset)] [@(preset)]', self.status),
+            ('fee', 'status [@(serial)] [@(temps)] [@(bias)] [@(voltage)] [@(offset)] [@(preset)] [@fresh]', self.status),
             ('fee', 'test1', self.test1),
+            ('fee', 'scheduler', self.scheduler),
             ('fee', 'setOffsets <n> <p> [@(save)]', self.setOffsets),
-            ('feeTimes', '@raw', self.times),
+            ('feeTimes', '@raw [<cnt>]', self.times),
+            ('fee', 'record @(start|stop) [<filename>]', self.record),
+            ('fee', 'bench [<cnt>] [<retries>] [<categories>] [<filename>]', self.bench),
             ('fee', 'setSerials [<ADC>] [<PA0>] [<CCD0>] [<CCD1>]', self.setSerials),
             ('fee', '@(setMode) @(idle|wipe|erase|expose|read|offset)', self.setMode),
             ('fee', 'setVoltageCalibrations [<v3V3M>] [<v3V3>] [<v5VP>] [<v5VN>] [<v5VPpa>] [<v5VNpa>] [<v12VP>] [<v12VN>] [<v24VN>] [<v54VP>]',
@@ -47,6 +53,12 @@ class FeeCmd(object):
                                                  help='P offsets'),
                                         keys.Key("cnt", types.Int(),
                                                  help='a count'),
+                                        keys.Key("retries", types.Int(),
+                                                 help='how many times to retry a failed FEE call'),
+                                        keys.Key("categories", types.String()*(1,),
+                                                 help='FEE benchmark categories: %s' % (','.join(feeBench.CATEGORIES))),
+                                        keys.Key("filename", types.String(),
+                                                 help='where to save FEE benchmark results or a FEE transcript'),
                                         keys.Key("ADC", types.Int(),
                                                  help='the ADC serial number'),
                                         keys.Key("PA0", types.Int(),
@@ -72,8 +84,45 @@ class FeeCmd(object):
 
         cmdTxt = cmd.cmd.keywords['raw'].values[0]
 
-        ret = self.actor.fee.sendCommandStr(cmdTxt, noTilde=(cmdTxt in {'reset'}))
-        cmd.finish('text=%s' % (qstr('returned: %s' % (ret))))  
+        def done(ret):
+            # We cannot tell what a raw command changed.
+            self.actor.fee.statusCache.invalidate()
+            cmd.inform('text=%s' % (qstr('returned: %s' % (ret))))
+
+        d = self.actor.fee.asyncFee.sendCommandStr(cmdTxt, noTilde=(cmdTxt in {'reset'}))
+        d.addCallback(done)
+        d.addBoth(self._done(cmd, 'raw command failed'))
+
+    def _done(self, cmd, what, doFinish=True):
+        """ Return the last callback for a FEE Deferred.
+
+        It fails the command if the FEE call or any earlier callback
+        failed, else finishes it, if doFinish.
+        """
+
+        def terminal(ret):
+            if isinstance(ret, failure.Failure):
+                cmd.fail('text=%s' % (qstr('%s: %s' % (what, ret.value))))
+            elif doFinish:
+                cmd.finish()
+        return terminal
+
+    def _exposureBusy(self):
+        """ Return why an exposure might be using the FEE, or None if none is. """
+
+        exp = self.actor.exposure
+        if exp is not None:
+            return f'an exposure is active: {exp}'
+
+        ccdCmd = self.actor.commandSets.get('CcdCmd', None)
+        state = getattr(ccdCmd, 'exposureState', 'idle')
+        if state != 'idle':
+            return f'the exposure state is {state}'
+
+        if self.actor.fee.scheduler.nBusy > 0:
+            return 'exposure FEE calls are running'
+
+        return None
 
     def _status(self, cmd, keys):
         """ Actually generate the keywords for the passed in keys. """
@@ -87,27 +136,49 @@ class FeeCmd(object):
                 
             cmd.inform('%s=%s' % (k,v))
         
+    def _statusAges(self, cmd, csets=None):
+        """ Generate the feeStatusAge keys: how old, in seconds, the cached status we reported is. """
+
+        for cset, age in self.actor.fee.statusAges(csets).items():
+            cmd.inform('feeStatusAge=%s,%0.1f' % (cset, age))
+
     def status(self, cmd, doFinish=True):
-        """ Fetch some status keys. All of them by default. """
+        """ Fetch some status keys. All of them by default.
+
+        Values fetched recently enough are reported from the FEE status
+        cache, unless fresh is given.
+        """
 
         cmdKeys = cmd.cmd.keywords
+        fresh = 'fresh' in cmdKeys
 
-        anyDone = False
+        csets = []
         for feeSet in 'serial', 'temps', 'bias', 'voltage', 'offset', 'preset':
             if feeSet in cmdKeys:
-                keys = self.actor.fee.getCommandStatus(feeSet)
-                self._status(cmd, keys)
-                anyDone = True
+                csets.append(feeSet)
                 if feeSet == 'serial':
-                    keys = self.actor.fee.getCommandStatus('revision')
-                    self._status(cmd, keys)
+                    csets.append('revision')
 
-        if not anyDone:
-            keys = self.actor.fee.getAllStatus()
+        # The FEE is read on its own thread; the keywords are generated
+        # back in the reactor thread.
+        if csets:
+            d = self.actor.fee.asyncFee.getStatusSets(csets, fresh=fresh)
+        else:
+            d = self.actor.fee.asyncFee.getAllStatus(fresh=fresh)
+            csets = None
+
+        def report(keys):
             self._status(cmd, keys)
+            self._statusAges(cmd, csets)
+
+        d.addCallback(report)
+        d.addBoth(self._done(cmd, 'could not get FEE status', doFinish=doFinish))
+        return d
+
+    def scheduler(self, cmd):
+        """ Report how long FEE requests have waited, by priority. """
 
-        if doFinish:
-            cmd.finish()
+        cmd.finish('text="%s"' % (self.actor.fee.scheduler))
 
     def setMode(self, cmd):
         cmdKeys = cmd.cmd.keywords
@@ -119,8 +190,8 @@ class FeeCmd(object):
                 mode = m
                 break
 
-        self.actor.fee.setMode(mode)
-        cmd.finish()
+        d = self.actor.fee.asyncFee.setMode(mode)
+        d.addBoth(self._done(cmd, f'could not set mode {mode}'))
         
     def setOffsets(self, cmd):
         cmdKeys = cmd.cmd.keywords
@@ -139,42 +210,129 @@ class FeeCmd(object):
     def test1(self, cmd):
         """ Test core parts of the FEE. """
 
-        S = self.actor.fee.getCommandStatus('serial')
-        self._status(cmd, S)
-        R = self.actor.fee.getCommandStatus('revision')
-        self._status(cmd, R)
-
-        V = self.actor.fee.getCommandStatus('voltage')
-        self._status(cmd, V)
+        def report(keys):
+            self._status(cmd, keys)
 
-        T = self.actor.fee.getCommandStatus('temps')
-        self._status(cmd, T)
-        
-        cmd.finish()
+        d = self.actor.fee.asyncFee.call('getStatusSets', ['serial', 'revision', 'voltage', 'temps'],
+                                         fresh=True)
+        d.addCallback(report)
+        d.addBoth(self._done(cmd, 'FEE test failed'))
         
     def times(self, cmd):
-        """ Test core parts of the FEE. """
+        """ Time a raw FEE command. Runs in its own thread. """
 
-        cmdTxt = cmd.cmd.keywords['raw'].values[0]
-        cnt = 10 # cmd.cmd.keywords['cnt'].values[0]
+        cmdKeys = cmd.cmd.keywords
+        cmdTxt = cmdKeys['raw'].values[0]
+        cnt = cmdKeys['cnt'].values[0] if 'cnt' in cmdKeys else 10
 
-        t0 = time.time()
-        for i in range(cnt):
-            ret = self.actor.fee.getRaw(cmdTxt)
-        t1 = time.time()
+        def runTimes():
+            times, nErrors, nRetries, lastError = feeBench.timeCall(lambda: self.actor.fee.getRaw(cmdTxt),
+                                                                    cnt, retries=0)
+            if lastError is not None:
+                cmd.warn('text=%s' % (qstr('%s failed %d times; last: %s' % (cmdTxt, nErrors, lastError))))
+            stats = feeBench.percentiles(times)
+            cmd.finish('text="n=%d total=%0.2fs, p50=%0.4fs p95=%0.4fs max=%0.4fs"' %
+                       (stats['n'], sum(times), stats['p50'], stats['p95'], stats['max']))
+
+        thread = threading.Thread(target=runTimes, name='feeTimes', daemon=True)
+        thread.start()
+
+    def record(self, cmd):
+        """ Record all FEE serial traffic, to replay with the FEE emulator (utils/feeSim.py).
+
+        Start, run whatever should be replayed (fee status, mode changes,
+        a firmware upload...), then stop with the filename to save to.
+        """
+
+        cmdKeys = cmd.cmd.keywords
+        fee = self.actor.fee
+
+        if 'start' in cmdKeys:
+            fee.startRecording()
+            cmd.finish('text="recording FEE traffic"')
+            return
+
+        if 'filename' not in cmdKeys:
+            cmd.fail('text="need a filename to save the FEE transcript to"')
+            return
+        filename = cmdKeys['filename'].values[0]
+        nExchanges = fee.stopRecording(filename)
+        cmd.finish('text="saved %d FEE exchanges to %s"' % (nExchanges, filename))
+
+    def bench(self, cmd):
+        """ Benchmark FEE serial latency for each command category.
+
+        Times cnt reads of each status set, and cnt of each exposure mode
+        transition, always from the FEE. Optionally saves everything to
+        a JSON file, for comparing firmware versions with feeBench.py.
+        Runs in its own thread, and leaves the FEE idle. Refused while any
+        exposure is active, and no exposure may start until it is done.
+        Should one start anyway, the benchmark stops at once.
+        """
+
+        cmdKeys = cmd.cmd.keywords
+        cnt = cmdKeys['cnt'].values[0] if 'cnt' in cmdKeys else 10
+        retries = cmdKeys['retries'].values[0] if 'retries' in cmdKeys else 1
+        categories = list(cmdKeys['categories'].values) if 'categories' in cmdKeys else feeBench.CATEGORIES
+        filename = cmdKeys['filename'].values[0] if 'filename' in cmdKeys else None
+
+        fee = self.actor.fee
+        busy = self._exposureBusy()
+        if busy is None and self.actor.benchingFee:
+            busy = 'a FEE benchmark is already running'
+        if busy is None and fee.recorder is not None:
+            busy = 'FEE traffic is being recorded'
+        if busy is not None:
+            cmd.fail('text=%s' % (qstr('cannot benchmark the FEE: %s' % (busy))))
+            return
+        self.actor.benchingFee = True
+
+        def report(result):
+            cmd.inform('feeBench=%s,%d,%d,%d,%0.1f,%0.1f,%0.1f,%0.1f,%0.0f' %
+                       (result['name'], result['n'], result['nErrors'], result['nRetries'],
+                        result['p50']*1000, result['p95']*1000, result['p99']*1000,
+                        result['max']*1000, result['bytesPerSec']))
+            if result['lastError'] is not None:
+                cmd.warn('text=%s' % (qstr('%s: %s' % (result['name'], result['lastError']))))
+
+        def runBench():
+            try:
+                info = feeBench.describe(fee)
+                cmd.inform('text="benchmarking FEE %s: %d of each of %s"' %
+                           (info.get('revision', '?'), cnt, ','.join(categories)))
+                results = feeBench.benchmark(fee, categories, nRepeat=cnt, retries=retries,
+                                             report=report, stopCheck=self._exposureBusy)
+                if filename is not None:
+                    feeBench.save(filename, results, info, nRepeat=cnt, retries=retries,
+                                  scheduler=str(fee.scheduler))
+            except feeBench.BenchStopped as e:
+                cmd.fail('text=%s' % (qstr('FEE benchmark stopped, FEE mode left alone: %s' % (e))))
+                return
+            except Exception as e:
+                cmd.fail('text=%s' % (qstr('FEE benchmark failed: %s' % (e))))
+                return
+            finally:
+                self.actor.benchingFee = False
+
+            if filename is not None:
+                cmd.finish('text="saved FEE benchmark to %s"' % (filename))
+            else:
+                cmd.finish()
+
+        thread = threading.Thread(target=runBench, name='feeBench', daemon=True)
+        thread.start()
 
-        cmd.finish('text="total=%0.2fs, per=%0.04fs"' % (t1-t0, (t1-t0)/cnt))
-        
     def calibrate(self, cmd):
         """ Calibrate FEE DACs and load mode voltages. """
 
-        fee = self.actor.fee
+        def calibrated(ret):
+            cmd.inform('text="fee calibrated..."')
+            self.status(cmd)
 
         cmd.inform('text="calibrating fee.... takes 30s or so..."')
-        fee.calibrate()
-        cmd.inform('text="fee calibrated..."')
-
-        self.status(cmd)
+        d = self.actor.fee.asyncFee.calibrate()
+        d.addCallback(calibrated)
+        d.addBoth(self._done(cmd, 'calibration failed', doFinish=False))
 
     def sendImage(self, cmd):
         """ Upload new firmware to interlock board. """
@@ -184,11 +342,10 @@ class FeeCmd(object):
         doWait = 'doWait' in cmdKeys
         sendReboot = 'sendReboot' in cmdKeys
 
-        fee = self.actor.fee
-        fee.sendImage(path, verbose=True, doWait=doWait,
-                      sendReboot=sendReboot,
-                      cmd=cmd)
-        cmd.finish()
+        d = self.actor.fee.asyncFee.sendImage(path, verbose=True, doWait=doWait,
+                                              sendReboot=sendReboot,
+                                              cmd=cmd)
+        d.addBoth(self._done(cmd, 'firmware upload failed'))
 
     def download(self, cmd):
         """ Download firmware. """
@@ -7,6 +7,7 @@ from builtins import object
 import opscore.protocols.keys as keys
 import opscore.protocols.types as types
 from opscore.utility.qstr import qstr
+from twisted.python import failure
 
 class TopCmd(object):
 
@@ -74,7 +75,7 @@ class TopCmd(object):
         try:
             instanceName = cmd.cmd.keywords['name'].values[0]
         except:
-            instanceName = controller
+            instanceName = self.actor.controllerAliases.get(controller, controller)
 
         try:
             self.actor.attachController(controller,
@@ -120,14 +121,27 @@ class TopCmd(object):
                 self.actor.callCommand("%s status" % (c))
         self.actor.commandSets['CcdCmd'].genStatus(cmd=cmd)
         cmd.inform('text="exposure=%s"' % (self.actor.exposure))
-        self.temps(cmd, doFinish=False)
-        cmd.finish(self.controllerKey())
+        d = self.temps(cmd, doFinish=False)
+        d.addBoth(lambda ret: cmd.finish(self.controllerKey()))
 
     def temps(self, cmd, doFinish=True):
-        """Report CCD and preamp temperatures. """
-        
-        ret = self.actor.fee.getTemps()
-        cmd.inform('ccdTemps=%0.2f,%0.2f,%0.2f' % (ret['PA'], ret['ccd0'], ret['ccd1']))
-        if doFinish:
-            cmd.finish()
+        """Report CCD and preamp temperatures.
+
+        The FEE is read without blocking the reactor. Returns a Deferred
+        which fires once the temperatures have been reported, or not.
+        """
+
+        def report(ret):
+            cmd.inform('ccdTemps=%0.2f,%0.2f,%0.2f' % (ret['PA'], ret['ccd0'], ret['ccd1']))
+
+        def finish(ret):
+            if isinstance(ret, failure.Failure):
+                cmd.warn('text=%s' % (qstr('could not read temperatures: %s' % (ret.value))))
+            if doFinish:
+                cmd.finish()
+
+        d = self.actor.fee.asyncFee.getTemps()
+        d.addCallback(report)
+        d.addBoth(finish)
+        return d
             
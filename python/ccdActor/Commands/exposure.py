@@ -1,5 +1,7 @@
 from importlib import reload
 
+import contextlib
+import functools
 import logging
 import pathlib
 import time
@@ -7,7 +9,6 @@ import threading
 
 import numpy as np
 
-import fitsio
 from ics.utils import pfsIERS   # noqa: F401
 from ics.utils.fits import mhs as fitsMhs
 from ics.utils.fits import utils as fitsUtils
@@ -16,7 +17,13 @@ from ics.utils.sps import fits as spsFits
 import ics.utils.time as pfsTime
 from opscore.utility.qstr import qstr
 import fpga.ccdFuncs as ccdFuncs
+import ccdActor.utils.ampLimits as ampLimits
 import ccdActor.utils.basicQA as basicQA
+import ccdActor.utils.fitsWriter as fitsWriter
+import ccdActor.utils.noiseQA as noiseQA
+import ccdActor.utils.preview as preview
+import ccdActor.utils.streamingQA as streamingQA
+import ccdActor.utils.timings as expTimings
 
 reload(fitsMhs)
 reload(fitsUtils)
@@ -40,18 +47,257 @@ class ExpThread(threading.Thread):
     def run(self):
         exp = self.kwargs['exp']
         callback = self.kwargs['callback']
+        pendingWrites = self.kwargs.get('pendingWrites', None)
 
         exp.cmd.inform('text="integrating for %0.2f s..."' % (exp.expTime))
         if exp.expTime > 0:
             time.sleep(exp.expTime)
-        exp.readout()
+        exp.readout(pendingWrites=pendingWrites)
         exp.cmd.inform('text="calling next exposure..."')
         callback()
 
+class ProcessJob(object):
+    """Everything done to a frame after it has been read out.
+
+    Fixes up the image, queues QA to the actor's QaPool, adds it to any
+    sequence combiner, then writes the file. The whole job is handed to
+    the FitsWriter. Normally the image is processed first, and only the
+    combining and the write are left for the FitsWriter; for pipelined
+    sequences everything is, so that the next frame can be wiped as soon
+    as the readout is done.
+
+    Args
+    ----
+    exp : `Exposure`
+      The exposure which was read out.
+    im : `numpy.ndarray`
+      The raw image, as just read out.
+    writeJob : `fitsWriter.WriteJob`
+      The job which will write the file. Gets the processed image.
+    visit, row0, nrows : `int`
+      What was read out.
+    cmd : `actorcore.Command`
+      Where to send keywords.
+    windowed : `bool`
+      If set, write a row0 window as it was read, instead of placing it
+      in a full-sized frame.
+    doOverscan : `bool`
+      Whether QA needs to measure the overscans. Not if they were
+      already measured during the readout.
+    doPreview : `bool`
+      Whether to write a binned preview next to the raw file.
+    onFinished : callable
+      If set, called with no arguments after the job has succeeded or failed.
+    """
+
+    def __init__(self, exp, im, writeJob, visit, row0, nrows, cmd,
+                 windowed=False, doOverscan=True, doPreview=False, onFinished=None):
+        self.exp = exp
+        self.im = im
+        self.writeJob = writeJob
+        self.visit = visit
+        self.row0 = row0
+        self.nrows = nrows
+        self.cmd = cmd
+        self.windowed = windowed
+        self.doOverscan = doOverscan
+        self.doPreview = doPreview
+        self.onFinished = onFinished
+        self.processed = False
+
+    def __str__(self):
+        return f'ProcessJob(visit={self.visit}, {self.writeJob})'
+
+    def fixup(self):
+        with self.exp.timings.phase('fixup'):
+            im = self.exp.fixupImage(self.im, self.cmd)
+            if self.row0 > 0 and not self.windowed:
+                rawIm = im
+                im = self.exp.placeRows(rawIm, self.row0)
+                self.exp.releaseImage(rawIm)
+
+        self.im = im
+        self.writeJob.image = im
+        return im
+
+    def runQA(self):
+        """Queue QA on the processed image to the actor's QaPool. """
+
+        if self.windowed:
+            readRows = (0, self.nrows)
+        else:
+            readRows = (self.row0, self.row0+self.nrows)
+
+        exp, im, visit, cmd = self.exp, self.im, self.visit, self.cmd
+        doOverscan = self.doOverscan
+
+        def computeQA():
+            with exp.timings.phase('qa'):
+                return exp.computeQA(im, visit, readRows, doOverscan=doOverscan)
+
+        def onFail(e):
+            cmd.warn(f'text="failed to run QA checks: {e}"')
+
+        def onTimeout():
+            cmd.warn(f'visitQA={visit},{qstr("QA timed out")}')
+            exp.timings.finished('qa')
+
+        def onFinished():
+            exp.releaseImage(im)
+            exp.timings.finished('qa')
+
+        exp.retainImage(im)
+        queued = exp.actor.qaPool.submit(f'QA for visit {visit}', computeQA,
+                                         onDone=functools.partial(exp.emitQA, cmd=cmd),
+                                         onFail=onFail, onTimeout=onTimeout,
+                                         onFinished=onFinished)
+        if not queued:
+            cmd.warn(f'text="QA queue is full, skipping QA for visit {visit}"')
+            onFinished()
+
+    def runPreview(self):
+        """Queue the binned preview to the actor's QaPool. """
+
+        if not self.doPreview:
+            return
+
+        exp, im, visit, cmd = self.exp, self.im, self.visit, self.cmd
+        config = exp.actor.actorConfig.get('preview', dict())
+        filepath = self.writeJob.finalPath
+
+        def makePreview():
+            return preview.writePreview(im, filepath,
+                                        binning=config.get('binning', 8),
+                                        fmt=config.get('format', 'fits'),
+                                        cards=[dict(name='W_VISIT', value=visit,
+                                                    comment='visit of the raw file')])
+
+        def onDone(path):
+            cmd.inform(f'previewPath={visit},{qstr(path)}')
+
+        def onFail(e):
+            cmd.warn(f'text="failed to write preview for visit {visit}: {e}"')
+
+        def onTimeout():
+            cmd.warn(f'text="preview for visit {visit} timed out"')
+
+        exp.retainImage(im)
+        queued = exp.actor.qaPool.submit(f'preview for visit {visit}', makePreview,
+                                         onDone=onDone, onFail=onFail, onTimeout=onTimeout,
+                                         onFinished=functools.partial(exp.releaseImage, im))
+        if not queued:
+            cmd.warn(f'text="QA queue is full, skipping preview for visit {visit}"')
+            exp.releaseImage(im)
+
+    def process(self):
+        """Fix up the image and queue its QA and preview, once. Returns the processed image. """
+
+        if not self.processed:
+            self.fixup()
+            self.runQA()
+            self.runPreview()
+            self.processed = True
+        return self.im
+
+    def combine(self):
+        """Add the processed image to the sequence's combined products, if any.
+
+        A failure here must not stop the file being written.
+        """
+
+        combiner = self.exp.combiner
+        if combiner is None:
+            return
+        try:
+            added = combiner.add(self.im, visit=self.visit, filepath=self.writeJob.finalPath)
+        except Exception as e:
+            added = False
+            self.exp.logger.warn('failed to add visit %s to %s: %s', self.visit, combiner, e)
+        if not added:
+            self.cmd.warn(f'text="could not add visit {self.visit} to {combiner}"')
+
+    def run(self):
+        self.process()
+        self.combine()
+        self.writeJob.run()
+
+    def onDone(self):
+        try:
+            self.writeJob.onDone()
+        finally:
+            if self.onFinished is not None:
+                self.onFinished()
+
+    def onFail(self, e):
+        try:
+            self.writeJob.onFail(e)
+        finally:
+            if self.onFinished is not None:
+                self.onFinished()
+
+class FramePipeline(object):
+    """Let a sequence read out frame N+1 while frame N is being processed.
+
+    Args
+    ----
+    writer : `fitsWriter.FitsWriter`
+      Runs the post-readout ProcessJobs.
+    maxInFlight : `int`
+      How many read out frames can be waiting for or undergoing
+      processing. Submitting another blocks, which holds off the next wipe
+      and bounds our memory use.
+    """
+
+    def __init__(self, writer, maxInFlight=2):
+        self.writer = writer
+        self.maxInFlight = maxInFlight
+        self.inFlight = threading.BoundedSemaphore(maxInFlight)
+
+    def __str__(self):
+        return f'FramePipeline(maxInFlight={self.maxInFlight})'
+
+    def submit(self, job):
+        self.inFlight.acquire()
+        job.onFinished = self.inFlight.release
+        self.writer.submit(job)
+
+def armName(armNum):
+    """Map arm number (1, 2, 3 or 4) to arm name. """
+
+    arms = {1:'b', 2:'r', 3:'n', 4:'m'}
+    return arms.get(armNum, 'x')
+
+def reportFile(filepath, visit, cmd):
+    """Generate the keywords announcing an image file, which must be durably at filepath. """
+
+    # The generated filenames encapsulate SPS logic. Extract the
+    # components instead of regenerating them.
+    filepath = pathlib.Path(filepath)
+    filename = filepath.name
+
+    rootDir = filepath.parents[2]
+    dateDir = filepath.parent.parent.name
+
+    filestem = filepath.stem
+    spectrograph = int(filestem[-2])
+    armNum = int(filestem[-1])
+    camName = f'{armName(armNum)}{spectrograph}'
+
+    cmd.inform('filepath=%s,%s,%s' % (qstr(rootDir),
+                                      qstr(dateDir),
+                                      qstr(filename)))
+
+    cmd.inform('spsFileIds=%s,%s,%d,%d,%d' % (camName,
+                                              qstr(dateDir),
+                                              visit,
+                                              spectrograph,
+                                              armNum))
+
 class Exposure(object):
     exposureState = 'idle'
 
-    def __init__(self, actor, imtype, expTime, ccd, fee, cmd=None, comment=''):
+    def __init__(self, actor, imtype, expTime, ccd, fee, cmd=None, comment='',
+                 pipeline=None, combiner=None):
         self.actor = actor
         self.ccd = ccd
         self.fee = fee
@@ -67,6 +313,10 @@ class Exposure(object):
         self.headerCards = None
         self.obstime = None
         self.genStatus = self.__instanceGetStatus
+        self.pipeline = pipeline
+        self.combiner = combiner
+        self.timings = expTimings.ExposureTimings()
+        self.qaRecord = dict()
 
         self.pleaseStop = False
 
@@ -74,6 +324,12 @@ class Exposure(object):
         return "Exposure(imtype=%s, expTime=%s, startedAt=%s)" % (self.imtype,
                                                                   self.expTime,
                                                                   self.startTime)
+    @property
+    def ccdFuncs(self):
+        """The readout routines: fpga.ccdFuncs unless the ccd controller has its own. """
+
+        return getattr(self.ccd, 'ccdFuncs', ccdFuncs)
+
     def setFee(self, newFee, cmd):
         self.fee = newFee
         cmd.warn('text="replacing FEE instance for some reason."')
@@ -115,11 +371,12 @@ class Exposure(object):
         self.exposureState = newState
         self.genStatus(cmd, newState)
 
-    def run(self, callback=None):
+    def run(self, callback=None, pendingWrites=None):
         if self.exposureState != 'idle':
             raise ExposureIsActive('this exposure is already running: %s' % (self))
 
-        expThread = ExpThread(kwargs=dict(exp=self, callback=callback))
+        expThread = ExpThread(kwargs=dict(exp=self, callback=callback,
+                                          pendingWrites=pendingWrites))
         expThread.daemon = True
 
         self.wipe()
@@ -144,9 +401,9 @@ class Exposure(object):
         if fast:
             cmd.inform('text="fast wipe"')
 
-        ccdFuncs.wipe(self.ccd, feeControl=self.fee,
-                      nwipes=1, nrows=nrows,
-                      toExposeMode=False, blockPurgedWipe=fast)
+        self.ccdFuncs.wipe(self.ccd, feeControl=self.fee,
+                           nwipes=1, nrows=nrows,
+                           toExposeMode=False, blockPurgedWipe=fast)
         self.fee.setMode('idle')
         self._setExposureState('idle', cmd=cmd)
 
@@ -160,13 +417,24 @@ class Exposure(object):
         nwipes = int(nrows != 0)
         if nwipes == 0:
             cmd.warn('text="not really wiping, because nrows=0..."')
-        ccdFuncs.wipe(self.ccd, feeControl=self.fee,
-                      nwipes=nwipes, nrows=nrows, blockPurgedWipe=fast)
-        self.timecards = timecards.TimeCards()
-        self._setExposureState('integrating', cmd=cmd)
-        self.startTime = time.time()
-        if nwipes > 0:
-            self.startHeader(cmd)
+        with self.feeExposing():
+            with self.timings.phase('wipe'):
+                self.ccdFuncs.wipe(self.ccd, feeControl=self.fee,
+                                   nwipes=nwipes, nrows=nrows, blockPurgedWipe=fast)
+            self.timings.start('integration')
+            self.timecards = timecards.TimeCards()
+            self._setExposureState('integrating', cmd=cmd)
+            self.startTime = time.time()
+            if nwipes > 0:
+                self.startHeader(cmd)
+
+    def feeExposing(self):
+        """Return a context in which the FEE serves us before any monitoring. """
+
+        scheduler = getattr(self.actor.controllers.get('fee', None), 'scheduler', None)
+        if scheduler is None:
+            return contextlib.nullcontext()
+        return scheduler.exposing()
 
     def armName(self, armNum):
         """Map arm number to arm name.
@@ -181,8 +449,7 @@ class Exposure(object):
         armName : `str`
         """
 
-        arms = {1:'b', 2:'r', 3:'n', 4:'m'}
-        return arms.get(armNum, 'x')
+        return armName(armNum)
 
     def makeFilePath(self, visit, cmd=None):
         """Construct next image filename. Creates any necessary directories. """
@@ -194,6 +461,31 @@ class Exposure(object):
         pathDir.mkdir(mode=0o2755, parents=True, exist_ok=True)
         return path
 
+    def fullFrameRows(self):
+        """Return the number of rows in a full frame, or None if we cannot tell.
+
+        Taken from the ccd frame pool, which is sized by makeEmptyImage().
+        """
+
+        pool = getattr(self.ccd, 'framePool', None)
+        if pool is not None:
+            return pool.shape[0]
+        return getattr(self.ccd, 'nrows', None)
+
+    def retainImage(self, im):
+        """Add a reference to an image which might be a ccd frame pool buffer. """
+
+        pool = getattr(self.ccd, 'framePool', None)
+        if pool is not None:
+            pool.retain(im)
+
+    def releaseImage(self, im):
+        """Drop a reference to an image which might be a ccd frame pool buffer. """
+
+        pool = getattr(self.ccd, 'framePool', None)
+        if pool is not None:
+            pool.release(im)
+
     def placeRows(self, subIm, row0):
         """Return a full-sized readout with the given band of rows copied in.
 
@@ -207,12 +499,16 @@ class Exposure(object):
         Returns
         -------
         im : a full-size detector image, with subIm placed between rows row0..row0+nrows-1, and
-             the rest of the image set to 0.
+             the rest of the image set to 0. It is a ccd frame pool buffer if a frame is free.
         """
 
         nrows = subIm.shape[0]
 
-        newIm = self.ccd.makeEmptyImage()
+        pool = getattr(self.ccd, 'framePool', None)
+        if pool is not None:
+            newIm = pool.acquire(zero=True)
+        else:
+            newIm = self.ccd.makeEmptyImage()
         newIm[row0:row0+nrows,:] = subIm
         return newIm
 
@@ -220,8 +516,28 @@ class Exposure(object):
                 visit=None, obstime=None, comment='',
                 pfsDesign=None, metadata=None,
                 doFeeCards=True, doModes=True, fast=False,
-                nrows=None, ncols=None, row0=0,
-                cmd=None, doRun=True):
+                nrows=None, ncols=None, row0=0, windowed=None,
+                cmd=None, doRun=True, pendingWrites=None, doPreview=None):
+        """Read the detector out, and queue the image file to be written.
+
+        The `filepath` and `spsFileIds` keywords are only generated once
+        the file is on disk. If `pendingWrites` is passed, it is told about
+        the write so that the caller can finish or fail its command once
+        the file has been written.
+
+        If we are part of a pipelined sequence, all post-readout processing
+        is handed off and we return as soon as the header is complete.
+
+        A window of rows starting at row0 is written as a full-sized frame
+        unless `windowed` is set, in which case only the rows which were
+        read are written, and the DETSEC card says where they belong. The
+        default comes from actorConfig['readout']['windowMode'].
+
+        If `doPreview` is set, or by default if actorConfig['preview']['enabled']
+        is, a small binned preview is written next to the raw file by the
+        QaPool, and announced with the `previewPath` keyword.
+        """
+
         if imtype is not None:
             self.imtype = imtype
         if expTime is not None:
@@ -244,8 +560,27 @@ class Exposure(object):
         if cmd is None:
             cmd = self.cmd
 
+        readoutConfig = self.actor.actorConfig.get('readout', dict())
+        if windowed is None:
+            windowed = readoutConfig.get('windowMode', 'padded') == 'windowed'
+        if doPreview is None:
+            doPreview = self.actor.actorConfig.get('preview', dict()).get('enabled', False)
+
+        # Measure the overscans as the rows arrive, so that their QA is
+        # ready as soon as the readout is done.
+        qaConfig = self.actor.actorConfig.get('qa', dict())
+        if doRun and qaConfig.get('streaming', True):
+            streamQA = streamingQA.StreamingOverscanQA(bandRows=qaConfig.get('bandRows', 100),
+                                                       zeroFrac=qaConfig.get('zeroFrac', 0.5),
+                                                       satFrac=qaConfig.get('satFrac', 0.5))
+        else:
+            streamQA = None
+
         def rowCB(line, image, errorMsg="OK", cmd=cmd, **kwargs):
             imageHeight = image.shape[0]
+            if streamQA is not None:
+                for anomaly in streamQA.update(line, image):
+                    cmd.warn(f'text="visit {visit}: {anomaly}"')
             everyNRows = 500
             if (line % everyNRows != 0) and (line < imageHeight-1):
                 return
@@ -271,21 +606,28 @@ class Exposure(object):
         self.darkTime = darkTime
 
         if doRun:
+            self.timings.end('integration')
+            self.timings.waitFor = {'write', 'qa'}
+            self.timings.onComplete = functools.partial(self._reportTimings, visit, cmd)
+
             self.timecards.end(expTime=self.expTime)
-            im, _ = ccdFuncs.readout(self.imtype, expTime=self.expTime,
-                                     darkTime=self.darkTime,
-                                     ccd=self.ccd, feeControl=self.fee,
-                                     nrows=nrows, ncols=ncols,
-                                     doFeeCards=False, doModes=doModes,
-                                     comment=self.comment,
-                                     doSave=False,
-                                     rowStatsFunc=rowCB)
+            with self.timings.phase('readout'), self.feeExposing():
+                im, _ = self.ccdFuncs.readout(self.imtype, expTime=self.expTime,
+                                              darkTime=self.darkTime,
+                                              ccd=self.ccd, feeControl=self.fee,
+                                              nrows=nrows, ncols=ncols,
+                                              doFeeCards=False, doModes=doModes,
+                                              comment=self.comment,
+                                              doSave=False,
+                                              rowStatsFunc=rowCB)
             if nrows is None:
                 nrows = im.shape[0]
-            im = self.fixupImage(im, cmd)
 
-            if row0 > 0:
-                im = self.placeRows(im, row0)
+            overscan = None
+            if streamQA is not None:
+                overscan = streamQA.finish(ampOrder=self.ampOrder())
+                if overscan is not None:
+                    self.emitQA(self.overscanQA(overscan, visit), cmd)
 
             filepath = self.makeFilePath(visit, cmd)
 
@@ -295,65 +637,231 @@ class Exposure(object):
             addCards.append(dict(name='W_CDROWN', value=row0+nrows-1,
                                 comment='last row in readout window'))
 
-            finalCards = self.finishHeaderKeys(cmd, visit, extraCards=addCards,
-                                               pfsDesign=pfsDesign,
-                                               metadata=metadata)
-
-            self.writeImageFile(im, filepath, visit, cards=finalCards,
-                                comment=self.comment, cmd=cmd)
+            with self.timings.phase('header'):
+                finalCards = self.finishHeaderKeys(cmd, visit, extraCards=addCards,
+                                                   pfsDesign=pfsDesign,
+                                                   metadata=metadata)
+
+            imageCards = []
+            fullRows = self.fullFrameRows()
+            isWindow = row0 > 0 or (fullRows is not None and nrows < fullRows)
+            if windowed and isWindow and readoutConfig.get('detsec', True):
+                imageCards.append(dict(name='DETSEC',
+                                       value=f'[1:{im.shape[1]},{row0+1}:{row0+nrows}]',
+                                       comment='detector section of the readout window'))
+
+            writeJob = self.makeWriteJob(filepath, visit, cards=finalCards,
+                                         imageCards=imageCards,
+                                         comment=self.comment, cmd=cmd,
+                                         pendingWrites=pendingWrites)
+            job = ProcessJob(self, im, writeJob, visit, row0, nrows, cmd,
+                             windowed=windowed, doOverscan=overscan is None,
+                             doPreview=doPreview)
+            if self.pipeline is not None:
+                self.pipeline.submit(job)
+            else:
+                # Combining is left to the writer, with the write, to keep
+                # it off the path to the next wipe.
+                im = job.process()
+                self.actor.fitsWriter.submit(job)
         else:
             im = None
             filepath = "/no/such/dir/PFXA00000099.fits"
-        if im is not None:
-            try:
-                # proceed with crude serial overscan check.
-                overscan = basicQA.serialOverscanStats(im, readRows=(row0, row0+nrows))
-
-                # generate keywords.
-                cmd.inform(f"overscanLevels={','.join(map(str, overscan.level.round(3)))}")
-                cmd.inform(f"overscanNoise={','.join(map(str, overscan.noise.round(3)))}")
-
-                # ensure overscans level/noise are compliants.
-                status = basicQA.ensureOverscansAreInRange(overscan, self.actor.actorConfig['amplifiers'])
-                msg = f'visitQA={visit},{qstr(status)}'
-                if status == 'OK':
-                    cmd.inform(msg)
-                else:
-                    cmd.warn(msg)
-            except Exception as e:
-                cmd.warn(f'text="failed to run QA checks: {e}"')
 
-        # The generated filenames encapsulate SPS logic. Extract the
-        # components instead of regenerating them.
-        filepath = pathlib.Path(filepath)
-        filename = filepath.name
+        self._setExposureState('idle', cmd=cmd)
+        if not doRun:
+            self._reportFile(filepath, visit, cmd)
 
-        rootDir = filepath.parents[2]
-        dateDir = filepath.parent.parent.name
+        return im, pathlib.Path(filepath)
 
-        filestem = filepath.stem
-        spectrograph = int(filestem[-2])
-        armNum = int(filestem[-1])
-        armName = self.armName(armNum)
-        camName = f'{armName}{spectrograph}'
+    def computeQA(self, im, visit, readRows, doOverscan=True):
+        """Run the post-readout QA checks.
 
-        self._setExposureState('idle', cmd=cmd)
-        cmd.inform('filepath=%s,%s,%s' % (qstr(rootDir),
-                                          qstr(dateDir),
-                                          qstr(filename)))
+        Args
+        ----
+        im : `numpy.ndarray`
+          The processed image. Not modified.
+        visit : `int`
+          The PFS visit number.
+        readRows : (`int`, `int`)
+          The range of image rows which were read.
+        doOverscan : `bool`
+          Whether to run the overscan checks. Not needed if they were
+          run during the readout.
+
+        Returns
+        -------
+        keys : `list` of (`bool`, `str`)
+          The keywords to generate, and whether each is a warning.
+        """
+
+        keys = []
+
+        if doOverscan:
+            # proceed with crude serial overscan check.
+            overscan = basicQA.serialOverscanStats(im, readRows=readRows)
+            keys.extend(self.overscanQA(overscan, visit))
+
+        spectrumConfig = self.actor.actorConfig.get('qa', dict()).get('noiseSpectrum', dict())
+        if self.imtype in spectrumConfig.get('imtypes', ['bias']):
+            keys.extend(self.noiseSpectrumQA(im, visit, readRows, spectrumConfig))
+
+        return keys
 
-        cmd.inform('spsFileIds=%s,%s,%d,%d,%d' % (camName,
-                                                  qstr(dateDir),
-                                                  visit,
-                                                  spectrograph,
-                                                  armNum))
-        return im, filepath
+    def noiseSpectrumQA(self, im, visit, readRows, config):
+        """Return the QA keywords for periodic noise in the amp readouts.
+
+        Pickup lines are only looked for in biases, using whole rows. For
+        other images see `broadbandNoiseQA`.
+
+        Args
+        ----
+        im : `numpy.ndarray`
+          The processed image. Not modified.
+        visit : `int`
+          The PFS visit number.
+        readRows : (`int`, `int`)
+          The range of image rows which were read.
+        config : `dict`
+          actorConfig['qa']['noiseSpectrum']
+
+        Returns
+        -------
+        keys : `list` of (`bool`, `str`)
+          The keywords to generate, and whether each is a warning.
+        """
+
+        pixelTime = config.get('pixelTime', getattr(self.ccd, 'pixelTime', 13.6e-6))
+        if self.imtype != 'bias':
+            return self.broadbandNoiseQA(im, visit, readRows, pixelTime, config)
+
+        nPeaks = config.get('nPeaks', 3)
+        peaks, ampPeaks = noiseQA.noiseSpectrum(im, readRows, pixelTime,
+                                                rowGap=config.get('rowGap', 0),
+                                                maxRows=config.get('maxRows', 1000),
+                                                nperseg=config.get('nperseg', 4096),
+                                                nPeaks=nPeaks,
+                                                minFreq=config.get('minFreq', 100.0),
+                                                threshold=config.get('threshold', 10.0))
+        self.qaRecord['noisePeaks'] = peaks
+        self.qaRecord['ampNoisePeaks'] = ampPeaks
+
+        peakVals = np.full((nPeaks, 2), np.nan)
+        peakVals[:len(peaks)] = np.array([peaks.freq, peaks.rms]).T
+        ampVals = np.array([ampPeaks.freq, ampPeaks.rms]).T
+
+        warnRms = config.get('warnRms', 1.0)
+        isWarning = len(peaks) > 0 and peaks.rms.max() > warnRms
+
+        def fmt(vals):
+            return ','.join(['%0.1f,%0.3f' % (f, rms) for f, rms in vals])
+
+        keys = []
+        keys.append((isWarning, 'noisePeaks=%d,%s' % (visit, fmt(peakVals))))
+        keys.append((False, 'ampNoisePeaks=%d,%s' % (visit, fmt(ampVals))))
+
+        return keys
+
+    def broadbandNoiseQA(self, im, visit, readRows, pixelTime, config):
+        """Return the QA keyword for the overscan noise above minFreq, for images with signal.
+
+        The overscans alone cannot locate pickup lines, so only the total
+        is reported. It is a warning above config['warnBroadbandRms'], if set.
+        """
+
+        rms = noiseQA.broadbandNoise(im, readRows, pixelTime,
+                                     rowGap=config.get('rowGap', 0),
+                                     maxRows=config.get('maxRows', 1000),
+                                     nperseg=config.get('nperseg', 4096),
+                                     minFreq=config.get('minFreq', 100.0))
+        self.qaRecord['noiseBroadband'] = rms
+
+        warnRms = config.get('warnBroadbandRms', None)
+        isWarning = warnRms is not None and rms.max() > warnRms
+
+        return [(isWarning, 'noiseBroadband=%d,%s' % (visit, ','.join(['%0.3f' % r for r in rms])))]
+
+    def overscanQA(self, overscan, visit):
+        """Return the QA keywords for per-amp overscan levels and noise.
+
+        Args
+        ----
+        overscan : `numpy.recarray`
+          level and noise per amp.
+        visit : `int`
+          The PFS visit number.
+
+        Returns
+        -------
+        keys : `list` of (`bool`, `str`)
+          The keywords to generate, and whether each is a warning.
+        """
+
+        self.qaRecord['overscan'] = overscan
+        history = getattr(self.actor, 'qaHistory', None)
+        if history is not None:
+            history.add(visit, overscan)
+
+        keys = []
+
+        # generate keywords.
+        keys.append((False, f"overscanLevels={','.join(map(str, overscan.level.round(3)))}"))
+        keys.append((False, f"overscanNoise={','.join(map(str, overscan.noise.round(3)))}"))
+
+        # ensure overscans level/noise are compliants.
+        limits = getattr(self.actor, 'ampLimits', None)
+        if limits is None:
+            limits = ampLimits.AmpLimits(self.actor.actorConfig['amplifiers'])
+        mask = limits.check(overscan)
+        self.qaRecord['ampQA'] = mask
+        status = basicQA.ensureOverscansAreInRange(overscan, limits, mask=mask)
+        keys.append((False, f"ampQA={visit},{','.join(map(str, mask))}"))
+        keys.append((status != 'OK', f'visitQA={visit},{qstr(status)}'))
+
+        return keys
+
+    def emitQA(self, keys, cmd):
+        """Generate the keywords returned by `computeQA`. """
+
+        for isWarning, key in keys:
+            if isWarning:
+                cmd.warn(key)
+            else:
+                cmd.inform(key)
+
+    def _reportTimings(self, visit, cmd, timings):
+        """Generate the exposureTimings keyword and add to the actor's history. """
+
+        durations = timings.getDurations() + [timings.getTotal()]
+        self.logger.info('timings for visit %s: %s total=%0.3f', visit, timings, durations[-1])
+        cmd.inform('exposureTimings=%d,%s' % (visit, ','.join(['%0.3f' % d for d in durations])))
+
+        history = getattr(self.actor, 'timingHistory', None)
+        if history is not None:
+            history.add(visit, timings)
+
+    def _reportFile(self, filepath, visit, cmd):
+        """Generate the keywords announcing a new image file. """
+
+        reportFile(filepath, visit, cmd)
+
+    def ampOrder(self):
+        """Return the raw amp index for each amp, as `fixupImage` leaves them.
+
+        Returns
+        -------
+        order : `list` of `int`, or `None` if fixupImage does not move amps.
+        """
+
+        if self.actor.ids.camName == 'b2':
+            return [0, 6, 2, 3, 4, 5, 1, 7]
+        return None
 
     def fixupImage(self, im, cmd):
         """Apply any post-readout corrections to images.
 
         Current used for:
-         - INSTRM-1100: swap b2 amps: 0_1 (idx=1) <-> 1_2 (idx=6)
+         - INSTRM-1100: swap b2 amps: 0_1 (idx=1) <-> 1_2 (idx=6). Keep `ampOrder` in step.
 
         Args
         ----
@@ -372,42 +880,75 @@ class Exposure(object):
             self.logger.info('swapping b2 amps')
             cmd.debug('text="fixup: swapping b2 amps"')
 
+            # Swap in bands, so that we do not allocate a full amp copy.
             ampWidth = im.shape[1] // 8
-            amp_0_1 = im[:, 1*ampWidth:2*ampWidth].copy()
-            im[:, 1*ampWidth:2*ampWidth] = im[:, 6*ampWidth:7*ampWidth]
-            im[:, 6*ampWidth:7*ampWidth] = amp_0_1
+            bandRows = 256
+            tmp = np.empty((bandRows, ampWidth), dtype=im.dtype)
+            for r0 in range(0, im.shape[0], bandRows):
+                r1 = min(r0 + bandRows, im.shape[0])
+                amp_0_1 = tmp[:r1-r0]
+                amp_0_1[:] = im[r0:r1, 1*ampWidth:2*ampWidth]
+                im[r0:r1, 1*ampWidth:2*ampWidth] = im[r0:r1, 6*ampWidth:7*ampWidth]
+                im[r0:r1, 6*ampWidth:7*ampWidth] = amp_0_1
 
         return im
 
     def writeImageFile(self, im, filepath, visit,
-                       cards=None, comment=None, cmd=None):
-        """Actually write the FITS file.
+                       cards=None, imageCards=None, comment=None, cmd=None,
+                       pendingWrites=None):
+        """Queue the FITS file to be written by the actor's FitsWriter.
+
+        See `makeWriteJob` for the arguments.
+        """
+
+        job = self.makeWriteJob(filepath, visit, cards=cards, imageCards=imageCards,
+                                comment=comment, cmd=cmd, pendingWrites=pendingWrites)
+        job.image = im
+        self.actor.fitsWriter.submit(job)
+
+        return filepath
+
+    def makeWriteJob(self, filepath, visit,
+                     cards=None, imageCards=None, comment=None, cmd=None,
+                     pendingWrites=None):
+        """Prepare the job which will write the FITS file.
 
         Args
         ----
-        im : `numpy.ndarray`
-          The image.
         filepath : `str` or `pathlib.Path`
           The full pathname of the file to write.
         visit : `int`
           The PFS visit number
-        addCards : sequence of fitsio card dicts
-          FITS cards to add.
+        cards : sequence of fitsio card dicts
+          FITS cards to add to the PHDU.
+        imageCards : sequence of fitsio card dicts
+          FITS cards to add to the image HDU.
         comment : `str`
           A comment to put at the start of the headeer.
         cmd : `actorcore.Command`
           Where to dribble info
+        pendingWrites : `fitsWriter.PendingWrites`
+          If set, told when the file has been written or has failed.
 
         Returns
         -------
-        filepath : `str`
-          the input filepath
+        job : `fitsWriter.WriteJob`
+          The job, without its image. The image is handed back to the ccd
+          frame pool once it has been written.
+
+        The image is compressed as the actor's CompressionPolicy says
+        for our imtype. The filepath keywords are generated once the
+        file is on disk.
 
-        The file is saved with RICE compression.
+        If the actor has a spool, the file is written there and handed
+        to the FileMover once it is on disk, and spoolFilepath is
+        generated. The command does not wait for the move, but the
+        filepath keywords do: the actor generates them once the file is
+        at its final path.
 
         """
-        self.logger.info('creating fits file: %s', filepath)
-        cmd.debug('text="creating fits file %s' % (filepath))
+        self.logger.info('queueing fits file: %s', filepath)
+        cmd.debug('text="queueing fits file %s' % (filepath))
 
         finalCards = []
         if comment is not None:
@@ -415,22 +956,57 @@ class Exposure(object):
 
         if cards is not None:
             finalCards.extend(cards)
+        imCards = self.header.getImageCards(cmd)
+        if imageCards is not None:
+            imCards.extend(imageCards)
 
-        try:
-            hdr = fitsio.FITSHDR(finalCards)
-            fitsFile = fitsio.FITS(str(filepath), 'rw')
-            fitsFile.write(None, header=hdr)
-            fitsFile[-1].write_checksum()
-            imHdr = fitsio.FITSHDR(self.header.getImageCards(cmd))
-            fitsFile.write(im, extname="image", header=imHdr, compress='RICE')
-            fitsFile[-1].write_checksum()
-            fitsFile.close()
-        except Exception as e:
-            cmd.warn('text="failed to write fits file %s: %s"' % (filepath, e))
-            self.logger.warn('failed to write fits file %s: %s', filepath, e)
-            self.logger.warn('hdr : %s', hdr)
+        mover = getattr(self.actor, 'fileMover', None)
+        writePath = mover.spoolPath(filepath) if mover is not None else filepath
 
-        return filepath
+        # Whatever goes wrong after the write, pendingWrites must hear
+        # about it, or the command waiting for the file never finishes.
+        def onDone():
+            error = None
+            try:
+                self.logger.info('wrote fits file: %s', writePath)
+                self.actor.lastFilepath = writePath
+                self.releaseImage(job.image)
+                self.timings.finished('write')
+                if mover is not None:
+                    cmd.inform('spoolFilepath=%s' % (qstr(writePath)))
+                    mover.submit(writePath, filepath, info=dict(visit=int(visit)))
+                else:
+                    self._reportFile(filepath, visit, cmd)
+                    self.actor.verifyFile(filepath)
+            except Exception as e:
+                self.logger.warn('failed to handle written fits file %s: %s', writePath, e)
+                error = e
+            finally:
+                if pendingWrites is not None:
+                    pendingWrites.done(error)
+
+        def onFail(e):
+            try:
+                cmd.warn('text="failed to write fits file %s: %s"' % (writePath, e))
+                self.logger.warn('failed to write fits file %s: %s', writePath, e)
+                self.logger.warn('hdr : %s', finalCards)
+                self.releaseImage(job.image)
+                self.timings.finished('write')
+            finally:
+                if pendingWrites is not None:
+                    pendingWrites.done(e)
+
+        policy = getattr(self.actor, 'compressionPolicy', None)
+        compression = policy.forImtype(self.imtype) if policy is not None else None
+
+        if pendingWrites is not None:
+            pendingWrites.add()
+        job = fitsWriter.WriteJob(writePath, None, finalCards, imCards,
+                                  onDone=onDone, onFail=onFail,
+                                  timings=self.timings, compression=compression,
+                                  tileWriter=getattr(self.actor, 'tileWriter', None),
+                                  finalPath=filepath)
+        return job
 
     def _grabInternalCards(self):
         cards = []
@@ -446,8 +1022,7 @@ class Exposure(object):
             fee = self.actor.fee
             ccdKeys = self.actor.ccdModel.keyVarDict
 
-            fee.getCommandStatus('voltage')
-            fee.getCommandStatus('bias')
+            fee.getStatusSets(['voltage', 'bias'])
 
         except Exception as e:
             cmd.warn(f'text="could not fetch new FEE cards: {e}"')
@@ -466,9 +1041,10 @@ class Exposure(object):
     def _grabLastFeeCards(self, cmd):
         cards = []
         try:
-            cards = fitsMhs.gatherHeaderCards(cmd, self.actor,
-                                              modelNames=[self.actor.ccdModelName],
-                                              shortNames=True)
+            with self.timings.phase('feeCards'):
+                cards = fitsMhs.gatherHeaderCards(cmd, self.actor,
+                                                  modelNames=[self.actor.ccdModelName],
+                                                  shortNames=True)
         except Exception as e:
             cmd.warn(f'text="could not gather ccdModel cards: {e}"')
             return cards
@@ -4,6 +4,7 @@ import logging
 
 import fpga.ccd
 from ics.utils.sps import spectroIds
+from ccdActor.utils import framePool
 
 reload(fpga.ccd)
 
@@ -29,6 +30,16 @@ class ccd(fpga.ccd.CCD):
                               adcVersion=adcVersion)
         actor.bcast.inform('version_fpga="%s"; text="%s"' % (self.fpgaVersion(), self))
 
+        # Full frames for the readouts we assemble ourselves: row0 windows
+        # placed in a full frame (see Exposure.placeRows). Full-frame
+        # readouts are not pooled: ccdFuncs.readout allocates its own
+        # image and cannot be given one.
+        poolConfig = actor.actorConfig.get('framePool', dict())
+        fullFrame = self.makeEmptyImage()
+        self.framePool = framePool.FramePool(fullFrame.shape,
+                                             nFrames=poolConfig.get('nFrames', 4),
+                                             dtype=fullFrame.dtype)
+
     def stop(self, cmd=None):
         pass
 
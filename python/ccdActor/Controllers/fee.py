@@ -1,7 +1,15 @@
+import functools
 import logging
+import threading
+import time
 from importlib import reload
 
 import xcu_fpga.fee.feeControl as feeControl
+from ccdActor.utils import feeAsync
+from ccdActor.utils import feeBatch
+from ccdActor.utils import feeCache
+from ccdActor.utils import feeScheduler
+from ccdActor.utils import feeSim
 
 reload(feeControl)
 
@@ -15,13 +23,46 @@ class fee(feeControl.FeeControl):
 
         fpga = actor.controllers.get('ccd', None)
         port = actor.actorConfig['fee']['port']
+
+        # Optionally talk to an in-process FEE emulator instead of the real
+        # FEE, replaying a transcript recorded with `startRecording()`.
+        self.simulator = None
+        self.recorder = None
+        self.benchCounter = None
+        simConfig = actor.actorConfig['fee'].get('simulator', None)
+        if simConfig is not None:
+            self.simulator = feeSim.FeeSimulator(**simConfig)
+            port = self.simulator.start()
+            actor.bcast.warn(f'text="using FEE emulator: {self.simulator}"')
+
         features = actor.actorConfig.get('feeFeatures', None)
 
+        # Status replies are served from memory while they are fresh, so
+        # that monitoring does not compete with exposures for the serial line.
+        self.statusCache = feeCache.StatusCache(actor.actorConfig['fee'].get('cacheTTL', None))
+        self.allCategories = None
+
+        # Status reads are sent to the FEE in batches, without waiting
+        # for each reply. All serial I/O goes through ioLock.
+        self.ioLock = threading.RLock()
+        self.replay = feeBatch.CommandReplay()
+        self.batchDepth = actor.actorConfig['fee'].get('batchDepth', 4)
+
+        # Once started, all serial traffic goes through the scheduler's
+        # thread, exposures first and monitoring last.
+        schedConfig = actor.actorConfig['fee'].get('scheduler', dict())
+        self.scheduler = feeScheduler.FeeScheduler(dropWhileBusy=schedConfig.get('dropWhileBusy', True))
+
         feeControl.FeeControl.__init__(self, fpga=fpga,
                                        port=port,
                                        features=features,
                                        logLevel=logLevel)
         self.grabStaticKeys()
+        if schedConfig.get('enabled', True):
+            self.scheduler.start()
+
+        # For callers in the reactor thread, which must not block.
+        self.asyncFee = feeAsync.AsyncFee(self)
 
     def grabStaticKeys(self, cmd=None):
         self.actor.bcast.inform('version_fee="%s"' % self.getCommandStatus('revision')['revision.FEE'])
@@ -32,8 +73,275 @@ class fee(feeControl.FeeControl):
         serialsKey = ','.join(serials)
         self.actor.bcast.inform(f'serials={serialsKey}')
 
+    def sendCommandStr(self, cmdStr, *args, **kwargs):
+        """Send one command and return its reply, which might already have been fetched in a batch. """
+
+        return self.scheduler.call(feeScheduler.COMMAND, self._sendCommandStr, cmdStr, *args, **kwargs)
+
+    def _sendCommandStr(self, cmdStr, *args, **kwargs):
+        with self.ioLock:
+            found, reply = self.replay.answer((cmdStr, args, tuple(sorted(kwargs.items()))))
+            if found:
+                return reply
+            return feeControl.FeeControl.sendCommandStr(self, cmdStr, *args, **kwargs)
+
+    def _exchange(self, request, device):
+        """Run feeControl's own exchange for one (cmdStr, args, kwargs) request, on the given device. """
+
+        cmdStr, args, kwargs = request
+        realDevice = self.device
+        self.device = device
+        try:
+            return feeControl.FeeControl.sendCommandStr(self, cmdStr, *args, **dict(kwargs))
+        finally:
+            self.device = realDevice
+
+    def _drain(self, quiet=0.2):
+        """Discard replies still arriving after a failed batch. """
+
+        device = self.device
+        while 'device' in vars(device):     # Our recording and counting wrappers.
+            device = vars(device)['device']
+        timeout = device.timeout
+        device.timeout = quiet
+        try:
+            while device.read(4096):
+                pass
+        finally:
+            device.timeout = timeout
+
+    def transact(self, cmdStrs):
+        """Send several get-commands back to back and return their replies, in order.
+
+        Only for commands which do not change the FEE state. Each reply
+        is what sendCommandStr would have returned, or a
+        `feeBatch.FeeReplyError` if that command failed. Once a reply
+        goes missing, the rest are sent one at a time.
+        """
+
+        requests = [(cmdStr, (), ()) for cmdStr in cmdStrs]
+        return self.scheduler.call(feeScheduler.COMMAND, self._transact, requests)
+
+    def _transact(self, requests):
+        with self.ioLock:
+            if self.batchDepth > 1 and getattr(self, 'device', None) is not None:
+                replies = feeBatch.pipelined(self._exchange, self.device, requests,
+                                             depth=self.batchDepth)
+            else:
+                replies = [None] * len(requests)
+
+            if any(isinstance(r, Exception) for r in replies):
+                self._drain()
+            for i, (cmdStr, args, kwargs) in enumerate(requests):
+                if replies[i] is None:
+                    try:
+                        replies[i] = feeControl.FeeControl.sendCommandStr(self, cmdStr, *args, **dict(kwargs))
+                    except Exception as e:
+                        replies[i] = feeBatch.FeeReplyError(f'{cmdStr}: {e}')
+
+        return replies
+
+    def _batched(self, name, call):
+        """Run a feeControl status call, with its commands sent to the FEE as one batch.
+
+        The commands are those the same call sent last time, if any.
+        """
+
+        with self.ioLock:
+            if self.replay.recording is not None:
+                return call()
+
+            transcript = self.replay.transcript(name)
+            replies = self._transact(transcript) if transcript else ()
+            self.replay.start(transcript or (), replies)
+            try:
+                ret = call()
+            except Exception:
+                self.replay.abort()
+                raise
+            self.replay.finish(name)
+        return ret
+
+    def _storeBySet(self, values, generation=None):
+        """Cache status keys under their command sets. Returns the set names.
+
+        generation is the status cache's, from before they were read.
+        """
+
+        bySet = dict()
+        for k, v in values.items():
+            bySet.setdefault(k.split('.')[0], dict())[k] = v
+        for cset, setValues in bySet.items():
+            self.statusCache.store(cset, setValues, generation=generation)
+        return sorted(bySet)
+
+    def getCommandStatus(self, cset, fresh=False):
+        """Return the status keys for one command set, from the cache if they are fresh. """
+
+        def fetch():
+            return self.scheduler.call(feeScheduler.MONITOR, self._batched, cset,
+                                       lambda: feeControl.FeeControl.getCommandStatus(self, cset),
+                                       key=cset)
+
+        # Inside a batch, always ask the FEE, so that the batch stays the same.
+        fresh = fresh or self.replay.recording is not None
+        values, age = self.statusCache.fetch(cset, fetch, fresh=fresh)
+        if age > 0:
+            self.status.update(values)
+        return dict(values)
+
+    def getStatusSets(self, csets, fresh=False, separately=False):
+        """Return the status keys for several command sets, fetching all the stale ones in one batch.
+
+        With separately, each stale set is its own batch and scheduler
+        request, so that an exposure never waits for more than one set.
+        """
+
+        values = dict()
+        stale = []
+        for cset in csets:
+            cached = None if fresh else self.statusCache.lookup(cset)
+            if cached is None:
+                stale.append(cset)
+            else:
+                values.update(cached[0])
+
+        def fetch(csets):
+            fetched = dict()
+            for cset in csets:
+                fetched.update(feeControl.FeeControl.getCommandStatus(self, cset))
+            return fetched
+
+        batches = [[cset] for cset in stale] if separately else [stale] if stale else []
+        for batch in batches:
+            name = '+'.join(batch)
+            generation = self.statusCache.generation
+            fetched = self.scheduler.call(feeScheduler.MONITOR, self._batched, name,
+                                          functools.partial(fetch, batch), key=name)
+            self._storeBySet(fetched, generation)
+            values.update(fetched)
+        self.status.update(values)
+        return values
+
+    def getAllStatus(self, fresh=False):
+        """Return all the status keys, using the cache for the command sets which are fresh.
+
+        The first time, feeControl fetches everything, which tells us
+        what the command sets are. After that, each is fetched separately.
+        """
+
+        if self.allCategories:
+            return self.getStatusSets(self.allCategories, fresh=fresh, separately=True)
+
+        generation = self.statusCache.generation
+        values = self.scheduler.call(feeScheduler.MONITOR, self._batched, 'all',
+                                     lambda: feeControl.FeeControl.getAllStatus(self),
+                                     key='all')
+        self.allCategories = self._storeBySet(values, generation)
+
+        return values
+
+    def getTemps(self, fresh=False):
+        def fetch():
+            return self.scheduler.call(feeScheduler.MONITOR, feeControl.FeeControl.getTemps, self,
+                                       key='getTemps')
+
+        values, age = self.statusCache.fetch('getTemps', fetch, category='temps', fresh=fresh)
+        return dict(values)
+
+    def statusAges(self, csets=None):
+        """Return the age in seconds of the cached status for some or all command sets. """
+
+        ages = self.statusCache.ages()
+        if csets is not None:
+            ages = {cset: ages[cset] for cset in csets if cset in ages}
+        return ages
+
+    # Anything which changes the FEE state drops what it makes stale.
+
+    def _change(self, priority, categories, func, *args, **kwargs):
+        """Run a feeControl call which changes the FEE state, on the scheduler thread.
+
+        The cached status in the given categories (all, if none) is
+        dropped under ioLock both before and after the change, so that
+        nobody is answered from it meanwhile, and fetches which read the
+        FEE before the change cannot store their results.
+        """
+
+        def change():
+            with self.ioLock:
+                self.statusCache.invalidate(*categories)
+                try:
+                    return func(self, *args, **kwargs)
+                finally:
+                    self.statusCache.invalidate(*categories)
+
+        return self.scheduler.call(priority, change)
+
+    def setMode(self, *args, **kwargs):
+        return self._change(feeScheduler.EXPOSURE, ('preset', 'voltage', 'bias'),
+                            feeControl.FeeControl.setMode, *args, **kwargs)
+
+    def setOffsets(self, *args, **kwargs):
+        return self._change(feeScheduler.COMMAND, ('offset',),
+                            feeControl.FeeControl.setOffsets, *args, **kwargs)
+
+    def calibrate(self, *args, **kwargs):
+        return self._change(feeScheduler.COMMAND, ('preset', 'voltage', 'bias', 'offset'),
+                            feeControl.FeeControl.calibrate, *args, **kwargs)
+
+    def setSerial(self, *args, **kwargs):
+        return self._change(feeScheduler.COMMAND, ('serial',),
+                            feeControl.FeeControl.setSerial, *args, **kwargs)
+
+    def setVoltageCalibrations(self, *args, **kwargs):
+        return self._change(feeScheduler.COMMAND, ('voltage',),
+                            feeControl.FeeControl.setVoltageCalibrations, *args, **kwargs)
+
+    def sendImage(self, *args, **kwargs):
+        return self._change(feeScheduler.COMMAND, (),
+                            feeControl.FeeControl.sendImage, *args, **kwargs)
+
+    def startRecording(self):
+        """Start recording all FEE traffic, for replaying with feeSim.
+
+        Batching is turned off while recording, so that each recorded
+        exchange is one command and its reply.
+        """
+
+        def start():
+            with self.ioLock:
+                if self.recorder is not None:
+                    raise RuntimeError('already recording FEE traffic')
+                if self.benchCounter is not None:
+                    raise RuntimeError('cannot record FEE traffic during a FEE benchmark')
+                self.recorder = feeSim.FeeRecorder(self.device)
+                self.device = self.recorder
+                self.recordedBatchDepth = self.batchDepth
+                self.batchDepth = 1
+
+        self.scheduler.call(feeScheduler.COMMAND, start)
+
+    def stopRecording(self, path):
+        """Stop recording FEE traffic, and save the transcript. Returns the number of exchanges. """
+
+        def stop():
+            with self.ioLock:
+                if self.recorder is None:
+                    raise RuntimeError('not recording FEE traffic')
+                recorder = self.recorder
+                self.device = recorder.device
+                self.batchDepth = self.recordedBatchDepth
+                self.recorder = None
+            return recorder
+
+        recorder = self.scheduler.call(feeScheduler.COMMAND, stop)
+        return recorder.save(path, revision=self.status.get('revision.FEE', None),
+                             serial=self.status.get('serial.FEE', None),
+                             date=time.strftime('%Y-%m-%dT%H:%M:%S'))
+
     def stop(self, cmd=None):
-        pass
+        self.scheduler.stop()
 
     def start(self, cmd=None):
         pass
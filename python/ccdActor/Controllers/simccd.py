@@ -0,0 +1,230 @@
+import logging
+import threading
+import time
+
+import numpy as np
+
+from ccdActor.utils import framePool
+
+
+class SimFileMgr(object):
+    """Hand out sequence numbers when we are not told our visit. """
+
+    def __init__(self, seqno=1):
+        self.lock = threading.Lock()
+        self.seqno = seqno
+
+    def consumeNextSeqno(self):
+        with self.lock:
+            seqno = self.seqno
+            self.seqno += 1
+        return seqno
+
+
+class SimCcdFuncs(object):
+    """Stand-ins for the `fpga.ccdFuncs` routines which `Exposure` calls.
+
+    The signatures match those of fpga.ccdFuncs, so an Exposure simply
+    uses `ccd.ccdFuncs` if the controller provides one.
+    """
+
+    def __init__(self, ccd):
+        self.ccd = ccd
+
+    def wipe(self, ccd, feeControl=None, nwipes=1, nrows=None,
+             toExposeMode=True, blockPurgedWipe=False):
+        if feeControl is not None and nwipes > 0:
+            feeControl.setMode('wipe')
+        if nwipes > 0:
+            self.ccd.simWipe(nrows=nrows, fast=blockPurgedWipe)
+        if feeControl is not None and toExposeMode:
+            feeControl.setMode('expose')
+
+    def readout(self, imtype, expTime=0.0, darkTime=None,
+                ccd=None, feeControl=None,
+                nrows=None, ncols=None,
+                doFeeCards=True, doModes=True, comment='',
+                doSave=True, rowStatsFunc=None, **kwargs):
+        if feeControl is not None and doModes:
+            feeControl.setMode('read')
+
+        im = self.ccd.simReadout(imtype, expTime=expTime, darkTime=darkTime,
+                                 nrows=nrows, ncols=ncols,
+                                 rowFunc=rowStatsFunc)
+
+        if feeControl is not None and doModes:
+            feeControl.setMode('idle')
+        return im, None
+
+
+class simccd(object):
+    """A simulated CCD/FPGA controller, which needs no PCI hardware.
+
+    Produces frames with the PFS amp/leadin/overscan geometry at the real
+    pixel rate, calling the readout row callback as rows arrive. Attach
+    it by listing 'simccd' instead of 'ccd' in
+    actorConfig['controllers']['starting']; the actor registers it as
+    the 'ccd' controller.
+
+    All parameters come from actorConfig['simccd']:
+
+    ampCols, leadinCols, overscanCols : `int`
+      Columns per amp, of which leading and trailing columns are bias.
+    nrows, overscanRows : `int`
+      Rows per frame, of which the last ones are bias.
+    pixelTime : `float`
+      Seconds per pixel. All amps are read in parallel.
+    wipeTime : `float`
+      Seconds per full wipe.
+    bias, noise : `float` or list of 8 `float`
+      Per-amp bias level and read noise, in ADU.
+    darkRate, flatLevel : `float`
+      Dark current in ADU/s and the level of flats and arcs, in ADU.
+    """
+
+    namps = 8
+
+    def __init__(self, actor, name,
+                 logLevel=logging.DEBUG):
+
+        self.actor = actor
+        self.name = name
+        self.logger = logging.getLogger(name)
+        self.logger.setLevel(logLevel)
+
+        config = actor.actorConfig.get('simccd', dict())
+        self.ampCols = config.get('ampCols', 520)
+        self.leadinCols = config.get('leadinCols', 8)
+        self.overscanCols = config.get('overscanCols', 32)
+        self.nrows = config.get('nrows', 4300)
+        self.overscanRows = config.get('overscanRows', 76)
+        self.pixelTime = config.get('pixelTime', 13.6e-6)
+        self.wipeTime = config.get('wipeTime', 3.0)
+        self.bias = np.broadcast_to(np.asarray(config.get('bias', 1000.0), dtype='f4'),
+                                    (self.namps,)).copy()
+        self.noise = np.broadcast_to(np.asarray(config.get('noise', 4.0), dtype='f4'),
+                                     (self.namps,)).copy()
+        self.darkRate = config.get('darkRate', 0.0)
+        self.flatLevel = config.get('flatLevel', 10000.0)
+
+        self.holdOn = []
+        self.holdOff = []
+        self.fileMgr = SimFileMgr()
+        self.ccdFuncs = SimCcdFuncs(self)
+        self.rng = np.random.default_rng()
+
+        poolConfig = actor.actorConfig.get('framePool', dict())
+        self.framePool = framePool.FramePool((self.nrows, self.ncols),
+                                             nFrames=poolConfig.get('nFrames', 4))
+
+        actor.bcast.warn(f'text="using simulated ccd controller: {self}"')
+        actor.bcast.inform('version_fpga="%s"; text="%s"' % (self.fpgaVersion(), self))
+
+    def __str__(self):
+        return (f'simccd(nrows={self.nrows}, ncols={self.ncols}, '
+                f'pixelTime={self.pixelTime})')
+
+    @property
+    def ncols(self):
+        return self.namps * self.ampCols
+
+    def fpgaVersion(self):
+        return 'simulated'
+
+    def makeEmptyImage(self):
+        """Return a new, cleared, full frame. """
+
+        return np.zeros((self.nrows, self.ncols), dtype='u2')
+
+    def simWipe(self, nrows=None, fast=False):
+        if nrows is None:
+            nrows = self.nrows
+        wipeTime = self.wipeTime * nrows / self.nrows
+        if fast:
+            wipeTime /= 10
+        time.sleep(wipeTime)
+
+    def _ampLevels(self, imtype, darkTime):
+        """Return the per-amp signal level for an exposure. """
+
+        signal = 0.0
+        if darkTime:
+            signal += self.darkRate * darkTime
+        if imtype in {'flat', 'domeflat', 'arc'}:
+            signal += self.flatLevel
+        return signal
+
+    def _fillRows(self, image, row0, row1, ampCols, signal):
+        """Fill image rows row0..row1-1 with simulated pixels. """
+
+        nrows = row1 - row0
+        band = image[row0:row1].reshape(nrows, self.namps, ampCols)
+        noise = self.rng.standard_normal((nrows, self.namps, ampCols), dtype='f4')
+        noise *= self.noise[None, :, None]
+        noise += self.bias[None, :, None]
+
+        dataRows = max(0, min(row1, self.nrows - self.overscanRows) - row0)
+        dataCols = slice(self.leadinCols, min(ampCols, self.ampCols - self.overscanCols))
+        if signal and dataRows > 0:
+            noise[:dataRows, :, dataCols] += signal
+
+        np.clip(noise, 0, 65535, out=noise)
+        band[...] = noise
+
+    def simReadout(self, imtype, expTime=0.0, darkTime=None,
+                   nrows=None, ncols=None, rowFunc=None, bandRows=50):
+        """Generate one frame, at the real pixel rate.
+
+        Args
+        ----
+        imtype : `str`
+          bias, dark, flat, etc.
+        expTime, darkTime : `float`
+          Exposure and dark times.
+        nrows : `int`
+          How many rows to read. All by default.
+        ncols : `int`
+          How many columns to read per amp. All by default.
+        rowFunc : callable
+          Called as rowFunc(row, image) after each row is read.
+        bandRows : `int`
+          How many rows to generate at once.
+
+        Returns
+        -------
+        image : `numpy.ndarray`
+          The uint16 image, in the same layout as a real readout.
+        """
+
+        if nrows is None:
+            nrows = self.nrows
+        if ncols is None:
+            ncols = self.ampCols
+        if darkTime is None:
+            darkTime = expTime
+
+        if nrows == self.nrows and ncols == self.ampCols:
+            image = self.framePool.acquire()
+        else:
+            image = np.zeros((nrows, self.namps*ncols), dtype='u2')
+
+        signal = self._ampLevels(imtype, darkTime)
+        rowTime = ncols * self.pixelTime
+        t0 = time.monotonic()
+        for row0 in range(0, nrows, bandRows):
+            row1 = min(row0 + bandRows, nrows)
+            self._fillRows(image, row0, row1, ncols, signal)
+            for row in range(row0, row1):
+                dt = t0 + (row+1)*rowTime - time.monotonic()
+                if dt > 0:
+                    time.sleep(dt)
+                if rowFunc is not None:
+                    rowFunc(row, image)
+
+        return image
+
+    def stop(self, cmd=None):
+        pass
+
+    def start(self, cmd=None):
+        pass
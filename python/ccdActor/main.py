@@ -2,15 +2,27 @@
 
 import argparse
 import logging
+import os
 
 import actorcore.ICC
 import pfs.utils.butler as pfsButler
 
+from ccdActor.utils import ampLimits
+from ccdActor.utils import compression
+from ccdActor.utils import fitsWriter
+from ccdActor.utils import qaHistory
+from ccdActor.utils import qaPool
+from ccdActor.utils import spool
+from ccdActor.utils import tileWriter
+from ccdActor.utils import timings
 from ics.utils.sps import spectroIds
 from twisted.internet import reactor
 
 
 class OurActor(actorcore.ICC.ICC):
+    # Simulated controllers are registered under the name of the real one.
+    controllerAliases = dict(simccd='ccd')
+
     def __init__(self, name=None, site=None,
                  productName=None,
                  logLevel=30):
@@ -46,8 +58,105 @@ class OurActor(actorcore.ICC.ICC):
         self.statusLoopCB = self.statusLoop
 
         self.exposure = None
+        self.benchingFee = False
         self.grating = 'real'
 
+        writerConfig = self.actorConfig.get('fitsWriter', dict())
+        self.tileWriter = None
+        if writerConfig.get('parallel', True):
+            self.tileWriter = tileWriter.TileWriter(nThreads=writerConfig.get('tileThreads', None),
+                                                    bandRows=writerConfig.get('tileBandRows', 128))
+            reactor.addSystemEventTrigger('after', 'shutdown', self.tileWriter.stop)
+        self.fitsWriter = fitsWriter.FitsWriter(queueDepth=writerConfig.get('queueDepth', 2),
+                                                doAsync=writerConfig.get('async', True))
+        self.fitsWriter.start()
+        reactor.addSystemEventTrigger('before', 'shutdown', self.fitsWriter.stop)
+
+        self.checksumVerifier = None
+        if writerConfig.get('verify', False):
+            self.checksumVerifier = fitsWriter.ChecksumVerifier()
+            self.checksumVerifier.start()
+            reactor.addSystemEventTrigger('after', 'shutdown', self.checksumVerifier.stop)
+
+        spoolConfig = self.actorConfig.get('spool', dict())
+        self.fileMover = None
+        if spoolConfig.get('dir', None) is not None:
+            self.fileMover = spool.FileMover(os.path.expanduser(spoolConfig['dir']),
+                                             minBackoff=spoolConfig.get('minBackoff', 2.0),
+                                             maxBackoff=spoolConfig.get('maxBackoff', 300.0),
+                                             onMoved=self.fileMoved,
+                                             onDepth=self.reportSpoolDepth)
+            self.fileMover.start()
+            reactor.addSystemEventTrigger('after', 'shutdown', self.fileMover.stop)
+
+        self.timingHistory = timings.TimingHistory()
+
+        qaConfig = self.actorConfig.get('qa', dict())
+        self.qaPool = qaPool.QaPool(nWorkers=qaConfig.get('nWorkers', 2),
+                                    queueDepth=qaConfig.get('queueDepth', 4),
+                                    timeout=qaConfig.get('timeout', 30.0))
+        reactor.addSystemEventTrigger('before', 'shutdown', self.qaPool.stop)
+
+        self.qaHistory = qaHistory.QaHistory(maxVisits=qaConfig.get('historyVisits', 2000),
+                                             path=os.path.expanduser(qaConfig.get('historyPath',
+                                                                                  f'~/ccdActor/{name}_qaHistory.npz')),
+                                             saveEvery=qaConfig.get('historySaveEvery', 50),
+                                             minSigma=qaConfig.get('historyMinSigma', None))
+        try:
+            self.qaHistory.load()
+        except Exception as e:
+            self.logger.warning('could not load QA history, starting a new one: %s', e)
+        reactor.addSystemEventTrigger('before', 'shutdown', self.qaHistory.save)
+
+        self.ampLimits = None
+        self.loadAmpLimits()
+        self.compressionPolicy = compression.CompressionPolicy()
+        self.loadCompressionPolicy()
+        self.lastFilepath = None
+
+    def verifyFile(self, filepath):
+        """Queue a file for an independent checksum check, if we are configured to.
+
+        Whoever wrote it has usually finished by the time the check has,
+        so failures are broadcast.
+        """
+
+        if self.checksumVerifier is None:
+            return
+
+        def report(filepath, problems, duration):
+            if problems:
+                self.bcast.warn('text="checksum verification of %s failed: %s"' %
+                                (filepath, '; '.join(problems)))
+
+        self.checksumVerifier.submit(filepath, report)
+
+    def fileMoved(self, spoolPath, finalPath, info):
+        """Called by the FileMover once a spooled file is at its final path.
+
+        Only now can the filepath keywords be generated: whatever acts on
+        them expects the file to be there. The command which wrote the file
+        has usually finished, so they are broadcast.
+        """
+
+        import Commands.exposure as exposure
+
+        if str(self.lastFilepath) == str(spoolPath):
+            self.lastFilepath = finalPath
+        if 'visit' in info:
+            exposure.reportFile(finalPath, info['visit'], self.bcast)
+        else:
+            self.bcast.warn('text="moved %s to %s, but do not know its visit"' % (spoolPath, finalPath))
+        self.verifyFile(finalPath)
+
+    def reportSpoolDepth(self, depth, cmd=None):
+        """Generate the spoolDepth keyword: files waiting to be moved, their MB, and how many are failing. """
+
+        if cmd is None:
+            cmd = self.bcast
+        nFiles, nBytes, nFailing = depth
+        cmd.inform('spoolDepth=%d,%0.1f,%d' % (nFiles, nBytes/1e6, nFailing))
+
     @property
     def fee(self):
         return self.controllers['fee']
@@ -90,9 +199,53 @@ class OurActor(actorcore.ICC.ICC):
             self.attachAllControllers()
             self.everConnected = True
 
+    def attachAllControllers(self):
+        """Attach all starting controllers, putting simulators in place of the real ones. """
+
+        for c in self.allControllers:
+            instanceName = self.controllerAliases.get(c, c)
+            try:
+                self.attachController(c, instanceName=instanceName)
+            except Exception as e:
+                self.logger.warning('failed to attach controller %s as %s: %s', c, instanceName, e)
+                self.bcast.warn('text="failed to attach controller %s: %s"' % (c, e))
+
     def reloadConfiguration(self, cmd):
         """ optional user hook, called from Actor._reloadConfiguration"""
-        pass
+        self.loadAmpLimits(cmd)
+        self.loadCompressionPolicy(cmd)
+
+    def loadAmpLimits(self, cmd=None):
+        """Compile actorConfig['amplifiers'] into the QA limit table.
+
+        If the configuration is not valid, complain and keep any previous table.
+        """
+
+        try:
+            self.ampLimits = ampLimits.AmpLimits(self.actorConfig['amplifiers'])
+        except Exception as e:
+            self.logger.warning('failed to load amplifier limits: %s', e)
+            if cmd is not None:
+                cmd.warn(f'text="failed to load amplifier limits, keeping the old ones: {e}"')
+            return
+
+        self.logger.info('loaded %s', self.ampLimits)
+
+    def loadCompressionPolicy(self, cmd=None):
+        """Load the per-imtype image compression from actorConfig['compression'].
+
+        If the configuration is not valid, complain and keep any previous policy.
+        """
+
+        try:
+            self.compressionPolicy = compression.CompressionPolicy(self.actorConfig.get('compression', None))
+        except Exception as e:
+            self.logger.warning('failed to load compression policy: %s', e)
+            if cmd is not None:
+                cmd.warn(f'text="failed to load compression policy, keeping the old one: {e}"')
+            return
+
+        self.logger.info('loaded %s', self.compressionPolicy)
 
     def statusLoop(self, controller):
         try:
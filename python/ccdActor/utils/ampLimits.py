@@ -0,0 +1,87 @@
+import numpy as np
+
+
+class AmpLimits(object):
+    """Per-amp QA limits, compiled from actorConfig['amplifiers'] into arrays.
+
+    Every metric has a (low, high) limit per amp, and a value passes if
+    low < value < high. `check()` compares all metrics for all amps at
+    once and returns one bitmask per amp: bit 2*i is set if metric i is
+    too low, bit 2*i+1 if it is too high. NaNs fail both.
+
+    Args
+    ----
+    ampsConfig : `dict`
+      Per-amp config dicts, keyed by amp id, in readout order.
+    metrics : `dict`
+      The metric names, mapped to the config key of their limits. New
+      per-amp checks only need an entry here.
+    """
+
+    metrics = dict(level='serialOverscanLevelLim',
+                   noise='serialOverscanNoiseLim')
+
+    def __init__(self, ampsConfig, metrics=None):
+        if metrics is not None:
+            self.metrics = dict(metrics)
+        self.names = list(self.metrics.keys())
+        self.ampIds = list(ampsConfig.keys())
+
+        limits = np.empty((len(self.names), len(self.ampIds), 2), dtype='f8')
+        for amp_i, (ampId, ampConfig) in enumerate(ampsConfig.items()):
+            for m_i, (name, configKey) in enumerate(self.metrics.items()):
+                try:
+                    lo, hi = ampConfig[configKey]
+                    limits[m_i, amp_i] = float(lo), float(hi)
+                except Exception as e:
+                    raise ValueError(f'amp {ampId}: invalid or missing {configKey}: {e}')
+                if not lo < hi:
+                    raise ValueError(f'amp {ampId}: {configKey} low limit {lo} is not below {hi}')
+
+        self.lo = limits[:, :, 0]
+        self.hi = limits[:, :, 1]
+        self.lowBits = (1 << (2 * np.arange(len(self.names))))[:, None]
+        self.highBits = self.lowBits << 1
+
+    def __str__(self):
+        return f'AmpLimits(amps={self.ampIds}, metrics={self.names})'
+
+    @property
+    def namps(self):
+        return len(self.ampIds)
+
+    def values(self, stats):
+        """Return the (metrics, amps) array of our metrics from a recarray or dict. """
+
+        return np.array([stats[name] for name in self.names], dtype='f8')
+
+    def check(self, stats):
+        """Compare per-amp metrics with their limits.
+
+        Args
+        ----
+        stats : `numpy.recarray` or `dict`
+          At least our metrics, each with one value per amp.
+
+        Returns
+        -------
+        mask : `numpy.ndarray`
+          One integer per amp, with the bits described above. 0 if all
+          is well.
+        """
+
+        values = self.values(stats)
+        tooLow = ~(values > self.lo)
+        tooHigh = ~(values < self.hi)
+        return (tooLow * self.lowBits + tooHigh * self.highBits).sum(axis=0)
+
+    def describe(self, mask):
+        """Return the failed checks in a mask as a list of (metric, 'low'|'high'). """
+
+        failed = []
+        for m_i, name in enumerate(self.names):
+            if mask & (1 << 2*m_i):
+                failed.append((name, 'low'))
+            if mask & (1 << (2*m_i + 1)):
+                failed.append((name, 'high'))
+        return failed
@@ -1,6 +1,10 @@
 import fpga.geom as geom
 import numpy as np
-import pandas as pd
+
+import ccdActor.utils.ampLimits as ampLimits
+
+# Where splitImage() puts the serial overscans, by image shape.
+_overscanGeometries = dict()
 
 
 def robustRms(array):
@@ -22,25 +26,220 @@ def robustRms(array):
     return 0.741 * (uq - lq)
 
 
-def serialOverscanStats(image, readRows=(0, 4300)):
-    """Calculate serial overscan levels and noise for all amplifiers.
+def ampHistograms(stack, nbins=65536):
+    """Histogram uint16 pixels per amp, in one bincount pass.
 
     Parameters
     ----------
-    image : `numpy.ndarray`
-        Raw CCD Image
+    stack : `numpy.ndarray`
+        uint16 pixels, shaped (rows, amps, cols).
+
+    Returns
+    -------
+    hist : `numpy.ndarray`
+        (amps, nbins) pixel counts.
+    """
+    namps = stack.shape[1]
+    ampOffsets = (np.arange(namps, dtype='i4') * nbins)[None, :, None]
+    idx = stack.astype('i4')
+    idx += ampOffsets
+    hist = np.bincount(idx.ravel(), minlength=namps*nbins)
+    return hist.reshape(namps, nbins)
+
+
+def _histQuantiles(cdf, n, q):
+    """Return quantiles, interpolated as by np.percentile, from per-amp cumulative histograms. """
+
+    pos = q * (n - 1)
+    lo = np.floor(pos).astype('i8')
+    frac = pos - lo
+    vlo = (cdf <= lo[:, None]).sum(axis=1)
+    vhi = (cdf <= np.minimum(lo + 1, n - 1)[:, None]).sum(axis=1)
+    return vlo + frac * (vhi - vlo)
+
+
+def histogramStats(hist, saturation=65535):
+    """Calculate pixel statistics from per-amp histograms.
+
+    Parameters
+    ----------
+    hist : `numpy.ndarray`
+        (amps, nbins) pixel counts, as from `ampHistograms`.
+    saturation : `int`
+        Pixels at or above this are counted as saturated.
+
+    Returns
+    -------
+    stats : `numpy.recarray`
+        Per amp: npix, average, stddev, median, robust rms (from the IQR,
+        as `robustRms`), minval, maxval and nsat. The field names avoid
+        those of ndarray methods, so that they work as attributes.
+    """
+    namps, nbins = hist.shape
+    values = np.arange(nbins, dtype='f8')
+
+    n = hist.sum(axis=1)
+    good = n > 0
+    nn = np.where(good, n, 1)
+
+    mean = hist.dot(values) / nn
+    var = (hist * np.square(values[None, :] - mean[:, None])).sum(axis=1) / nn
+
+    cdf = np.cumsum(hist, axis=1)
+    median = _histQuantiles(cdf, nn, 0.5)
+    lq = _histQuantiles(cdf, nn, 0.25)
+    uq = _histQuantiles(cdf, nn, 0.75)
+
+    nonzero = hist > 0
+    vmin = np.argmax(nonzero, axis=1)
+    vmax = nbins - 1 - np.argmax(nonzero[:, ::-1], axis=1)
+    nsat = hist[:, saturation:].sum(axis=1)
+
+    nan = np.where(good, 1.0, np.nan)
+    return np.rec.fromarrays([n, mean*nan, np.sqrt(var)*nan, median*nan, 0.741*(uq - lq)*nan,
+                              vmin, vmax, nsat],
+                             names='npix,average,stddev,median,rms,minval,maxval,nsat')
+
+
+def ampStats(stack, saturation=65535):
+    """Calculate per-amp pixel statistics in one pass.
+
+    Parameters
+    ----------
+    stack : `numpy.ndarray`
+        uint16 pixels, shaped (rows, amps, cols).
+    saturation : `int`
+        Pixels at or above this are counted as saturated.
 
     Returns
     -------
-    stats : `pd.DataFrame`
-        DataFrame with stats for each amplifier.
+    stats : `numpy.recarray`
+        See `histogramStats`.
     """
+    return histogramStats(ampHistograms(stack), saturation=saturation)
+
+
+def _splitOverscans(image):
+    """Return the per-amp serial overscan images, as split by `fpga.geom`. """
+
     exp = geom.Exposure()
     exp.image = image
     ampIms, osIms, _ = exp.splitImage()
+    return osIms
+
+
+def overscanGeometry(image):
+    """Find where the serial overscans sit in a raw image.
+
+    The geometry is taken from `fpga.geom.Exposure.splitImage`, and cached
+    by image shape.
+
+    Parameters
+    ----------
+    image : `numpy.ndarray`
+        Raw CCD Image
 
-    stats = [perAmpSerialOverScan(osIm[slice(*readRows)]) for osIm in osIms]
-    return pd.DataFrame(stats, columns=['level', 'noise'])
+    Returns
+    -------
+    geometry : `tuple` or `None`
+        (row0, nrows, col0, ampStep, ncols, namps): the overscan of amp i is
+        image[row0:row0+nrows, col0+i*ampStep:col0+i*ampStep+ncols].
+        None if the overscans are not equally spaced views of the image.
+    """
+    key = (image.shape, image.dtype.str)
+    try:
+        return _overscanGeometries[key]
+    except KeyError:
+        pass
+
+    osIms = _splitOverscans(image)
+    base = image.__array_interface__['data'][0]
+
+    corners = []
+    for osIm in osIms:
+        if osIm.strides != image.strides or not np.shares_memory(osIm, image):
+            corners = None
+            break
+        offset = osIm.__array_interface__['data'][0] - base
+        row0, colBytes = divmod(offset, image.strides[0])
+        corners.append((row0, colBytes // image.itemsize, osIm.shape))
+
+    geometry = None
+    if corners:
+        rows = {c[0] for c in corners}
+        shapes = {c[2] for c in corners}
+        col0s = np.array([c[1] for c in corners])
+        steps = set(np.diff(col0s))
+        if len(rows) == 1 and len(shapes) == 1 and len(steps) <= 1:
+            nrows, ncols = shapes.pop()
+            ampStep = int(steps.pop()) if steps else 0
+            geometry = (rows.pop(), nrows, int(col0s[0]), ampStep, ncols, len(corners))
+
+    _overscanGeometries[key] = geometry
+    return geometry
+
+
+def overscanStack(image):
+    """Return all the serial overscans as one (rows, amps, cols) view of the image.
+
+    Parameters
+    ----------
+    image : `numpy.ndarray`
+        Raw CCD Image
+
+    Returns
+    -------
+    stack : `numpy.ndarray`
+        A strided view: stack[:, i, :] is the serial overscan of amp i.
+        None if the overscans cannot be expressed as one view.
+    """
+    geometry = overscanGeometry(image)
+    if geometry is None:
+        return None
+
+    row0, nrows, col0, ampStep, ncols, namps = geometry
+    corner = image[row0:row0+nrows, col0:]
+    return np.lib.stride_tricks.as_strided(corner,
+                                           shape=(nrows, namps, ncols),
+                                           strides=(image.strides[0], ampStep*image.itemsize, image.itemsize),
+                                           writeable=False)
+
+
+def serialOverscanStats(image, readRows=(0, 4300), rowTrim=(0, 0), colTrim=(3, 3)):
+    """Calculate serial overscan levels and noise for all amplifiers.
+
+    All amps are processed at once, from a strided view of the overscan
+    columns.
+
+    Parameters
+    ----------
+    image : `numpy.ndarray`
+        Raw CCD Image
+
+    Returns
+    -------
+    stats : `numpy.recarray`
+        level and noise for each amplifier.
+    """
+    osStack = overscanStack(image)
+    if osStack is None:
+        stats = [perAmpSerialOverScan(osIm[slice(*readRows)], rowTrim=rowTrim, colTrim=colTrim)
+                 for osIm in _splitOverscans(image)]
+        level, noise = np.array(stats, dtype='f8').T
+        return np.rec.fromarrays([level, noise], names='level,noise')
+
+    osStack = osStack[slice(*readRows)]
+    rows = slice(rowTrim[0], osStack.shape[0] - rowTrim[1])
+    cols = slice(colTrim[0], osStack.shape[2] - colTrim[1])
+    trimmed = osStack[rows, :, cols]
+
+    if trimmed.dtype == np.uint16:
+        stats = ampStats(trimmed)
+        level, noise = stats.median, stats.stddev
+    else:
+        level = np.median(trimmed, axis=(0, 2))
+        noise = np.std(trimmed, axis=(0, 2))
+    return np.rec.fromarrays([level, noise], names='level,noise')
 
 
 def perAmpSerialOverScan(osIm, rowTrim=(0, 0), colTrim=(3, 3)):
@@ -63,43 +262,46 @@ def perAmpSerialOverScan(osIm, rowTrim=(0, 0), colTrim=(3, 3)):
 
     trimmed = osIm[rows, cols]
 
+    if trimmed.dtype == np.uint16:
+        stats = ampStats(trimmed[:, None, :])
+        return stats.median[0], stats.stddev[0]
+
     return np.median(trimmed), np.std(trimmed)
 
 
-def ensureOverscansAreInRange(overscan, ampsConfig):
+def ensureOverscansAreInRange(overscan, ampsConfig, mask=None):
     """Check that overscan level/noise are in range.
 
    Parameters
    ----------
-   overscan : `pd.DataFrame`
-       Serial Overscan data.
+   overscan : `numpy.recarray`
+       Serial overscan level and noise per amp.
 
-   ampsConfig : `dict`
-       Amplifiers configuration.
+   ampsConfig : `dict` or `ampLimits.AmpLimits`
+       Amplifiers configuration, preferably already compiled.
+
+   mask : `numpy.ndarray`
+       The per-amp result of `AmpLimits.check`, if it has already been run.
 
    Returns
    -------
    status : `str`
        Status of the overscans, OK or meaningful message otherwise.
    """
-    warnings = []
-
-    for level, rms, ampId, ampConfig in zip(overscan.level, overscan.noise, ampsConfig.keys(), ampsConfig.values()):
-        minLevel, maxLevel = ampConfig['serialOverscanLevelLim']
-        minRMS, maxRMS = ampConfig['serialOverscanNoiseLim']
-
-        if (not minLevel < level < maxLevel) or (not minRMS < rms < maxRMS):
-            warnings.append((ampId, int(level), round(rms, 1)))
+    if isinstance(ampsConfig, ampLimits.AmpLimits):
+        limits = ampsConfig
+    else:
+        limits = ampLimits.AmpLimits(ampsConfig)
+    if mask is None:
+        mask = limits.check(overscan)
 
-        # this would be too long let's keep it short for STS sake
-        #     warnings.append(f'amp{ampId} overscan level({level}) out of range({minLevel}:{maxLevel})')
-        # if not minRMS<noise<maxRMS:
-        #    warnings.append(f'amp{ampId} overscan noise({noise}) out of range({minRMS}:{maxRMS})')
+    if not mask.any():
+        return "OK"
 
-    if not warnings:
-        status = "OK"
-    else:
-        status = "overscan out of range ! " + \
-                 " ".join([f'amp{ampId}(level={level} RMS={rms})' for ampId, level, rms in warnings])
+    # this would be too long let's keep it short for STS sake
+    warnings = [(limits.ampIds[i], int(overscan.level[i]), round(overscan.noise[i], 1))
+                for i in np.where(mask)[0]]
+    status = "overscan out of range ! " + \
+             " ".join([f'amp{ampId}(level={level} RMS={rms})' for ampId, level, rms in warnings])
 
     return status
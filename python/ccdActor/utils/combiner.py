@@ -0,0 +1,311 @@
+import logging
+import os
+import pathlib
+import shutil
+import tempfile
+import threading
+
+import fitsio
+import numpy as np
+
+
+class FrameCombiner(object):
+    """Combine the frames of a bias or dark sequence as they are read out.
+
+    Keeps float32 running accumulators, updated one band of rows at a
+    time so that the temporaries stay small:
+
+     - mean and variance, with Welford's algorithm.
+     - the per-pixel minimum and maximum, for a clipped mean: at the end,
+       each pixel's lowest and highest values are dropped if they are
+       more than clipSigma from the mean of the others. Sigma is the
+       typical per-pixel noise of the surrounding rows, so the clipping
+       is not fooled by the outliers themselves. This rejects up to one
+       cosmic ray per pixel, which is what matters for biases and darks.
+     - optionally, the exact median. The frames are spooled to a uint16
+       memmap, which is reduced in tiles of rows at the end.
+
+    Args
+    ----
+    shape : (`int`, `int`)
+      The image shape. Frames of any other shape are ignored. By
+      default, the shape of the first frame.
+    nFrames : `int`
+      How many frames will be added. Only needed for the median.
+    clipSigma : `float`
+      The clipping threshold, in standard deviations.
+    doMedian : `bool`
+      Whether to calculate the median.
+    spoolDir : `str`
+      Where to put the median spool file, which holds every frame.
+    minFree : `float`
+      Bytes which must still be free on the spool disk once all the
+      frames are spooled.
+    tileRows : `int`
+      How many rows to process at a time.
+    """
+
+    def __init__(self, shape=None, nFrames=None, clipSigma=3.0, doMedian=False,
+                 spoolDir=None, minFree=1e9, tileRows=256):
+        self.logger = logging.getLogger('combiner')
+        self.lock = threading.Lock()
+        self.shape = None
+        self.nFrames = nFrames
+        self.clipSigma = clipSigma
+        self.doMedian = doMedian
+        self.spoolDir = spoolDir
+        self.minFree = minFree
+        self.tileRows = tileRows
+
+        if doMedian and nFrames is None:
+            raise ValueError('the median needs to know the number of frames')
+
+        self.n = 0
+        self.visits = []
+        self.filepaths = []
+        self.spool = None
+        self.spoolPath = None
+
+        if shape is not None:
+            self._allocate(shape)
+
+    def __str__(self):
+        return (f'FrameCombiner(n={self.n}/{self.nFrames}, shape={self.shape}, '
+                f'clipSigma={self.clipSigma}, median={self.doMedian})')
+
+    def checkSpool(self, shape):
+        """Raise OSError if the median spool for frames of this shape would not fit. """
+
+        if not self.doMedian:
+            return
+
+        spoolDir = self.spoolDir if self.spoolDir is not None else tempfile.gettempdir()
+        os.makedirs(spoolDir, exist_ok=True)
+        need = self.nFrames * int(np.prod(shape)) * 2
+        free = shutil.disk_usage(spoolDir).free
+        if free - need < self.minFree:
+            raise OSError(f'not enough space in {spoolDir} to spool {self.nFrames} frames for the median: '
+                          f'need {need/1e9:0.1f} GB and {self.minFree/1e9:0.1f} GB spare, '
+                          f'have {free/1e9:0.1f} GB')
+
+    def _allocate(self, shape):
+        self.checkSpool(shape)
+        self.shape = tuple(shape)
+        self.mean = np.zeros(shape, dtype='f4')
+        self.m2 = np.zeros(shape, dtype='f4')
+        self.minval = np.full(shape, 65535, dtype='u2')
+        self.maxval = np.zeros(shape, dtype='u2')
+
+        if self.doMedian:
+            fd, self.spoolPath = tempfile.mkstemp(prefix='combineSpool', suffix='.npy',
+                                                  dir=self.spoolDir)
+            os.close(fd)
+            self.spool = np.lib.format.open_memmap(self.spoolPath, mode='w+', dtype='u2',
+                                                   shape=(self.nFrames,) + self.shape)
+
+    def add(self, im, visit=None, filepath=None):
+        """Add one frame.
+
+        Args
+        ----
+        im : `numpy.ndarray`
+          The processed image. Not modified or kept.
+        visit : `int`
+          Its visit number.
+        filepath : `str` or `pathlib.Path`
+          Where it is being written. The combined file goes next to the first one.
+
+        Returns
+        -------
+        added : `bool`
+          False if the frame could not be used.
+        """
+
+        with self.lock:
+            if self.shape is None:
+                try:
+                    self._allocate(im.shape)
+                except OSError as e:
+                    self.logger.warning('cannot combine frames: %s', e)
+                    return False
+            if im.shape != self.shape:
+                self.logger.warning('not combining frame of shape %s into %s', im.shape, self)
+                return False
+            if self.spool is not None and self.n >= len(self.spool):
+                self.logger.warning('not combining extra frame into %s', self)
+                return False
+
+            self.n += 1
+            for r0 in range(0, self.shape[0], self.tileRows):
+                rows = slice(r0, min(r0 + self.tileRows, self.shape[0]))
+                self._addRows(im[rows], rows)
+
+            if self.spool is not None:
+                self.spool[self.n - 1] = im
+            self.visits.append(visit)
+            self.filepaths.append(filepath)
+
+        return True
+
+    def _addRows(self, rawRows, rows):
+        x = rawRows.astype('f4')
+        mean = self.mean[rows]
+        m2 = self.m2[rows]
+
+        delta = x - mean
+        mean += delta / self.n
+        m2 += delta * (x - mean)
+
+        np.minimum(self.minval[rows], rawRows, out=self.minval[rows])
+        np.maximum(self.maxval[rows], rawRows, out=self.maxval[rows])
+
+    def _clipRows(self, rows):
+        """Return the clipped mean, and the number of values dropped, for some rows. """
+
+        n = self.n
+        mean = self.mean[rows].astype('f8')
+        total = mean * n
+        lo = self.minval[rows].astype('f8')
+        hi = self.maxval[rows].astype('f8')
+
+        if n < 3:
+            return mean.astype('f4'), np.zeros(mean.shape, dtype='u1')
+
+        sigma = np.median(np.sqrt(self.m2[rows] / (n - 1)))
+        limit = self.clipSigma * sigma
+        dropHi = hi - (total - hi) / (n - 1) > limit
+        dropLo = (total - lo) / (n - 1) - lo > limit
+        if n < 4:
+            dropLo &= ~dropHi
+
+        total -= np.where(dropHi, hi, 0) + np.where(dropLo, lo, 0)
+        nDropped = dropHi.astype('u1') + dropLo
+        return (total / (n - nDropped)).astype('f4'), nDropped
+
+    def median(self):
+        """Return the per-pixel median of the spooled frames. """
+
+        if self.spool is None:
+            return None
+
+        spool = self.spool[:self.n]
+        median = np.empty(self.shape, dtype='f4')
+        for r0 in range(0, self.shape[0], self.tileRows):
+            rows = slice(r0, min(r0 + self.tileRows, self.shape[0]))
+            median[rows] = np.median(spool[:, rows], axis=0)
+        return median
+
+    def results(self):
+        """Return the combined images.
+
+        Returns
+        -------
+        images : `dict` of `numpy.ndarray`
+          float32 MEAN, VAR and CLIPPED images, and MEDIAN if asked for.
+        """
+
+        with self.lock:
+            clipped = np.empty(self.shape, dtype='f4')
+            self.nDropped = np.empty(self.shape, dtype='u1')
+            for r0 in range(0, self.shape[0], self.tileRows):
+                rows = slice(r0, min(r0 + self.tileRows, self.shape[0]))
+                clipped[rows], self.nDropped[rows] = self._clipRows(rows)
+
+            images = dict(MEAN=self.mean,
+                          VAR=self.m2 / max(self.n - 1, 1),
+                          CLIPPED=clipped)
+            median = self.median()
+            if median is not None:
+                images['MEDIAN'] = median
+        return images
+
+    def ampSummary(self, images, namps=8):
+        """Return per-amp statistics of the combined images.
+
+        Returns
+        -------
+        summary : `numpy.recarray`
+          One row per amp: the median of the mean and clipped images, the
+          median per-frame noise, and the fraction of values clipped.
+          Must follow `results()`.
+        """
+
+        rows, cols = self.shape
+        ampCols = cols // namps
+
+        def perAmp(im):
+            return im[:, :ampCols*namps].reshape(rows, namps, ampCols).transpose(1, 0, 2).reshape(namps, -1)
+
+        level = np.median(perAmp(images['MEAN']), axis=1)
+        clipped = np.median(perAmp(images['CLIPPED']), axis=1)
+        noise = np.median(np.sqrt(perAmp(images['VAR'])), axis=1)
+        rejected = perAmp(self.nDropped).mean(axis=1, dtype='f8') / max(self.n, 1)
+
+        return np.rec.fromarrays([np.arange(namps), level, clipped, noise, rejected],
+                                 names='amp,level,clipped,noise,rejected')
+
+    def combinedPath(self):
+        """Return the path of the combined file, next to the first raw file. """
+
+        first = pathlib.Path(self.filepaths[0])
+        return first.parent / f'{first.stem}_combined.fits'
+
+    def write(self, filepath=None, cards=None, compress='GZIP_2', qlevel=0):
+        """Write the combined images and the per-amp summary.
+
+        Args
+        ----
+        filepath : `str` or `pathlib.Path`
+          Where to write. By default, next to the first raw file.
+        cards : sequence of fitsio card dicts
+          Extra PHDU cards.
+        compress, qlevel : `str`, `float`
+          The fitsio compression for the images. The default is lossless:
+          these are calibration products, and must not be quantized.
+
+        Returns
+        -------
+        filepath : `pathlib.Path`
+          The file written.
+        summary : `numpy.recarray`
+          The per-amp summary.
+        """
+
+        if self.n == 0:
+            raise RuntimeError('no frames were combined')
+        if filepath is None:
+            filepath = self.combinedPath()
+
+        images = self.results()
+        summary = self.ampSummary(images)
+
+        phdrCards = [dict(name='NCOMBINE', value=self.n, comment='number of frames combined'),
+                     dict(name='CLIPSIG', value=self.clipSigma, comment='sigma clipping threshold'),
+                     dict(name='VISIT0', value=int(self.visits[0]), comment='first visit combined'),
+                     dict(name='VISITN', value=int(self.visits[-1]), comment='last visit combined')]
+        if cards is not None:
+            phdrCards.extend(cards)
+
+        tmpPath = f'{filepath}.tmp'
+        with fitsio.FITS(tmpPath, 'rw', clobber=True) as fitsFile:
+            fitsFile.write(None, header=fitsio.FITSHDR(phdrCards))
+            for name, im in images.items():
+                fitsFile.write(im, extname=name, compress=compress, qlevel=qlevel)
+            fitsFile.write(summary, extname='AMPSTATS')
+        os.replace(tmpPath, filepath)
+
+        return pathlib.Path(filepath), summary
+
+    def close(self):
+        """Release the median spool. """
+
+        if self.spool is not None:
+            del self.spool
+            self.spool = None
+        if self.spoolPath is not None:
+            try:
+                os.unlink(self.spoolPath)
+            except OSError:
+                pass
+            self.spoolPath = None
+
@@ -0,0 +1,143 @@
+import os
+import pathlib
+import time
+
+import fitsio
+import numpy as np
+
+import ccdActor.utils.fitsWriter as fitsWriter
+import ccdActor.utils.tileWriter as tileWriterMod
+
+# The image HDU compressions we know how to ask fitsio for.
+CODECS = ('RICE', 'GZIP', 'GZIP_2', 'HCOMPRESS', 'PLIO', 'none')
+
+# What to benchmark if we are not told.
+BENCH_SPECS = dict(RICE=dict(codec='RICE'),
+                   GZIP=dict(codec='GZIP'),
+                   GZIP_2=dict(codec='GZIP_2'),
+                   HCOMPRESS=dict(codec='HCOMPRESS'),
+                   none=dict(codec='none'))
+
+
+def compressionKwargs(spec):
+    """Turn one compression spec into fitsio write() arguments.
+
+    Args
+    ----
+    spec : `dict`
+      codec : one of `CODECS`
+      tileDims : (`int`, `int`), optional
+        Tile shape, in (rows, cols). fitsio tiles by row by default.
+      qlevel, qmethod : optional
+        Quantization, for float images.
+      hcompScale, hcompSmooth : optional
+        HCOMPRESS parameters.
+
+    Returns
+    -------
+    kwargs : `dict`
+    """
+
+    spec = dict(spec)
+    codec = spec.pop('codec', 'RICE')
+    if codec not in CODECS:
+        raise ValueError(f'unknown compression {codec}: must be one of {CODECS}')
+
+    kwargs = dict(compress=None if codec == 'none' else codec)
+    names = dict(tileDims='tile_dims', qlevel='qlevel', qmethod='qmethod',
+                 hcompScale='hcomp_scale', hcompSmooth='hcomp_smooth')
+    for name, value in spec.items():
+        if name not in names:
+            raise ValueError(f'unknown compression parameter {name}')
+        kwargs[names[name]] = list(value) if name == 'tileDims' else value
+
+    return kwargs
+
+
+class CompressionPolicy(object):
+    """The image HDU compression to use for each imtype.
+
+    Args
+    ----
+    config : `dict`
+      actorConfig['compression']: compression specs (see
+      `compressionKwargs`) keyed by imtype, with 'default' for the rest.
+      RICE with fitsio defaults if not set.
+    """
+
+    def __init__(self, config=None):
+        if config is None:
+            config = dict()
+        self.specs = dict(config)
+        self.specs.setdefault('default', dict(codec='RICE'))
+
+        # Fail now, not when writing a file.
+        self.kwargs = {imtype: compressionKwargs(spec) for imtype, spec in self.specs.items()}
+
+    def __str__(self):
+        return f'CompressionPolicy({self.specs})'
+
+    def forImtype(self, imtype):
+        """Return the fitsio write() arguments for an imtype. """
+
+        return self.kwargs.get(imtype, self.kwargs['default'])
+
+
+def benchmark(im, specs, directory, nRepeat=1, tileWriter=None):
+    """Time writing an image with various compressions.
+
+    Each file is written as the raw files are, with `fitsWriter.writeFits`:
+    by the tile writer if it can, otherwise by fitsio, and checksummed
+    and fsync-ed. It is then read back, and deleted.
+
+    Args
+    ----
+    im : `numpy.ndarray`
+      The image to write.
+    specs : `dict`
+      Compression specs, keyed by the name to report them under.
+    directory : `str` or `pathlib.Path`
+      Where to write the test files: the disk we care about.
+    nRepeat : `int`
+      How many times to write each file. The best time is kept.
+    tileWriter : `ccdActor.utils.tileWriter.TileWriter`
+      The actor's tile writer, if it has one.
+
+    Returns
+    -------
+    results : `list` of (name, writer, writeTime, MB/s, ratio, readTime)
+      writer is 'tile' or 'fitsio'. The write rate is in uncompressed MB
+      per second, and the ratio is uncompressed over file size.
+    """
+
+    # Images read back from FITS files are big-endian; the camera's are not.
+    im = np.ascontiguousarray(im, dtype=im.dtype.newbyteorder('='))
+
+    rawBytes = im.nbytes
+    results = []
+    for name, spec in specs.items():
+        kwargs = compressionKwargs(spec)
+        useTiles = tileWriter is not None and tileWriterMod.canWrite(im, kwargs)
+        path = pathlib.Path(directory) / f'.benchCompression_{os.getpid()}_{name}.fits'
+        try:
+            writeTimes = []
+            for i in range(nRepeat):
+                if path.exists():
+                    path.unlink()
+                t0 = time.monotonic()
+                fitsWriter.writeFits(path, im, [], [], compression=kwargs,
+                                     tileWriter=tileWriter if useTiles else None)
+                writeTimes.append(time.monotonic() - t0)
+            size = path.stat().st_size
+
+            t0 = time.monotonic()
+            fitsio.read(str(path), ext=1)
+            readTime = time.monotonic() - t0
+        finally:
+            if path.exists():
+                path.unlink()
+
+        writeTime = min(writeTimes)
+        results.append((name, 'tile' if useTiles else 'fitsio', writeTime, rawBytes / 1e6 / writeTime, rawBytes / size, readTime))
+
+    return results
@@ -0,0 +1,125 @@
+from twisted.internet import defer, reactor, threads
+from twisted.python import failure
+
+import ccdActor.utils.feeScheduler as feeScheduler
+
+
+class AsyncFee(object):
+    """Call the fee controller without blocking the reactor.
+
+    Each call is queued to the FEE scheduler and returns a Deferred,
+    which fires in the reactor thread with the result, or errbacks with
+    the exception. The fee controller's own methods remain the
+    synchronous interface, for the exposure and other threads.
+
+    Args
+    ----
+    fee : `ccdActor.Controllers.fee.fee`
+      The controller.
+    """
+
+    # The default priority of each method. Anything else is COMMAND.
+    priorities = dict(setMode=feeScheduler.EXPOSURE,
+                      getAllStatus=feeScheduler.MONITOR,
+                      getCommandStatus=feeScheduler.MONITOR,
+                      getStatusSets=feeScheduler.MONITOR,
+                      getTemps=feeScheduler.MONITOR)
+
+    def __init__(self, fee):
+        self.fee = fee
+
+    def __str__(self):
+        return f'AsyncFee({self.fee.scheduler})'
+
+    def call(self, methodName, *args, priority=None, **kwargs):
+        """Call a fee controller method on the scheduler thread.
+
+        Args
+        ----
+        methodName : `str`
+          The name of the method, e.g. 'calibrate'.
+        priority : `int`
+          The scheduler priority. By default, from `priorities`.
+
+        Returns
+        -------
+        d : `twisted.internet.defer.Deferred`
+        """
+
+        method = getattr(self.fee, methodName)
+        if priority is None:
+            priority = self.priorities.get(methodName, feeScheduler.COMMAND)
+
+        scheduler = self.fee.scheduler
+        if scheduler.thread is None:
+            return threads.deferToThread(method, *args, **kwargs)
+
+        d = defer.Deferred()
+
+        def fire(req):
+            if req.error is not None:
+                reactor.callFromThread(d.errback, failure.Failure(req.error))
+            else:
+                reactor.callFromThread(d.callback, req.result)
+
+        key = None
+        if priority == feeScheduler.MONITOR:
+            key = f'{methodName}{args}{sorted(kwargs.items())}'
+        scheduler.submit(priority, method, *args, key=key, callback=fire, **kwargs)
+        return d
+
+    # The status reads are answered here, in the reactor thread, from
+    # whatever is fresh in the status cache. Only the stale sets are
+    # fetched by a scheduler request, which an exposure might hold up or drop.
+
+    def _cached(self, csets, fresh=False):
+        """Return the fresh cached keys of some command sets, and the names of the other sets. """
+
+        values = dict()
+        stale = []
+        for cset in csets:
+            cached = None if fresh else self.fee.statusCache.lookup(cset)
+            if cached is None:
+                stale.append(cset)
+            else:
+                values.update(cached[0])
+        return values, stale
+
+    def getStatusSets(self, csets, fresh=False, separately=False):
+        values, stale = self._cached(csets, fresh=fresh)
+        if not stale:
+            return defer.succeed(values)
+
+        def merge(fetched):
+            values.update(fetched)
+            return values
+
+        d = self.call('getStatusSets', stale, fresh=fresh, separately=separately)
+        d.addCallback(merge)
+        return d
+
+    def getAllStatus(self, fresh=False):
+        if not self.fee.allCategories:
+            return self.call('getAllStatus', fresh=fresh)
+        return self.getStatusSets(self.fee.allCategories, fresh=fresh, separately=True)
+
+    def getCommandStatus(self, cset, fresh=False):
+        return self.getStatusSets([cset], fresh=fresh)
+
+    def getTemps(self, fresh=False):
+        cached = None if fresh else self.fee.statusCache.lookup('getTemps', category='temps')
+        if cached is not None:
+            return defer.succeed(dict(cached[0]))
+        return self.call('getTemps', fresh=fresh)
+
+    def sendCommandStr(self, cmdStr, **kwargs):
+        return self.call('sendCommandStr', cmdStr, **kwargs)
+
+    def setMode(self, mode):
+        return self.call('setMode', mode)
+
+    def calibrate(self):
+        return self.call('calibrate')
+
+    def sendImage(self, path, **kwargs):
+        return self.call('sendImage', path, **kwargs)
@@ -0,0 +1,211 @@
+import logging
+import threading
+
+
+class FeeReplyError(RuntimeError):
+    """One command in a batch got no usable reply. """
+    pass
+
+
+class _Captured(Exception):
+    """Raised by `CaptureDevice` when the command has been written. """
+    pass
+
+
+class CaptureDevice(object):
+    """A stand-in serial device which records what is written, and stops at the first read.
+
+    Running feeControl's sendCommandStr against this gives the exact bytes
+    it sends for a command, without sending them.
+    """
+
+    in_waiting = 0
+
+    def __init__(self, device):
+        self.device = device
+        self.written = b''
+
+    def __getattr__(self, name):
+        return getattr(self.device, name)
+
+    def write(self, data):
+        self.written += bytes(data)
+        return len(data)
+
+    def _read(self, *args, **kwargs):
+        raise _Captured()
+
+    read = read_until = readline = read_all = _read
+
+    def _nothing(self, *args, **kwargs):
+        pass
+
+    flush = reset_input_buffer = reset_output_buffer = flushInput = flushOutput = _nothing
+
+
+class AheadDevice(object):
+    """The real serial device, for a command whose bytes have already been sent.
+
+    What feeControl writes is checked against what was sent and dropped;
+    writing it sends more commands ahead instead. Until then, the replies
+    to earlier commands are hidden, so that feeControl cannot discard them.
+    """
+
+    def __init__(self, device, expected, sendAhead):
+        self.device = device
+        self.expected = expected
+        self.sendAhead = sendAhead
+        self.written = b''
+
+    def __getattr__(self, name):
+        return getattr(self.device, name)
+
+    @property
+    def in_waiting(self):
+        return self.device.in_waiting if self.written else 0
+
+    def write(self, data):
+        self.written += bytes(data)
+        if not self.expected.startswith(self.written):
+            raise FeeReplyError(f'wrote {self.written!r}, but {self.expected!r} was sent ahead')
+        if self.written == self.expected:
+            self.sendAhead()
+        return len(data)
+
+    def _nothing(self, *args, **kwargs):
+        pass
+
+    reset_input_buffer = flushInput = _nothing
+
+
+def captureFrame(exchange, device, request):
+    """Return the bytes exchange() writes for one request, or None if they cannot be told. """
+
+    capture = CaptureDevice(device)
+    try:
+        exchange(request, capture)
+    except _Captured:
+        return capture.written or None
+    except Exception:
+        return None
+    return None
+
+
+def pipelined(exchange, device, requests, depth=4):
+    """Send FEE commands back to back, reading the replies in order.
+
+    The framing and parsing are all feeControl's: exchange(request,
+    device) must run feeControl's own command/reply exchange for one
+    request on the given device. Each command's bytes are first captured
+    with a `CaptureDevice`, then up to depth commands are sent ahead, and
+    the exchanges are run in order on `AheadDevice`s, which only read.
+    So each reply is exactly what the unbatched exchange would return.
+
+    Once an exchange fails, we can no longer tell which reply belongs to
+    which command, so nothing more is sent: it is returned as a
+    `FeeReplyError`, and the rest as None, for the caller to drain the
+    line and send one at a time. A command which gets no reply at all is
+    only noticed if exchange checks that each reply is for its own command;
+    an unbatched exchange would simply time out.
+
+    Args
+    ----
+    exchange : callable
+      exchange(request, device) returns the parsed reply to request.
+    device : `serial.Serial`
+      The real device.
+    requests : sequence
+      The requests, as exchange takes them.
+    depth : `int`
+      How many commands may be outstanding.
+
+    Returns
+    -------
+    replies : `list`
+      One reply, `FeeReplyError` or None per command.
+    """
+
+    replies = [None] * len(requests)
+    frames = [captureFrame(exchange, device, r) for r in requests]
+    if any(f is None for f in frames):
+        return replies
+
+    nSent = 0
+
+    def sendAhead(upTo):
+        nonlocal nSent
+        while nSent < min(upTo, len(frames)):
+            device.write(frames[nSent])
+            nSent += 1
+
+    sendAhead(depth)
+    for i, request in enumerate(requests):
+        ahead = AheadDevice(device, frames[i], lambda i=i: sendAhead(i + 1 + depth))
+        try:
+            replies[i] = exchange(request, ahead)
+        except Exception as e:
+            replies[i] = FeeReplyError(f'{request}: {e}')
+            return replies
+
+    return replies
+
+
+class CommandReplay(object):
+    """Record the FEE commands a call makes, and answer them from prefetched replies.
+
+    feeControl knows which commands make up each status set and how to
+    parse their replies; we do not. So the first time a status set is
+    read, the commands are recorded as they are sent, as (cmdStr, args,
+    kwargs) requests to sendCommandStr. Later reads send the recorded
+    requests in one batch, then let feeControl run as usual, answering
+    its sendCommandStr calls with the batch's sendCommandStr results.
+    Requests which do not match, or whose replies failed, go to the FEE
+    as normal.
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger('feeBatch')
+        self.lock = threading.Lock()
+        self.transcripts = dict()
+        self.recording = None
+        self.replies = []
+
+    def transcript(self, name):
+        return self.transcripts.get(name, None)
+
+    def start(self, requests=(), replies=()):
+        """Start recording, with the given prefetched replies to answer from. """
+
+        self.recording = []
+        self.replies = list(zip(requests, replies))
+
+    def finish(self, name):
+        """Stop recording, and keep the transcript for next time. """
+
+        if self.recording:
+            self.transcripts[name] = tuple(self.recording)
+        self.recording = None
+        self.replies = []
+
+    def abort(self):
+        self.recording = None
+        self.replies = []
+
+    def answer(self, request):
+        """Return (True, the prefetched reply) to the next request, or (False, None) if it must really be sent. """
+
+        if self.recording is None:
+            return False, None
+        self.recording.append(request)
+
+        if not self.replies:
+            return False, None
+        expected, reply = self.replies.pop(0)
+        if expected != request:
+            self.logger.info('FEE sent %s where %s was batched: dropping the rest of the batch',
+                             request, expected)
+            self.replies = []
+            return False, None
+        if reply is None or isinstance(reply, Exception):
+            return False, None
+        return True, reply
@@ -0,0 +1,401 @@
+#!/usr/bin/env python
+
+"""Benchmark FEE serial latency, per command category.
+
+Times each FEE status set (revision, serial, voltage, bias, temps,
+offset) and the mode transitions an exposure makes, through the same
+calls the actor uses, and reports latency percentiles, error and retry
+counts, and serial bytes per second. Results can be saved as JSON, with
+the FEE revision, so that firmware and host-side changes can be compared.
+
+Run from the actor with `fee bench`, or offline against a FEE port or
+an in-process emulator replaying a `fee record` transcript:
+
+  feeBench.py --port /dev/ttyS1 --cnt 50 --output fee-v1.2.json
+  feeBench.py --sim fee-v1.2-transcript.json --cnt 20
+  feeBench.py --compare fee-v1.1.json fee-v1.2.json
+"""
+
+import argparse
+import contextlib
+import json
+import logging
+import socket
+import time
+
+import numpy as np
+
+from ccdActor.utils import feeScheduler
+
+STATUS_CATEGORIES = ('revision', 'serial', 'voltage', 'bias', 'temps', 'offset')
+
+# The mode changes an exposure makes, in order.
+MODE_TRANSITIONS = (('idle', 'wipe'),
+                    ('wipe', 'expose'),
+                    ('expose', 'read'),
+                    ('read', 'idle'))
+
+CATEGORIES = STATUS_CATEGORIES + ('setMode',)
+
+
+class BenchStopped(RuntimeError):
+    """The benchmark was stopped because something else needed the FEE. """
+    pass
+
+
+class _CountingDevice(object):
+    """Wrap a serial device, counting the bytes written and read while counting is set. """
+
+    def __init__(self, device):
+        self.device = device
+        self.nBytes = 0
+        self.counting = False
+
+    def __getattr__(self, name):
+        return getattr(self.device, name)
+
+    def write(self, data):
+        if self.counting:
+            self.nBytes += len(data)
+        return self.device.write(data)
+
+    def _counted(self, data):
+        if self.counting:
+            self.nBytes += len(data)
+        return data
+
+    def read(self, *args, **kwargs):
+        return self._counted(self.device.read(*args, **kwargs))
+
+    def read_until(self, *args, **kwargs):
+        return self._counted(self.device.read_until(*args, **kwargs))
+
+    def readline(self, *args, **kwargs):
+        return self._counted(self.device.readline(*args, **kwargs))
+
+
+def _exclusive(fee, func):
+    """Run func() with the FEE serial line to ourselves, and return its result.
+
+    For the actor's fee controller, that is on its scheduler thread at
+    COMMAND priority, under its ioLock. A plain FeeControl is only ours.
+    """
+
+    lock = getattr(fee, 'ioLock', None) or contextlib.nullcontext()
+
+    def locked():
+        with lock:
+            return func()
+
+    scheduler = getattr(fee, 'scheduler', None)
+    if scheduler is None:
+        return locked()
+    return scheduler.call(feeScheduler.COMMAND, locked)
+
+
+def _countedCall(fee, counter, func):
+    """Return a call which runs func exclusively, counting only its own serial bytes. """
+
+    def counted():
+        counter.counting = True
+        try:
+            return func()
+        finally:
+            counter.counting = False
+
+    return lambda: _exclusive(fee, counted)
+
+
+def _installCounter(fee):
+    """Wrap the FEE serial device with a `_CountingDevice`, and return it. """
+
+    def install():
+        if getattr(fee, 'recorder', None) is not None:
+            raise RuntimeError('cannot benchmark the FEE while its traffic is being recorded')
+        device = getattr(fee, 'device', None)
+        if device is None:
+            return None
+        fee.device = fee.benchCounter = _CountingDevice(device)
+        return fee.device
+
+    return _exclusive(fee, install)
+
+
+def _removeCounter(fee, counter):
+    def remove():
+        if fee.device is not counter:
+            raise RuntimeError('the FEE serial device was replaced during the benchmark')
+        fee.device = counter.device
+        fee.benchCounter = None
+
+    _exclusive(fee, remove)
+
+
+def percentiles(times):
+    """Return n, p50, p95, p99 and max of some times, in seconds. """
+
+    if len(times) == 0:
+        return dict(n=0, p50=np.nan, p95=np.nan, p99=np.nan, max=np.nan)
+
+    p50, p95, p99 = np.percentile(times, [50, 95, 99])
+    return dict(n=len(times), p50=float(p50), p95=float(p95), p99=float(p99),
+                max=float(np.max(times)))
+
+
+def _statusCall(fee, cset):
+    """Return a call which reads one status set from the FEE, never from a cache. """
+
+    if hasattr(fee, 'statusCache'):
+        return lambda: fee.getCommandStatus(cset, fresh=True)
+    return lambda: fee.getCommandStatus(cset)
+
+
+def timeCall(func, nRepeat, retries=1, setup=None, stopCheck=None):
+    """Time a FEE call repeatedly.
+
+    Args
+    ----
+    func : callable
+      The call to time.
+    nRepeat : `int`
+      How many times to call it.
+    retries : `int`
+      How many times to retry a failed call. The time of a call which
+      succeeded after retries includes the failed attempts.
+    setup : callable
+      Called, untimed, before each repeat.
+    stopCheck : callable
+      Called before each repeat. If it returns a reason, `BenchStopped`
+      is raised.
+
+    Returns
+    -------
+    times : `list` of `float`
+      The seconds taken by each successful call.
+    nErrors : `int`
+      How many calls failed on every attempt.
+    nRetries : `int`
+      How many attempts were retries.
+    lastError : `Exception`
+      The last error seen, or None.
+    """
+
+    times = []
+    nErrors = 0
+    nRetries = 0
+    lastError = None
+    for i in range(nRepeat):
+        reason = stopCheck() if stopCheck is not None else None
+        if reason is not None:
+            raise BenchStopped(reason)
+        if setup is not None:
+            setup()
+        t0 = time.monotonic()
+        for attempt in range(retries + 1):
+            if attempt > 0:
+                nRetries += 1
+            try:
+                func()
+            except Exception as e:
+                lastError = e
+                continue
+            times.append(time.monotonic() - t0)
+            break
+        else:
+            nErrors += 1
+
+    return times, nErrors, nRetries, lastError
+
+
+def benchmark(fee, categories=CATEGORIES, nRepeat=10, retries=1, report=None, stopCheck=None):
+    """Time FEE calls, by category.
+
+    Status sets are always read from the FEE, not from the status cache.
+    The 'setMode' category times each of `MODE_TRANSITIONS` separately,
+    setting the starting mode untimed first, and leaves the FEE idle.
+
+    Each call has the FEE to itself, so the byte rates are only of the
+    benchmark's own traffic. Something else can still use the FEE
+    between calls: if stopCheck says so, the benchmark stops and does
+    not touch the FEE mode again.
+
+    Args
+    ----
+    fee : `feeControl.FeeControl`
+      The FEE, usually the actor's fee controller.
+    categories : sequence of `str`
+      Which of `CATEGORIES` to time.
+    nRepeat : `int`
+      How many times to time each category.
+    retries : `int`
+      How many times to retry each failed call.
+    report : callable
+      If set, called with each category's result as soon as it is done.
+    stopCheck : callable
+      Called before each call. If it returns a reason, `BenchStopped` is raised.
+
+    Returns
+    -------
+    results : `list` of `dict`
+      Per category or transition: name, n, p50, p95, p99, max (seconds),
+      nErrors, nRetries, bytesPerSec, and times, all the call times.
+    """
+
+    for category in categories:
+        if category not in CATEGORIES:
+            raise ValueError(f'unknown FEE benchmark category {category}; '
+                             f'known: {",".join(CATEGORIES)}')
+
+    tests = []
+    for category in categories:
+        if category == 'setMode':
+            for fromMode, toMode in MODE_TRANSITIONS:
+                tests.append((f'setMode.{fromMode}.{toMode}',
+                              lambda toMode=toMode: fee.setMode(toMode),
+                              lambda fromMode=fromMode: fee.setMode(fromMode)))
+        else:
+            tests.append((category, _statusCall(fee, category), None))
+
+    counter = _installCounter(fee)
+    stopped = False
+    results = []
+    try:
+        for name, func, setup in tests:
+            if counter is not None:
+                func = _countedCall(fee, counter, func)
+            nBytes0 = counter.nBytes if counter is not None else 0
+            t0 = time.monotonic()
+            try:
+                times, nErrors, nRetries, lastError = timeCall(func, nRepeat, retries=retries, setup=setup,
+                                                               stopCheck=stopCheck)
+            except BenchStopped:
+                stopped = True
+                raise
+            elapsed = time.monotonic() - t0
+            nBytes = counter.nBytes - nBytes0 if counter is not None else 0
+
+            result = dict(name=name)
+            result.update(percentiles(times))
+            result.update(nErrors=nErrors, nRetries=nRetries,
+                          bytesPerSec=nBytes / elapsed if counter is not None and elapsed > 0 else np.nan,
+                          lastError=None if lastError is None else str(lastError),
+                          times=times)
+            results.append(result)
+            if report is not None:
+                report(result)
+    finally:
+        if counter is not None:
+            _removeCounter(fee, counter)
+        if 'setMode' in categories and not stopped:
+            fee.setMode('idle')
+
+    return results
+
+
+def describe(fee):
+    """Return what we know about the FEE under test, for the saved results. """
+
+    info = dict(host=socket.gethostname(),
+                date=time.strftime('%Y-%m-%dT%H:%M:%S'))
+    try:
+        info['revision'] = fee.getCommandStatus('revision')['revision.FEE']
+        info['serial'] = fee.getCommandStatus('serial')['serial.FEE']
+    except Exception as e:
+        info['error'] = str(e)
+    return info
+
+
+def save(path, results, info=None, **settings):
+    """Save benchmark results, and whatever describes the run, as JSON. """
+
+    out = dict(info=info or dict(), settings=settings, results=results)
+    with open(path, 'w') as f:
+        json.dump(out, f, indent=1, allow_nan=True)
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def formatResult(result):
+    """Return one result as a line of text, with times in milliseconds. """
+
+    return ('%-22s n=%-4d p50=%7.1f p95=%7.1f p99=%7.1f max=%7.1f ms  errors=%d retries=%d  %0.0f B/s' %
+            (result['name'], result['n'], result['p50']*1000, result['p95']*1000,
+             result['p99']*1000, result['max']*1000,
+             result['nErrors'], result['nRetries'], result['bytesPerSec']))
+
+
+def compare(old, new):
+    """Return lines comparing the p50 and p95 of two saved benchmark runs. """
+
+    lines = [f"old: {old['info'].get('revision', '?')} {old['info'].get('date', '')}",
+             f"new: {new['info'].get('revision', '?')} {new['info'].get('date', '')}"]
+    oldResults = {r['name']: r for r in old['results']}
+    for r in new['results']:
+        o = oldResults.get(r['name'], None)
+        if o is None:
+            continue
+        lines.append('%-22s p50 %7.1f -> %7.1f ms  p95 %7.1f -> %7.1f ms  errors %d -> %d' %
+                     (r['name'], o['p50']*1000, r['p50']*1000, o['p95']*1000, r['p95']*1000,
+                      o['nErrors'], r['nErrors']))
+    return lines
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='benchmark FEE serial latency')
+    parser.add_argument('--port', default=None,
+                        help='the FEE serial port')
+    parser.add_argument('--sim', default=None, metavar='TRANSCRIPT',
+                        help='benchmark an in-process FEE emulator replaying this transcript')
+    parser.add_argument('--latency', type=float, default=None,
+                        help='the emulator reply latency, seconds, instead of the recorded ones')
+    parser.add_argument('--cnt', type=int, default=10,
+                        help='how many times to time each category')
+    parser.add_argument('--retries', type=int, default=1,
+                        help='how many times to retry a failed call')
+    parser.add_argument('--categories', default=','.join(CATEGORIES),
+                        help='comma-separated categories to time')
+    parser.add_argument('--output', default=None,
+                        help='save the results to this JSON file')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), default=None,
+                        help='compare two saved results, and exit')
+    args = parser.parse_args(argv)
+
+    if args.compare is not None:
+        old, new = [load(path) for path in args.compare]
+        print('\n'.join(compare(old, new)))
+        return
+
+    logging.basicConfig(level=logging.INFO)
+
+    import xcu_fpga.fee.feeControl as feeControl
+    from ccdActor.utils import feeSim
+
+    sim = None
+    port = args.port
+    if args.sim is not None:
+        sim = feeSim.FeeSimulator(args.sim, latency=args.latency)
+        port = sim.start()
+    if port is None:
+        parser.error('need either --port or --sim')
+
+    try:
+        fee = feeControl.FeeControl(fpga=None, port=port)
+        categories = args.categories.split(',')
+        info = describe(fee)
+        print(f"FEE {info.get('revision', '?')} on {port}: {args.cnt} of each of {categories}")
+
+        results = benchmark(fee, categories, nRepeat=args.cnt, retries=args.retries,
+                            report=lambda result: print(formatResult(result), flush=True))
+        if args.output is not None:
+            save(args.output, results, info, port=port, nRepeat=args.cnt,
+                 retries=args.retries, simulator=str(sim) if sim is not None else None)
+    finally:
+        if sim is not None:
+            sim.stop()
+
+
+if __name__ == '__main__':
+    main()
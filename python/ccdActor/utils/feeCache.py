@@ -0,0 +1,144 @@
+import logging
+import threading
+import time
+
+
+class StatusCache(object):
+    """Remember FEE status replies for a while, per status category.
+
+    Each cached value belongs to a category ('voltage', 'temps', etc.),
+    which sets how long it stays fresh. A TTL of None means forever (or
+    until invalidated) and 0 means never cache.
+
+    A fetch which started before its category was last invalidated might
+    have read the FEE before the change, so its result is not stored: a
+    fetcher takes `generation` before reading the FEE, and passes it to
+    `store`.
+
+    Args
+    ----
+    ttls : `dict`
+      TTLs in seconds, keyed by category, overriding `defaultTTLs`.
+      'default' applies to categories which are not listed.
+    """
+
+    defaultTTLs = dict(revision=None,
+                       serial=None,
+                       voltage=5.0,
+                       bias=5.0,
+                       temps=30.0,
+                       offset=600.0,
+                       preset=600.0,
+                       default=0.0)
+
+    def __init__(self, ttls=None):
+        self.logger = logging.getLogger('feeCache')
+        self.lock = threading.Lock()
+        self.ttls = dict(self.defaultTTLs)
+        if ttls is not None:
+            self.ttls.update(ttls)
+
+        self.values = dict()
+        self.nHits = 0
+        self.nMisses = 0
+
+        # Bumped by each invalidation, and when each category, or all, were last invalidated.
+        self.generation = 0
+        self.invalidated = dict()
+        self.allInvalidated = 0
+        self.nDropped = 0
+
+    def __str__(self):
+        return (f'StatusCache(entries={len(self.values)}, hits={self.nHits}, '
+                f'misses={self.nMisses}, dropped={self.nDropped})')
+
+    def ttl(self, category):
+        return self.ttls.get(category, self.ttls['default'])
+
+    def lookup(self, name, category=None):
+        """Return a fresh cached value and its age in seconds, or None.
+
+        Args
+        ----
+        name : `str`
+          What was cached.
+        category : `str`
+          Its category. name by default.
+        """
+
+        if category is None:
+            category = name
+        ttl = self.ttl(category)
+
+        with self.lock:
+            entry = self.values.get(name, None)
+            if entry is not None:
+                value, t, _ = entry
+                age = time.monotonic() - t
+                if ttl is None or age <= ttl:
+                    self.nHits += 1
+                    return value, age
+            self.nMisses += 1
+        return None
+
+    def store(self, name, value, category=None, generation=None):
+        """Cache a value just fetched from the FEE.
+
+        Args
+        ----
+        generation : `int`
+          `generation` from before the FEE was read. If the category has
+          been invalidated since, the value is not stored.
+        """
+
+        if category is None:
+            category = name
+        if self.ttl(category) == 0:
+            return
+
+        with self.lock:
+            if generation is not None and generation < max(self.allInvalidated,
+                                                           self.invalidated.get(category, 0)):
+                self.nDropped += 1
+                return
+            self.values[name] = (value, time.monotonic(), category)
+
+    def fetch(self, name, fetchFunc, category=None, fresh=False):
+        """Return a cached value and its age, calling fetchFunc() if we have no fresh one.
+
+        Args
+        ----
+        fresh : `bool`
+          Always fetch a new value.
+        """
+
+        if not fresh:
+            cached = self.lookup(name, category)
+            if cached is not None:
+                return cached
+
+        generation = self.generation
+        value = fetchFunc()
+        self.store(name, value, category, generation=generation)
+        return value, 0.0
+
+    def invalidate(self, *categories):
+        """Drop the cached values in the given categories, or all of them. """
+
+        with self.lock:
+            self.generation += 1
+            if not categories:
+                self.allInvalidated = self.generation
+                self.values.clear()
+                return
+            for category in categories:
+                self.invalidated[category] = self.generation
+            for name in [n for n, entry in self.values.items() if entry[2] in categories]:
+                del self.values[name]
+
+    def ages(self):
+        """Return the age in seconds of each cached value, keyed by name. """
+
+        now = time.monotonic()
+        with self.lock:
+            return {name: now - t for name, (value, t, category) in self.values.items()}
@@ -0,0 +1,273 @@
+import contextlib
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+# Request priorities: lower goes first.
+EXPOSURE = 0
+COMMAND = 1
+MONITOR = 2
+
+PRIORITY_NAMES = {EXPOSURE: 'exposure', COMMAND: 'command', MONITOR: 'monitor'}
+
+
+class FeeBusy(RuntimeError):
+    """A monitoring request was dropped because an exposure is using the FEE. """
+    pass
+
+
+class _Request(object):
+    def __init__(self, priority, func, args, kwargs, key):
+        self.priority = priority
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.key = key
+        self.queued = time.monotonic()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.callbacks = []
+
+    def __str__(self):
+        return f'FeeRequest({PRIORITY_NAMES[self.priority]}, {self.key or self.func.__name__})'
+
+    def run(self):
+        try:
+            self.result = self.func(*self.args, **self.kwargs)
+        except Exception as e:
+            self.error = e
+        self.finish()
+
+    def fail(self, error):
+        self.error = error
+        self.finish()
+
+    def finish(self):
+        self.done.set()
+        for callback in self.callbacks:
+            callback(self)
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class FeeScheduler(object):
+    """Serialise all FEE serial traffic through one thread, by priority.
+
+    Requests are run one at a time by a single owner thread, lowest
+    priority number first, and in order within a priority. So a mode
+    change from an exposure always goes ahead of any queued status polls,
+    and waits for at most the one request already running.
+
+    While an exposure is wiping or reading out (see `exposing`),
+    monitoring requests are not started. With dropWhileBusy they are
+    failed with `FeeBusy`, otherwise they wait. Identical monitoring
+    requests, with the same key, are coalesced: later callers share the
+    result of the one already queued.
+
+    Calls made from the owner thread itself, as when feeControl calls
+    its own methods, run immediately.
+
+    Args
+    ----
+    dropWhileBusy : `bool`
+      Whether to drop, rather than defer, monitoring requests during
+      exposures.
+    """
+
+    def __init__(self, dropWhileBusy=True):
+        self.logger = logging.getLogger('feeScheduler')
+        self.dropWhileBusy = dropWhileBusy
+
+        self.cond = threading.Condition()
+        self.heap = []
+        self.pending = dict()
+        self.seq = itertools.count()
+        self.nBusy = 0
+        self.local = threading.local()
+        self.running = False
+        self.thread = None
+
+        # Per priority: number of requests, total and max wait before starting.
+        self.waits = {p: [0, 0.0, 0.0] for p in PRIORITY_NAMES}
+        self.nDropped = 0
+        self.nCoalesced = 0
+
+    def __str__(self):
+        waits = ', '.join(f'{PRIORITY_NAMES[p]}={n}/{total/max(n, 1)*1000:0.0f}/{maxWait*1000:0.0f}ms'
+                          for p, (n, total, maxWait) in self.waits.items())
+        return (f'FeeScheduler(queued={len(self.heap)}, busy={self.nBusy > 0}, '
+                f'dropped={self.nDropped}, coalesced={self.nCoalesced}, waits n/mean/max: {waits})')
+
+    def start(self):
+        if self.thread is not None:
+            return
+
+        self.running = True
+        self.thread = threading.Thread(target=self._loop, name='feeScheduler', daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout=None):
+        """Stop the owner thread, failing anything still queued. """
+
+        if self.thread is None:
+            return
+
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        self.thread.join(timeout)
+        self.thread = None
+
+        with self.cond:
+            while self.heap:
+                _, _, req = heapq.heappop(self.heap)
+                req.fail(RuntimeError('FEE scheduler stopped'))
+            self.pending.clear()
+
+    @contextlib.contextmanager
+    def exposing(self):
+        """Mark the FEE as in use by an exposure, for the duration of the block. """
+
+        with self.cond:
+            self.nBusy += 1
+            if self.dropWhileBusy:
+                self._dropMonitors()
+        try:
+            with self.priority(EXPOSURE):
+                yield
+        finally:
+            with self.cond:
+                self.nBusy -= 1
+                self.cond.notify_all()
+
+    @contextlib.contextmanager
+    def priority(self, priority):
+        """Set the default priority of the requests made by this thread. """
+
+        old = getattr(self.local, 'priority', None)
+        self.local.priority = priority
+        try:
+            yield
+        finally:
+            self.local.priority = old
+
+    def threadPriority(self, default):
+        """Return the priority set by `priority()` for this thread, or default. """
+
+        priority = getattr(self.local, 'priority', None)
+        return default if priority is None else priority
+
+    def call(self, priority, func, *args, key=None, **kwargs):
+        """Run func(*args, **kwargs) on the owner thread and return its result.
+
+        Args
+        ----
+        priority : `int`
+          EXPOSURE, COMMAND or MONITOR. A priority set for this thread by
+          `priority()` takes precedence if it is more urgent.
+        key : `str`
+          If set, monitoring requests with the same key are coalesced.
+        """
+
+        if self.thread is None or threading.current_thread() is self.thread:
+            return func(*args, **kwargs)
+
+        return self.submit(priority, func, *args, key=key, **kwargs).wait()
+
+    def submit(self, priority, func, *args, key=None, callback=None, **kwargs):
+        """Queue func(*args, **kwargs) to run on the owner thread, without waiting.
+
+        Takes the same arguments as `call`, plus:
+
+        callback : callable
+          Called with the request once it has finished, from whichever
+          thread finished it. req.result and req.error say how it went.
+
+        Returns
+        -------
+        req : the request. req.wait() returns its result or raises its error.
+        """
+
+        priority = min(priority, self.threadPriority(priority))
+        if self.thread is None or threading.current_thread() is self.thread:
+            req = _Request(priority, func, args, kwargs, key)
+            if callback is not None:
+                req.callbacks.append(callback)
+            req.run()
+            return req
+
+        with self.cond:
+            if priority == MONITOR and self.nBusy > 0 and self.dropWhileBusy:
+                self.nDropped += 1
+                req = _Request(priority, func, args, kwargs, key)
+                dropped = True
+            else:
+                dropped = False
+                req = self.pending.get(key, None) if (key is not None and priority == MONITOR) else None
+                if req is not None:
+                    self.nCoalesced += 1
+                else:
+                    req = _Request(priority, func, args, kwargs, key)
+                    heapq.heappush(self.heap, (priority, next(self.seq), req))
+                    if key is not None and priority == MONITOR:
+                        self.pending[key] = req
+                    self.cond.notify_all()
+                if callback is not None:
+                    req.callbacks.append(callback)
+
+        if dropped:
+            if callback is not None:
+                req.callbacks.append(callback)
+            req.fail(FeeBusy(f'FEE is busy with an exposure: not running {req}'))
+        return req
+
+    def _dropMonitors(self):
+        """Fail all queued monitoring requests. Called with the lock held. """
+
+        kept = []
+        for item in self.heap:
+            req = item[2]
+            if req.priority == MONITOR:
+                self.nDropped += 1
+                self.pending.pop(req.key, None)
+                req.fail(FeeBusy(f'FEE is busy with an exposure: dropped {req}'))
+            else:
+                kept.append(item)
+        heapq.heapify(kept)
+        self.heap = kept
+
+    def _nextRequest(self):
+        """Wait for a request which may run now. Called with the lock held. """
+
+        while self.running:
+            if self.heap:
+                priority = self.heap[0][0]
+                if priority < MONITOR or self.nBusy == 0:
+                    _, _, req = heapq.heappop(self.heap)
+                    if self.pending.get(req.key, None) is req:
+                        del self.pending[req.key]
+                    return req
+            self.cond.wait()
+        return None
+
+    def _loop(self):
+        while True:
+            with self.cond:
+                req = self._nextRequest()
+            if req is None:
+                return
+
+            wait = time.monotonic() - req.queued
+            stats = self.waits[req.priority]
+            stats[0] += 1
+            stats[1] += wait
+            stats[2] = max(stats[2], wait)
+
+            req.run()
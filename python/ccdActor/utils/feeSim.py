@@ -0,0 +1,355 @@
+#!/usr/bin/env python
+
+"""A FEE emulator on a pseudo-terminal, replaying traffic recorded from a real FEE.
+
+Runs a fake FEE on the slave side of a pty, which feeControl can open
+like the real serial port: point actorConfig['fee']['port'] at the
+device name we print.
+
+The FEE command set, framing and reply formats belong to feeControl, and
+we do not want a second copy of them here which could quietly drift. So
+the emulator is driven by a transcript: the exact bytes feeControl wrote
+to a real FEE and the bytes it read back, with the reply latencies,
+recorded with `FeeRecorder` (the actor's `fee record` command). Record
+whatever the test needs: status reads, mode changes, offsets, a
+firmware upload.
+
+A small transcript is kept in ccdActor/data/feeTranscript.json and used
+by default: a status sweep and the idle/wipe/expose/read/idle mode
+changes. It was written by hand, with the framing feeControl uses, and
+not recorded from a FEE, so replace it with a real recording when one
+can be made.
+
+Each request is answered with the bytes the real FEE sent for it, after
+the recorded latency. If the same request was recorded several times,
+the replies are replayed in the recorded order, so a replayed sequence
+of mode changes and status reads sees the same state changes the real
+FEE made. Requests which were never recorded are not answered: the
+caller times out, as it would with a confused FEE.
+
+Firmware uploads (`sendImage`) send the lines of an Intel HEX image,
+which differ from one image to the next. Unrecorded lines which start
+with a recorded HEX record's ':' are answered as the recorded records
+were, so an upload of any image can be replayed.
+
+Latencies can be scaled or overridden per request, and replies can
+occasionally be garbled, to exercise the error paths.
+"""
+
+import argparse
+import bisect
+import json
+import logging
+import os
+import random
+import select
+import threading
+import time
+import tty
+
+defaultTranscript = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                 'data', 'feeTranscript.json')
+
+
+class FeeRecorder(object):
+    """Wrap the FEE serial device, recording every exchange.
+
+    An exchange is the bytes written, up to the next read, and the
+    bytes read back before the next write. Record with one command
+    outstanding at a time (no batching), so that each exchange is one
+    request and its reply.
+
+    Args
+    ----
+    device : `serial.Serial`
+      The real device.
+    """
+
+    def __init__(self, device):
+        self.device = device
+        self.lock = threading.Lock()
+        self.exchanges = []
+        self.sent = b''
+        self.reply = b''
+        self.tSent = None
+        self.tReply = None
+
+    def __getattr__(self, name):
+        return getattr(self.device, name)
+
+    def _flush(self):
+        if self.sent:
+            latency = (self.tReply - self.tSent) if self.tReply is not None else None
+            self.exchanges.append(dict(sent=self.sent.decode('latin-1'),
+                                       reply=self.reply.decode('latin-1'),
+                                       latency=latency))
+        self.sent = b''
+        self.reply = b''
+        self.tSent = self.tReply = None
+
+    def write(self, data):
+        with self.lock:
+            if self.reply:
+                self._flush()
+            self.sent += bytes(data)
+            self.tSent = time.monotonic()
+        return self.device.write(data)
+
+    def _recorded(self, data):
+        if data:
+            with self.lock:
+                self.reply += data
+                self.tReply = time.monotonic()
+        return data
+
+    def read(self, *args, **kwargs):
+        return self._recorded(self.device.read(*args, **kwargs))
+
+    def read_until(self, *args, **kwargs):
+        return self._recorded(self.device.read_until(*args, **kwargs))
+
+    def readline(self, *args, **kwargs):
+        return self._recorded(self.device.readline(*args, **kwargs))
+
+    def save(self, path, **info):
+        """Save the transcript as JSON, with anything else describing it. """
+
+        with self.lock:
+            self._flush()
+            exchanges = list(self.exchanges)
+        with open(path, 'w') as f:
+            json.dump(dict(info=info, exchanges=exchanges), f, indent=1)
+        return len(exchanges)
+
+
+def loadTranscript(path):
+    """Return the info and the exchanges of a saved `FeeRecorder` transcript. """
+
+    with open(path) as f:
+        transcript = json.load(f)
+    return transcript.get('info', dict()), transcript['exchanges']
+
+
+class FeeSimulator(object):
+    """Replay a recorded FEE transcript on a pty.
+
+    Args
+    ----
+    transcript : `str` or `list`
+      The path of a `FeeRecorder` transcript, or its list of exchanges.
+      Our own small transcript by default.
+    latency : `float`
+      If set, the reply latency for all requests, instead of the recorded ones.
+    latencyScale : `float`
+      Factor applied to the recorded latencies.
+    cmdLatency : `dict`
+      Reply latencies for the requests starting with each key, as
+      feeControl sends them, e.g. {'~sm': 0.5}. Overrides the others.
+    garble : `float`
+      Probability that a reply is corrupted.
+    hexPrefix : `str`
+      The start of the HEX records of a firmware upload.
+    seed : `int`
+      Random seed, for reproducible garbling.
+    """
+
+    def __init__(self, transcript=None, latency=None, latencyScale=1.0, cmdLatency=None,
+                 garble=0.0, hexPrefix=':', seed=None):
+        self.logger = logging.getLogger('feeSim')
+        self.latency = latency
+        self.latencyScale = latencyScale
+        self.cmdLatency = dict(cmdLatency) if cmdLatency else dict()
+        self.garble = garble
+        self.hexPrefix = hexPrefix.encode('latin-1') if hexPrefix else None
+        self.rng = random.Random(seed)
+
+        if transcript is None:
+            transcript = defaultTranscript
+        if isinstance(transcript, str):
+            self.transcriptPath = transcript
+            _, transcript = loadTranscript(transcript)
+        else:
+            self.transcriptPath = None
+        self.exchanges = [(ex['sent'].encode('latin-1'), ex['reply'].encode('latin-1'),
+                           ex.get('latency', None) or 0.0)
+                          for ex in transcript if ex['sent']]
+        if not self.exchanges:
+            raise ValueError('the FEE transcript has no requests in it')
+
+        # Where each request was recorded, and what ends a request.
+        self.occurrences = dict()
+        for i, (sent, reply, latency) in enumerate(self.exchanges):
+            self.occurrences.setdefault(sent, []).append(i)
+        self.prefixes = {sent[:n] for sent in self.occurrences for n in range(1, len(sent))}
+        self.terminators = {sent[-1:] for sent in self.occurrences if len(sent) > 1}
+        self.hexReplies = [i for i, (sent, reply, latency) in enumerate(self.exchanges)
+                           if self.hexPrefix and sent.startswith(self.hexPrefix) and len(sent) > 1]
+        self.cursor = 0
+
+        self.nCommands = 0
+        self.nUnknown = 0
+        self.nGarbled = 0
+        self.master = None
+        self.slave = None
+        self.thread = None
+        self.running = False
+
+    def __str__(self):
+        return (f'FeeSimulator(port={self.portName}, transcript={self.transcriptPath}, '
+                f'exchanges={len(self.exchanges)}, commands={self.nCommands}, '
+                f'unknown={self.nUnknown}, garbled={self.nGarbled})')
+
+    @property
+    def portName(self):
+        return os.ttyname(self.slave) if self.slave is not None else None
+
+    def open(self):
+        """Create the pty. Returns the name of the device to connect to. """
+
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        return self.portName
+
+    def start(self):
+        if self.master is None:
+            self.open()
+        self.running = True
+        self.thread = threading.Thread(target=self._loop, name='feeSim', daemon=True)
+        self.thread.start()
+        return self.portName
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join(1.0)
+            self.thread = None
+        for fd in self.master, self.slave:
+            if fd is not None:
+                os.close(fd)
+        self.master = self.slave = None
+
+    def _loop(self):
+        buf = b''
+        while self.running:
+            ready, _, _ = select.select([self.master], [], [], 0.2)
+            if not ready:
+                continue
+            try:
+                buf += os.read(self.master, 1024)
+            except OSError:
+                return
+            buf = self._consume(buf)
+
+    def _consume(self, buf):
+        """Answer every complete request at the start of buf. Returns what is left. """
+
+        end = 1
+        while end <= len(buf):
+            request = buf[:end]
+            if request in self.occurrences and request not in self.prefixes:
+                self._reply(request)
+            elif request[-1:] in self.terminators:
+                self._reply(request)
+            else:
+                end += 1
+                continue
+            buf = buf[end:]
+            end = 1
+        return buf
+
+    def _find(self, request):
+        """Return the index of the recorded exchange to answer request with, or None. """
+
+        occurrences = self.occurrences.get(request, None)
+        if occurrences is None:
+            if self.hexReplies and request.startswith(self.hexPrefix):
+                occurrences = self.hexReplies
+            else:
+                return None
+
+        # The next time it was recorded at or after where we are, wrapping around.
+        j = bisect.bisect_left(occurrences, self.cursor)
+        return occurrences[j % len(occurrences)]
+
+    def _latency(self, request, recorded):
+        text = request.decode('latin-1')
+        for prefix, latency in self.cmdLatency.items():
+            if text.startswith(prefix):
+                return latency
+        if self.latency is not None:
+            return self.latency
+        return recorded * self.latencyScale
+
+    def _reply(self, request):
+        self.nCommands += 1
+        i = self._find(request)
+        if i is None:
+            self.nUnknown += 1
+            self.logger.warning('not answering unrecorded request %r', request)
+            return
+        self.cursor = i + 1
+
+        _, reply, recorded = self.exchanges[i]
+        delay = self._latency(request, recorded)
+        if delay > 0:
+            time.sleep(delay)
+
+        if self.garble > 0 and reply and self.rng.random() < self.garble:
+            reply = self._garble(reply)
+            self.nGarbled += 1
+        os.write(self.master, reply)
+
+    def _garble(self, reply):
+        """Corrupt a reply, keeping its line ending: truncate it, or replace some characters. """
+
+        body = reply.rstrip(b'\r\n')
+        eol = reply[len(body):]
+        if len(body) > 1 and self.rng.random() < 0.5:
+            return body[:self.rng.randrange(len(body))] + eol
+
+        chars = list(body) or [ord(' ')]
+        for i in range(max(1, len(chars) // 4)):
+            chars[self.rng.randrange(len(chars))] = self.rng.randrange(33, 127)
+        return bytes(chars) + eol
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='replay a recorded FEE transcript on a pty')
+    parser.add_argument('transcript', nargs='?', default=None,
+                        help='a transcript saved by "fee record"; our own small one by default')
+    parser.add_argument('--latency', type=float, default=None,
+                        help='reply latency for all requests, seconds, instead of the recorded ones')
+    parser.add_argument('--latencyScale', type=float, default=1.0,
+                        help='factor applied to the recorded latencies')
+    parser.add_argument('--cmdLatency', action='append', default=[],
+                        metavar='PREFIX=SECONDS',
+                        help='reply latency for requests starting with PREFIX; can be repeated')
+    parser.add_argument('--garble', type=float, default=0.0,
+                        help='probability of garbling a reply')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='random seed')
+    args = parser.parse_args(argv)
+
+    cmdLatency = dict()
+    for spec in args.cmdLatency:
+        prefix, secs = spec.rsplit('=', 1)
+        cmdLatency[prefix] = float(secs)
+
+    logging.basicConfig(level=logging.INFO)
+    sim = FeeSimulator(args.transcript, latency=args.latency, latencyScale=args.latencyScale,
+                       cmdLatency=cmdLatency, garble=args.garble, seed=args.seed)
+    port = sim.start()
+    print(f'FEE emulator listening on {port}', flush=True)
+
+    try:
+        while True:
+            time.sleep(10)
+            sim.logger.info('%s', sim)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sim.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,211 @@
+import numpy as np
+
+# The FITS checksum is the 32-bit ones' complement sum of the big-endian
+# 32-bit words of an HDU. That arithmetic is addition modulo 2**32-1, so
+# sums of separate pieces can be combined, and moving a piece by k bytes
+# only rotates its sum by 8k bits.
+
+_MASK = 0xffffffff
+
+
+def fold(total):
+    """Fold a wide integer sum into a 32-bit ones' complement sum. """
+
+    total = int(total)
+    while total > _MASK:
+        total = (total & _MASK) + (total >> 32)
+    return total
+
+
+def add(sum1, sum2):
+    """Add two ones' complement sums. """
+
+    return fold(sum1 + sum2)
+
+
+def rotate(checksum, offset):
+    """Return the sum of some bytes once they are moved to the given byte offset.
+
+    Args
+    ----
+    checksum : `int`
+      The sum of the bytes, as if they started on a word boundary.
+    offset : `int`
+      Where the bytes actually start, relative to a word boundary.
+    """
+
+    shift = 8 * (-offset % 4)
+    if shift == 0:
+        return checksum
+    return ((checksum << shift) | (checksum >> (32 - shift))) & _MASK
+
+
+def checksum(buf, offset=0):
+    """Calculate the ones' complement sum of some bytes.
+
+    Args
+    ----
+    buf : `bytes`, `bytearray` or `numpy.ndarray`
+      The bytes. Arrays are taken as they are laid out in memory, so must
+      already be big-endian.
+    offset : `int`
+      The byte offset of buf from a word boundary.
+
+    Returns
+    -------
+    sum : `int`
+    """
+
+    data = np.frombuffer(buf, dtype='u1') if not isinstance(buf, np.ndarray) else buf.reshape(-1).view('u1')
+    nWords = len(data) // 4
+    total = int(data[:nWords*4].view('>u4').sum(dtype='u8'))
+
+    tail = data[nWords*4:]
+    if len(tail):
+        padded = np.zeros(4, dtype='u1')
+        padded[:len(tail)] = tail
+        total += int(padded.view('>u4')[0])
+
+    return rotate(fold(total), offset)
+
+
+class RunningChecksum(object):
+    """Accumulate the checksum of a stream of bytes, as they are written. """
+
+    def __init__(self):
+        self.sum = 0
+        self.nbytes = 0
+
+    def update(self, buf):
+        self.sum = add(self.sum, checksum(buf, offset=self.nbytes))
+        self.nbytes += len(buf) if not isinstance(buf, np.ndarray) else buf.nbytes
+
+    def addSum(self, partialSum, nbytes):
+        """Add bytes whose sum, taken from a word boundary, was calculated elsewhere. """
+
+        self.sum = add(self.sum, rotate(partialSum, self.nbytes))
+        self.nbytes += nbytes
+
+
+def encode(value, complement=True):
+    """Encode a 32-bit checksum as the 16 character string for the CHECKSUM card.
+
+    This is the ASCII encoding of the FITS checksum convention. By default
+    the value is complemented first, which makes the HDU sum to -0 once
+    the string is in the header.
+    """
+
+    if complement:
+        value = ~value & _MASK
+
+    excluded = set(range(0x3a, 0x41)) | set(range(0x5b, 0x61))
+    asc = [0] * 16
+    for i in range(4):
+        byte = (value >> (24 - 8*i)) & 0xff
+        quotient = byte // 4 + 0x30
+        remainder = byte % 4
+        ch = [quotient + remainder, quotient, quotient, quotient]
+
+        again = True
+        while again:
+            again = False
+            for j in (0, 2):
+                if ch[j] in excluded or ch[j+1] in excluded:
+                    ch[j] += 1
+                    ch[j+1] -= 1
+                    again = True
+
+        for j in range(4):
+            asc[4*j + i] = ch[j]
+
+    # The string is rotated right by one, to line up with the header words.
+    asc = asc[15:] + asc[:15]
+    return ''.join(map(chr, asc))
+
+
+def _readHeader(f):
+    """Read one FITS header, returning its bytes and a dict of its keyword values. """
+
+    blocks = []
+    values = dict()
+    while True:
+        block = f.read(2880)
+        if len(block) == 0 and not blocks:
+            return None, None
+        if len(block) != 2880:
+            raise ValueError('truncated header')
+        blocks.append(block)
+        for i in range(0, 2880, 80):
+            card = block[i:i+80].decode('ascii', errors='replace')
+            name = card[:8].strip()
+            if name == 'END':
+                return b''.join(blocks), values
+            if card[8:10] == '= ':
+                values[name] = card[10:].split('/')[0].strip().strip("'").strip()
+
+
+def _dataSize(values):
+    """Return the size of an HDU's data, without padding. """
+
+    naxis = int(values.get('NAXIS', 0))
+    if naxis == 0:
+        return 0
+    npix = 1
+    for i in range(1, naxis + 1):
+        npix *= int(values[f'NAXIS{i}'])
+    nbytes = abs(int(values['BITPIX'])) // 8
+    return nbytes * int(values.get('GCOUNT', 1)) * (int(values.get('PCOUNT', 0)) + npix)
+
+
+def verifyFile(path, chunkSize=1 << 24):
+    """Independently check the CHECKSUM and DATASUM cards of every HDU in a file.
+
+    The file is read in chunks and summed here, without going through
+    the library which wrote it.
+
+    Args
+    ----
+    path : `str` or `pathlib.Path`
+      The file to check.
+    chunkSize : `int`
+      How many bytes to read at a time.
+
+    Returns
+    -------
+    problems : `list` of `str`
+      Empty if all is well.
+    """
+
+    problems = []
+    with open(path, 'rb') as f:
+        for hdu in range(1000):
+            try:
+                header, values = _readHeader(f)
+            except ValueError as e:
+                problems.append(f'HDU {hdu}: {e}')
+                break
+            if header is None:
+                break
+
+            dataSize = _dataSize(values)
+            paddedSize = dataSize + (-dataSize % 2880)
+            data = RunningChecksum()
+            while data.nbytes < paddedSize:
+                chunk = f.read(min(chunkSize, paddedSize - data.nbytes))
+                if len(chunk) == 0:
+                    break
+                data.update(chunk)
+            if data.nbytes < paddedSize:
+                problems.append(f'HDU {hdu}: truncated data ({data.nbytes} of {paddedSize} bytes)')
+                break
+
+            if 'DATASUM' not in values or 'CHECKSUM' not in values:
+                problems.append(f'HDU {hdu}: no CHECKSUM/DATASUM cards')
+                continue
+            if int(values['DATASUM']) != data.sum:
+                problems.append(f'HDU {hdu}: DATASUM is {values["DATASUM"]}, data sums to {data.sum}')
+            hduSum = add(checksum(header), data.sum)
+            if hduSum != _MASK:
+                problems.append(f'HDU {hdu}: CHECKSUM does not match: HDU sums to {hduSum:#010x}')
+
+    return problems
@@ -0,0 +1,372 @@
+import logging
+import os
+import queue
+import contextlib
+import threading
+import time
+
+import fitsio
+
+import ccdActor.utils.fitsChecksum as fitsChecksum
+import ccdActor.utils.tileWriter as tileWriterMod
+
+# The image and compression configurations the tile writer could not
+# write, which we have already complained about.
+_fallbacks = set()
+_fallbacksLock = threading.Lock()
+
+
+def fsyncPath(path):
+    """Flush a file and its directory entry to disk."""
+
+    fd = os.open(str(path), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+    fd = os.open(os.path.dirname(str(path)) or '.', os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _noteFallback(im, compression):
+    """Log, once per configuration, that an image is being written by fitsio instead of the tile writer. """
+
+    key = (im.dtype.str, im.shape, tuple(sorted((k, str(v)) for k, v in compression.items())))
+    with _fallbacksLock:
+        if key in _fallbacks:
+            return
+        _fallbacks.add(key)
+
+    logging.getLogger('fitsWriter').warning('the tile writer cannot write %s %s images with %s: '
+                                            'using fitsio, which re-reads each file for its checksums',
+                                            im.shape, im.dtype, compression)
+
+
+def writeFits(filepath, im, cards, imageCards, compress='RICE', timings=None,
+              compression=None, tileWriter=None):
+    """Write a PFS raw file: an empty PHDU and one compressed image HDU.
+
+    Args
+    ----
+    filepath : `str` or `pathlib.Path`
+      The full pathname of the file to write.
+    im : `numpy.ndarray`
+      The image.
+    cards : sequence of fitsio card dicts
+      The PHDU cards.
+    imageCards : sequence of fitsio card dicts
+      The image HDU cards.
+    compress : `str`
+      The fitsio compression type for the image HDU.
+    compression : `dict`
+      If set, all the fitsio write() compression arguments, overriding
+      `compress`. See `ccdActor.utils.compression`.
+    timings : `ccdActor.utils.timings.ExposureTimings`
+      If set, where to record the 'write' and 'checksum' times.
+    tileWriter : `ccdActor.utils.tileWriter.TileWriter`
+      If set, used to write the file for the compressions it supports.
+      It calculates the checksums as it writes. Otherwise, fitsio
+      writes the file and the checksums are calculated by re-reading
+      each HDU.
+
+    The file is fsync-ed before we return, so it is durably on disk.
+    """
+
+    def phase(name):
+        return timings.phase(name) if timings is not None else contextlib.nullcontext()
+
+    if compression is None:
+        compression = dict(compress=compress)
+
+    if tileWriter is not None:
+        if tileWriterMod.canWrite(im, compression):
+            return tileWriter.write(filepath, im, cards, imageCards,
+                                    compression=compression, timings=timings)
+        _noteFallback(im, compression)
+
+    hdr = fitsio.FITSHDR(cards)
+    imHdr = fitsio.FITSHDR(imageCards)
+
+    fitsFile = fitsio.FITS(str(filepath), 'rw')
+    try:
+        with phase('write'):
+            fitsFile.write(None, header=hdr)
+        with phase('checksum'):
+            fitsFile[-1].write_checksum()
+        with phase('write'):
+            fitsFile.write(im, extname="image", header=imHdr, **compression)
+        with phase('checksum'):
+            fitsFile[-1].write_checksum()
+    finally:
+        with phase('write'):
+            fitsFile.close()
+    with phase('write'):
+        fsyncPath(filepath)
+
+    return filepath
+
+
+class PendingWrites(object):
+    """Track the file writes started for one command.
+
+    Commands which read out the detector should not finish until their
+    files are on disk, and should fail if any of them could not be
+    written. Each write calls `add()` when queued and `done()` when
+    finished; `whenDone()` registers what to do once nothing is left.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.nPending = 0
+        self.errors = []
+        self.callbacks = []
+
+    def add(self):
+        with self.lock:
+            self.nPending += 1
+
+    def done(self, error=None):
+        with self.lock:
+            self.nPending -= 1
+            if error is not None:
+                self.errors.append(error)
+            callbacks = self._popCallbacks()
+
+        for cb in callbacks:
+            cb(self.errors)
+
+    def whenDone(self, callback):
+        """Call callback(errors) once all pending writes have completed. """
+
+        with self.lock:
+            self.callbacks.append(callback)
+            callbacks = self._popCallbacks()
+
+        for cb in callbacks:
+            cb(self.errors)
+
+    def _popCallbacks(self):
+        if self.nPending > 0:
+            return []
+        callbacks = self.callbacks
+        self.callbacks = []
+        return callbacks
+
+
+class WriteJob(object):
+    """One image file to write, and who to tell when it has been written.
+
+    Args
+    ----
+    filepath : `pathlib.Path`
+      The full pathname of the file to write.
+    image : `numpy.ndarray`
+      The image.
+    cards, imageCards : sequences of fitsio card dicts
+      The PHDU and image HDU cards.
+    onDone : callable
+      Called with no arguments once the file is durably on disk.
+    onFail : callable
+      Called with the exception if the write failed.
+    timings : `ccdActor.utils.timings.ExposureTimings`
+      If set, where to record the write times.
+    compression : `dict`
+      The fitsio compression arguments for the image HDU. RICE by default.
+    tileWriter : `ccdActor.utils.tileWriter.TileWriter`
+      If set, the parallel tile compressor to write with.
+    finalPath : `pathlib.Path`
+      Where the file will end up, if it is first written to a spool
+      directory. filepath by default.
+    """
+
+    def __init__(self, filepath, image, cards, imageCards,
+                 onDone=None, onFail=None, timings=None, compression=None,
+                 tileWriter=None, finalPath=None):
+        self.filepath = filepath
+        self.image = image
+        self.cards = cards
+        self.imageCards = imageCards
+        self.onDone = onDone
+        self.onFail = onFail
+        self.timings = timings
+        self.compression = compression
+        self.tileWriter = tileWriter
+        self.finalPath = finalPath if finalPath is not None else filepath
+
+    def __str__(self):
+        return f'WriteJob({self.filepath})'
+
+    def run(self):
+        writeFits(self.filepath, self.image, self.cards, self.imageCards,
+                  timings=self.timings, compression=self.compression,
+                  tileWriter=self.tileWriter)
+
+
+class FitsWriter(object):
+    """Run image write jobs on a background thread.
+
+    Args
+    ----
+    queueDepth : `int`
+      How many jobs can be waiting. `submit()` blocks when the queue is
+      full, which bounds how many images we hold in memory.
+    doAsync : `bool`
+      If False, run jobs in the submitting thread.
+    """
+
+    def __init__(self, queueDepth=2, doAsync=True, logLevel=logging.INFO):
+        self.logger = logging.getLogger('fitsWriter')
+        self.logger.setLevel(logLevel)
+
+        self.doAsync = doAsync
+        self.queue = queue.Queue(maxsize=queueDepth)
+        self.thread = None
+
+    def __str__(self):
+        return (f'FitsWriter(async={self.doAsync}, depth={self.queue.qsize()}'
+                f'/{self.queue.maxsize})')
+
+    def start(self):
+        if not self.doAsync or self.thread is not None:
+            return
+
+        self.thread = threading.Thread(target=self._loop, name='fitsWriter', daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout=None):
+        """Finish all queued jobs then stop the thread. """
+
+        if self.thread is None:
+            return
+
+        self.queue.put(None)
+        self.thread.join(timeout)
+        self.thread = None
+
+    def submit(self, job):
+        """Queue a job, blocking while the queue is full. """
+
+        if not self.doAsync or self.thread is None:
+            self._runJob(job)
+            return
+
+        t0 = time.monotonic()
+        self.queue.put(job)
+        dt = time.monotonic() - t0
+        if dt > 0.1:
+            self.logger.warning('waited %0.2fs to queue %s', dt, job)
+
+    def drain(self):
+        """Block until all queued jobs have been run. """
+
+        if self.thread is not None:
+            self.queue.join()
+
+    def _runJob(self, job):
+        try:
+            job.run()
+        except Exception as e:
+            self.logger.warning('%s failed: %s', job, e)
+            if job.onFail is not None:
+                job.onFail(e)
+            return
+
+        if job.onDone is not None:
+            job.onDone()
+
+    def _loop(self):
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None:
+                    return
+                self._runJob(job)
+            except Exception as e:
+                self.logger.exception('unexpected failure running %s: %s', job, e)
+            finally:
+                self.queue.task_done()
+
+
+class ChecksumVerifier(object):
+    """Check the checksums of written files on a background thread.
+
+    The files are re-read and summed by `fitsChecksum.verifyFile`,
+    independently of whatever wrote them. This is a check on the writers,
+    so is off by default.
+    """
+
+    def __init__(self, logLevel=logging.INFO):
+        self.logger = logging.getLogger('verifier')
+        self.logger.setLevel(logLevel)
+
+        self.queue = queue.Queue()
+        self.thread = None
+        self.nChecked = 0
+        self.nFailed = 0
+
+    def __str__(self):
+        return (f'ChecksumVerifier(queued={self.queue.qsize()}, checked={self.nChecked}, '
+                f'failed={self.nFailed})')
+
+    def start(self):
+        if self.thread is not None:
+            return
+
+        self.thread = threading.Thread(target=self._loop, name='verifier', daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout=None):
+        if self.thread is None:
+            return
+
+        self.queue.put(None)
+        self.thread.join(timeout)
+        self.thread = None
+
+    def submit(self, filepath, callback=None):
+        """Queue a file to check.
+
+        Args
+        ----
+        filepath : `str` or `pathlib.Path`
+          The file.
+        callback : callable
+          Called with (filepath, problems, duration). problems is a list
+          of strings, empty if the file is good.
+        """
+
+        self.queue.put((filepath, callback))
+
+    def _loop(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                self._check(*item)
+            except Exception as e:
+                self.logger.exception('unexpected failure verifying %s: %s', item, e)
+            finally:
+                self.queue.task_done()
+
+    def _check(self, filepath, callback):
+        t0 = time.monotonic()
+        try:
+            problems = fitsChecksum.verifyFile(filepath)
+        except Exception as e:
+            problems = [f'could not read file: {e}']
+        dt = time.monotonic() - t0
+
+        self.nChecked += 1
+        if problems:
+            self.nFailed += 1
+            self.logger.warning('%s failed verification: %s', filepath, problems)
+        else:
+            self.logger.info('%s verified in %0.2fs', filepath, dt)
+
+        if callback is not None:
+            callback(filepath, problems, dt)
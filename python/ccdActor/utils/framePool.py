@@ -0,0 +1,103 @@
+import logging
+import threading
+
+import numpy as np
+
+
+class FramePool(object):
+    """A small set of preallocated full-frame image buffers.
+
+    Frames are reference counted: `acquire()` hands out a frame with one
+    reference, `retain()` adds one for each additional user (QA, say),
+    and the frame goes back to the pool when `release()` drops the last
+    one. Arrays which did not come from the pool can be passed to
+    `retain()` and `release()`, which then do nothing.
+
+    If all frames are busy, `acquire()` falls back to allocating a new,
+    unpooled, array so that a readout is never held up by the pool.
+
+    Only frames we allocate ourselves come from here: windowed readouts
+    placed in a full frame, and the simulated ccd's readouts. Real
+    full-frame readouts are allocated by fpga's ccdFuncs.readout.
+
+    Args
+    ----
+    shape : `tuple`
+      The shape of a full frame.
+    nFrames : `int`
+      How many frames to preallocate.
+    dtype : `str`
+      The frame pixel type.
+    """
+
+    def __init__(self, shape, nFrames=4, dtype='u2'):
+        self.logger = logging.getLogger('framePool')
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.lock = threading.Lock()
+
+        self.frames = []
+        for i in range(nFrames):
+            frame = np.empty(self.shape, dtype=self.dtype)
+            frame.fill(0)       # Fault the pages in now, not during a readout.
+            self.frames.append(frame)
+
+        self.refcounts = {id(f): 0 for f in self.frames}
+        self.free = list(self.frames)
+        self.nMisses = 0
+
+    def __str__(self):
+        return (f'FramePool(shape={self.shape}, nFrames={len(self.frames)}, '
+                f'free={len(self.free)}, misses={self.nMisses})')
+
+    def _rootArray(self, arr):
+        while isinstance(arr, np.ndarray) and arr.base is not None:
+            arr = arr.base
+        return arr
+
+    def acquire(self, zero=False):
+        """Return a full frame with one reference.
+
+        Args
+        ----
+        zero : `bool`
+          Whether to clear the frame. Otherwise its contents are stale.
+        """
+
+        with self.lock:
+            frame = self.free.pop() if self.free else None
+            if frame is not None:
+                self.refcounts[id(frame)] = 1
+            else:
+                self.nMisses += 1
+
+        if frame is None:
+            self.logger.warning('no free frames, allocating a new one: %s', self)
+            return np.zeros(self.shape, dtype=self.dtype)
+
+        if zero:
+            frame.fill(0)
+        return frame
+
+    def retain(self, arr):
+        """Add a reference to the pool frame holding arr, if there is one. """
+
+        key = id(self._rootArray(arr))
+        with self.lock:
+            if key in self.refcounts:
+                self.refcounts[key] += 1
+
+    def release(self, arr):
+        """Drop a reference to the pool frame holding arr, if there is one. """
+
+        root = self._rootArray(arr)
+        key = id(root)
+        with self.lock:
+            if key not in self.refcounts:
+                return
+            if self.refcounts[key] <= 0:
+                self.logger.warning('releasing a frame which is already free')
+                return
+            self.refcounts[key] -= 1
+            if self.refcounts[key] == 0:
+                self.free.append(root)
@@ -0,0 +1,248 @@
+import numpy as np
+
+import ccdActor.utils.basicQA as basicQA
+
+
+def ampStreams(image, readRows, cols=None, namps=8, rowGap=0, maxRows=None):
+    """Rebuild the pixel-time-ordered stream of each amp.
+
+    The amps are read in parallel, one row at a time, so the stream of
+    amp i is its rows laid end to end. Pixels which are not used (data
+    columns of an illuminated image, or the parallel transfer time
+    between rows) are set to 0 after the amp level is removed.
+
+    Parameters
+    ----------
+    image : `numpy.ndarray`
+        Raw CCD image.
+    readRows : (`int`, `int`)
+        The range of image rows which were read.
+    cols : `slice`
+        The columns of each amp to use. All by default.
+    namps : `int`
+        Number of amps across the image.
+    rowGap : `int`
+        Pixel times between the end of one row and the start of the next.
+    maxRows : `int`
+        Only use this many rows.
+
+    Returns
+    -------
+    streams : `numpy.ndarray`
+        float32, (namps, nsamples).
+    fillFraction : `float`
+        The fraction of the stream which is real pixels.
+    """
+    row0, row1 = readRows
+    if maxRows is not None:
+        row1 = min(row1, row0 + maxRows)
+    nrows = row1 - row0
+    ampCols = image.shape[1] // namps
+
+    used = np.zeros(ampCols + rowGap, dtype=bool)
+    used[:ampCols][cols if cols is not None else slice(None)] = True
+
+    amps = image[row0:row1, :ampCols*namps].reshape(nrows, namps, ampCols)
+    streams = np.zeros((namps, nrows, ampCols + rowGap), dtype='f4')
+    streams[:, :, :ampCols] = amps.transpose(1, 0, 2)
+
+    pixels = streams[:, :, used]
+    streams[:, :, used] -= pixels.mean(axis=(1, 2), dtype='f8')[:, None, None].astype('f4')
+    streams[:, :, ~used] = 0
+
+    return streams.reshape(namps, -1), used.mean()
+
+
+def welchSpectra(streams, pixelTime, nperseg=4096, fillFraction=1.0):
+    """Calculate the power spectrum of each stream, averaging over segments.
+
+    Parameters
+    ----------
+    streams : `numpy.ndarray`
+        float32, (namps, nsamples).
+    pixelTime : `float`
+        Seconds per sample.
+    nperseg : `int`
+        Samples per segment: sets the frequency resolution.
+    fillFraction : `float`
+        The fraction of samples which are real, to scale the power by.
+
+    Returns
+    -------
+    freqs : `numpy.ndarray`
+        The frequencies, in Hz.
+    power : `numpy.ndarray`
+        (namps, nfreqs) power, in ADU^2: a sine wave of rms amplitude A at
+        one of the frequencies has a peak of A^2.
+    """
+    namps, nsamples = streams.shape
+    nperseg = min(nperseg, nsamples)
+    nseg = nsamples // nperseg
+
+    segs = streams[:, :nseg*nperseg].reshape(namps, nseg, nperseg)
+    segs = segs - segs.mean(axis=2, keepdims=True)
+    window = np.hanning(nperseg).astype('f4')
+    spec = np.fft.rfft(segs * window, axis=2)
+
+    power = (spec.real**2 + spec.imag**2).mean(axis=1)
+    power *= 2 / (window.sum()**2 * fillFraction)
+    power[:, 0] /= 2
+    freqs = np.fft.rfftfreq(nperseg, pixelTime)
+
+    return freqs, power
+
+
+def _peakMask(freqs, power, minFreq, threshold):
+    """Flag the local maxima of the last axis of power which stand out from the median. """
+
+    ok = np.zeros(power.shape, dtype=bool)
+    ok[..., 1:-1] = (power[..., 1:-1] > power[..., :-2]) & (power[..., 1:-1] >= power[..., 2:])
+    ok &= freqs >= minFreq
+    ok &= power > threshold * np.median(power[..., freqs >= minFreq], axis=-1, keepdims=True)
+    return ok
+
+
+def findPeaks(freqs, power, nPeaks=3, minFreq=0.0, threshold=10.0):
+    """Find the strongest narrow peaks in a power spectrum.
+
+    Parameters
+    ----------
+    freqs : `numpy.ndarray`
+        The frequencies, in Hz.
+    power : `numpy.ndarray`
+        One spectrum.
+    nPeaks : `int`
+        How many peaks to return, at most.
+    minFreq : `float`
+        Ignore anything below this frequency, in Hz.
+    threshold : `float`
+        Only take peaks this many times the median power.
+
+    Returns
+    -------
+    peakFreqs, peakRms : `numpy.ndarray`
+        The frequencies and rms amplitudes of the peaks, strongest first.
+    """
+    ok = _peakMask(freqs, power, minFreq, threshold)
+    idx = np.where(ok)[0]
+    idx = idx[np.argsort(power[idx])[::-1][:nPeaks]]
+
+    return freqs[idx], np.sqrt(power[idx])
+
+
+def _overscanCols(image, colTrim):
+    """Return the serial overscan columns within each amp, and the number of amps.
+
+    `ampStreams` takes amp i to be columns [i*ampCols, (i+1)*ampCols), so
+    each amp's overscan must sit at the same place within those.
+    """
+
+    geometry = basicQA.overscanGeometry(image)
+    if geometry is None:
+        raise RuntimeError('cannot locate the serial overscans')
+    _, _, col0, ampStep, ncols, namps = geometry
+
+    ampCols = image.shape[1] // namps
+    if namps > 1 and ampStep != ampCols:
+        raise RuntimeError(f'the serial overscans are {ampStep} columns apart, '
+                           f'but the amps are {ampCols} wide')
+    col0 -= (col0 // ampCols) * ampCols
+    if col0 + ncols > ampCols:
+        raise RuntimeError(f'the serial overscans (columns {col0}:{col0+ncols} of each amp) '
+                           f'run past the amps, which are {ampCols} wide')
+
+    return slice(col0 + colTrim[0], col0 + ncols - colTrim[1]), namps
+
+
+def noiseSpectrum(image, readRows, pixelTime,
+                  rowGap=0, maxRows=1000, nperseg=4096,
+                  nPeaks=3, minFreq=100.0, threshold=10.0):
+    """Look for periodic pickup in the amp readout streams.
+
+    Whole rows are used, so this is only meaningful for images without
+    signal, i.e. biases. The overscans alone cannot be used: the gaps
+    between them spread each line into sidebands spaced by the row
+    frequency, which then show up as false lines. See `broadbandNoise`
+    for those.
+
+    Parameters
+    ----------
+    image : `numpy.ndarray`
+        Raw CCD image.
+    readRows : (`int`, `int`)
+        The range of image rows which were read.
+    pixelTime : `float`
+        Seconds per pixel.
+
+    See `ampStreams`, `welchSpectra` and `findPeaks` for the other
+    parameters.
+
+    Returns
+    -------
+    peaks : `numpy.recarray`
+        One row per peak in the mean spectrum of all amps: freq and rms.
+    ampPeaks : `numpy.recarray`
+        One row per amp, for the strongest peak in that amp: freq and rms.
+        NaN if none were found.
+    """
+    namps = 8
+    streams, fillFraction = ampStreams(image, readRows, namps=namps,
+                                       rowGap=rowGap, maxRows=maxRows)
+    freqs, power = welchSpectra(streams, pixelTime, nperseg=nperseg,
+                                fillFraction=fillFraction)
+
+    peakFreqs, peakRms = findPeaks(freqs, power.mean(axis=0), nPeaks=nPeaks,
+                                   minFreq=minFreq, threshold=threshold)
+    peaks = np.rec.fromarrays([peakFreqs, peakRms], names='freq,rms')
+
+    ok = _peakMask(freqs, power, minFreq, threshold)
+    best = np.where(ok, power, -1).argmax(axis=1)
+    found = ok[np.arange(namps), best]
+    ampFreqs = np.where(found, freqs[best], np.nan)
+    ampRms = np.where(found, np.sqrt(power[np.arange(namps), best]), np.nan)
+    ampPeaks = np.rec.fromarrays([ampFreqs, ampRms], names='freq,rms')
+
+    return peaks, ampPeaks
+
+
+def broadbandNoise(image, readRows, pixelTime, colTrim=(3, 3),
+                   rowGap=0, maxRows=1000, nperseg=4096, minFreq=100.0):
+    """Measure the noise above some frequency in the serial overscans of each amp.
+
+    For images with signal, where only the overscans can be used. No
+    frequencies are reported: the overscan spectra are aliased by the row
+    frequency (see `noiseSpectrum`), but their total power is not.
+
+    Parameters
+    ----------
+    image : `numpy.ndarray`
+        Raw CCD image.
+    readRows : (`int`, `int`)
+        The range of image rows which were read.
+    pixelTime : `float`
+        Seconds per pixel.
+    colTrim : (`int`, `int`)
+        Overscan columns to skip at the start and end of each row.
+    minFreq : `float`
+        Only count the noise above this frequency, in Hz.
+
+    See `ampStreams` and `welchSpectra` for the other parameters.
+
+    Returns
+    -------
+    rms : `numpy.ndarray`
+        The rms of each amp above minFreq, in ADU.
+    """
+    cols, namps = _overscanCols(image, colTrim)
+    streams, fillFraction = ampStreams(image, readRows, cols=cols, namps=namps,
+                                       rowGap=rowGap, maxRows=maxRows)
+    freqs, power = welchSpectra(streams, pixelTime, nperseg=nperseg,
+                                fillFraction=fillFraction)
+
+    # welchSpectra scales for sine peaks; summing bins needs the window's
+    # equivalent noise bandwidth instead.
+    nperseg = min(nperseg, streams.shape[1])
+    window = np.hanning(nperseg)
+    enbw = nperseg * (window**2).sum() / window.sum()**2
+
+    return np.sqrt(power[:, freqs >= minFreq].sum(axis=1) / enbw)
@@ -0,0 +1,117 @@
+import os
+import pathlib
+import struct
+import zlib
+
+import fitsio
+import numpy as np
+
+
+def binImage(im, binning=8):
+    """Return the binning x binning block means of an image.
+
+    Rows and columns beyond a whole number of blocks are dropped.
+
+    Args
+    ----
+    im : `numpy.ndarray`
+      The image. Not modified.
+    binning : `int`
+      The block size.
+
+    Returns
+    -------
+    binned : `numpy.ndarray`
+      float32 block means.
+    """
+
+    ny, nx = im.shape[0] // binning, im.shape[1] // binning
+    blocks = im[:ny*binning, :nx*binning].reshape(ny, binning, nx, binning)
+    sums = blocks.sum(axis=(1, 3), dtype='u4' if im.dtype.kind == 'u' else 'f8')
+    return (sums / binning**2).astype('f4')
+
+
+def scaleToBytes(im, lowPercent=1.0, highPercent=99.5, namps=8):
+    """Stretch an image to uint8 for display.
+
+    Each amp's median is removed first, so that differing bias levels do
+    not dominate, then the percentiles of the whole image set the range.
+    """
+
+    ampCols = im.shape[1] // namps
+    flat = im.astype('f4')
+    if ampCols > 0:
+        amps = flat[:, :ampCols*namps].reshape(im.shape[0], namps, ampCols)
+        amps -= np.median(amps, axis=(0, 2))[None, :, None]
+
+    lo, hi = np.percentile(flat, (lowPercent, highPercent))
+    scaled = (flat - lo) * (255.0 / max(hi - lo, 1e-6))
+    return np.clip(scaled, 0, 255).astype('u1')
+
+
+def writePng(path, im8):
+    """Write a uint8 image as a greyscale PNG, with the bottom row last as in FITS viewers. """
+
+    def chunk(tag, data):
+        body = tag + data
+        return struct.pack('>I', len(data)) + body + struct.pack('>I', zlib.crc32(body) & 0xffffffff)
+
+    height, width = im8.shape
+    rows = np.zeros((height, width + 1), dtype='u1')
+    rows[:, 1:] = im8[::-1]
+
+    png = b'\x89PNG\r\n\x1a\n'
+    png += chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 0, 0, 0, 0))
+    png += chunk(b'IDAT', zlib.compress(rows.tobytes(), 6))
+    png += chunk(b'IEND', b'')
+
+    with open(path, 'wb') as f:
+        f.write(png)
+
+
+def previewPath(rawPath, fmt='fits'):
+    """Return the path of the preview for a raw file: next to it, with a _preview suffix. """
+
+    rawPath = pathlib.Path(rawPath)
+    return rawPath.parent / f'{rawPath.stem}_preview.{fmt}'
+
+
+def writePreview(im, rawPath, binning=8, fmt='fits', cards=None):
+    """Write a binned preview of an image next to its raw file.
+
+    Args
+    ----
+    im : `numpy.ndarray`
+      The processed image. Not modified.
+    rawPath : `str` or `pathlib.Path`
+      The raw file's path.
+    binning : `int`
+      The block size.
+    fmt : `str`
+      'fits' for float32 block means, or 'png' for a stretched 8-bit image.
+    cards : sequence of fitsio card dicts
+      Extra header cards, for FITS previews.
+
+    Returns
+    -------
+    path : `pathlib.Path`
+      The preview's path.
+    """
+
+    binned = binImage(im, binning)
+    path = previewPath(rawPath, fmt)
+    tmpPath = f'{path}.tmp'
+
+    if fmt == 'png':
+        writePng(tmpPath, scaleToBytes(binned))
+    elif fmt == 'fits':
+        allCards = [dict(name='BINNING', value=binning, comment='block size of the binned means')]
+        if cards is not None:
+            allCards.extend(cards)
+        with fitsio.FITS(tmpPath, 'rw', clobber=True) as fitsFile:
+            fitsFile.write(binned, header=fitsio.FITSHDR(allCards))
+    else:
+        raise ValueError(f'unknown preview format: {fmt}')
+
+    os.replace(tmpPath, path)
+    return path
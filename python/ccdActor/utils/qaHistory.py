@@ -0,0 +1,215 @@
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+
+
+class QaHistory(object):
+    """A fixed-size ring buffer of per-amp QA metrics for recent visits.
+
+    Args
+    ----
+    maxVisits : `int`
+      How many visits to keep.
+    namps : `int`
+      Number of amps.
+    metrics : sequence of `str`
+      The per-amp fields to keep from each record.
+    path : `str`
+      Where to save ourselves. Not saved if None.
+    saveEvery : `int`
+      If set, also save after this many new visits, in case we crash.
+    minSigma : `dict`
+      Per metric, the smallest visit-to-visit sigma used to find jumps,
+      overriding `defaultMinSigma`.
+    """
+
+    # Overscan levels are medians of integers, so are quantized to whole
+    # or half ADU: a steady amp has a robust sigma of 0, and a single ADU
+    # step must not count as a jump.
+    defaultMinSigma = dict(level=0.5, noise=0.1)
+
+    def __init__(self, maxVisits=2000, namps=8, metrics=('level', 'noise'),
+                 path=None, saveEvery=0, minSigma=None):
+        self.logger = logging.getLogger('qaHistory')
+        self.lock = threading.Lock()
+        self.saveLock = threading.Lock()
+        self.maxVisits = maxVisits
+        self.namps = namps
+        self.metrics = tuple(metrics)
+        self.path = path
+        self.saveEvery = saveEvery
+        self.minSigma = dict(self.defaultMinSigma)
+        if minSigma is not None:
+            self.minSigma.update(minSigma)
+
+        self.visits = np.zeros(maxVisits, dtype='i8')
+        self.times = np.zeros(maxVisits, dtype='f8')
+        self.values = np.full((maxVisits, namps, len(self.metrics)), np.nan, dtype='f4')
+        self.nAdded = 0
+
+    def __str__(self):
+        return (f'QaHistory(visits={len(self)}/{self.maxVisits}, '
+                f'metrics={self.metrics}, path={self.path})')
+
+    def __len__(self):
+        return min(self.nAdded, self.maxVisits)
+
+    def add(self, visit, stats, t=None):
+        """Add one visit's per-amp metrics.
+
+        Args
+        ----
+        visit : `int`
+          The PFS visit number.
+        stats : `numpy.recarray` or `dict`
+          Holds at least our metrics, with one value per amp.
+        t : `float`
+          Unix time of the visit. Now by default.
+        """
+
+        if t is None:
+            t = time.time()
+        row = np.array([stats[m] for m in self.metrics], dtype='f4').T
+
+        with self.lock:
+            self._append(visit, t, row)
+            doSave = self.saveEvery > 0 and self.nAdded % self.saveEvery == 0
+
+        if doSave:
+            try:
+                self.save()
+            except Exception as e:
+                self.logger.warning('failed to save QA history to %s: %s', self.path, e)
+
+    def _append(self, visit, t, row):
+        """Add one visit's (namps, nmetrics) row. Called with the lock held. """
+
+        idx = self.nAdded % self.maxVisits
+        self.visits[idx] = visit
+        self.times[idx] = t
+        self.values[idx] = row
+        self.nAdded += 1
+
+    def recent(self, nVisits=None):
+        """Return the most recent visits, oldest first.
+
+        Returns
+        -------
+        visits : `numpy.ndarray`
+          (n,) visit numbers.
+        times : `numpy.ndarray`
+          (n,) unix times.
+        values : `numpy.ndarray`
+          (n, namps, nmetrics) metrics.
+        """
+
+        with self.lock:
+            n = len(self)
+            if nVisits is not None:
+                n = min(n, nVisits)
+            idx = (self.nAdded - n + np.arange(n)) % self.maxVisits
+            return self.visits[idx], self.times[idx], self.values[idx]
+
+    def trends(self, nVisits=None, alpha=0.1, jumpSigma=5.0):
+        """Summarize the recent behaviour of each metric for each amp.
+
+        Args
+        ----
+        nVisits : `int`
+          How many recent visits to use. All by default.
+        alpha : `float`
+          EWMA weight of the newest visit.
+        jumpSigma : `float`
+          Visit-to-visit changes larger than this many robust sigma
+          count as jumps. The sigma is at least the metric's minSigma.
+
+        Returns
+        -------
+        trends : `numpy.recarray`
+          (nmetrics, namps) with fields: n, last, mean, slope (per hour),
+          ewma, drift (ewma - median), nJumps, jumpVisit (of the last
+          jump, or -1) and jump (its size). None if we have fewer than
+          two visits.
+        """
+
+        visits, times, values = self.recent(nVisits)
+        if len(visits) < 2:
+            return None
+
+        values = values.astype('f8')
+        ok = np.isfinite(values)
+        vals = np.where(ok, values, 0.0)
+        n = ok.sum(axis=0)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = vals.sum(axis=0) / n
+            median = np.nanmedian(values, axis=0)
+            last = values[-1]
+
+            # Least-squares slope against time, per amp and metric.
+            hours = np.where(ok, (times / 3600.0)[:, None, None], 0.0)
+            hours = np.where(ok, hours - hours.sum(axis=0) / n, 0.0)
+            slope = (hours * (vals - mean)).sum(axis=0) / (hours**2).sum(axis=0)
+
+            # Exponentially weighted mean, newest visits weighted most.
+            weights = (1 - alpha)**np.arange(len(values))[::-1]
+            weights = np.where(ok, weights[:, None, None], 0.0)
+            ewma = (weights * vals).sum(axis=0) / weights.sum(axis=0)
+
+            # Jumps: visit-to-visit changes compared with their robust spread.
+            diffs = np.diff(values, axis=0)
+            mad = np.nanmedian(np.abs(diffs - np.nanmedian(diffs, axis=0)), axis=0)
+            minSigma = np.array([self.minSigma.get(m, 1e-6) for m in self.metrics])
+            isJump = np.abs(diffs) > jumpSigma * np.maximum(1.4826 * mad, minSigma)
+
+        nJumps = isJump.sum(axis=0)
+        lastJump = len(diffs) - 1 - np.argmax(isJump[::-1], axis=0)
+        jumpVisit = np.where(nJumps > 0, visits[lastJump + 1], -1)
+        jump = np.where(nJumps > 0, np.take_along_axis(diffs, lastJump[None], axis=0)[0], np.nan)
+
+        fields = [n, last, mean, slope, ewma, ewma - median, nJumps, jumpVisit, jump]
+        return np.rec.fromarrays([f.T for f in fields],
+                                 names='n,last,mean,slope,ewma,drift,nJumps,jumpVisit,jump')
+
+    def save(self, path=None):
+        """Save ourselves to an .npz file, via a temporary file.
+
+        Saves from the QA threads and at shutdown can overlap, so one
+        waits for the other.
+        """
+
+        if path is None:
+            path = self.path
+        if path is None:
+            return
+
+        with self.saveLock:
+            visits, times, values = self.recent()
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            tmpPath = f'{path}.tmp.npz'
+            np.savez(tmpPath, visits=visits, times=times, values=values,
+                     metrics=np.array(self.metrics))
+            os.replace(tmpPath, path)
+        self.logger.info('saved %d visits to %s', len(visits), path)
+
+    def load(self, path=None):
+        """Load the visits saved by `save()`, if there are any. """
+
+        if path is None:
+            path = self.path
+        if path is None or not os.path.exists(path):
+            return
+
+        with np.load(path) as saved:
+            metrics = tuple(saved['metrics'])
+            values = saved['values']
+            if metrics != self.metrics or values.shape[1] != self.namps:
+                raise ValueError(f'{path} holds {metrics} for {values.shape[1]} amps, '
+                                 f'not {self.metrics} for {self.namps}')
+            with self.lock:
+                for visit, t, row in zip(saved['visits'], saved['times'], values):
+                    self._append(visit, t, row)
+        self.logger.info('loaded %d visits from %s', len(self), path)
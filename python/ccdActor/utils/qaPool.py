@@ -0,0 +1,142 @@
+import concurrent.futures
+import logging
+import threading
+
+
+class QaJob(object):
+    """One QA computation, and who to tell about it.
+
+    Exactly one of onDone, onFail or onTimeout is called. onFinished is
+    always called once the function has actually returned, even after a
+    timeout: that is when any shared inputs can be released.
+
+    The timeout runs from when the function starts, not from when the
+    job was queued.
+    """
+
+    def __init__(self, name, func, args, kwargs,
+                 onDone=None, onFail=None, onTimeout=None, onFinished=None,
+                 timeout=None):
+        self.name = name
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.onDone = onDone
+        self.onFail = onFail
+        self.onTimeout = onTimeout
+        self.onFinished = onFinished
+        self.timeout = timeout
+
+        self.lock = threading.Lock()
+        self.reported = False
+        self.timer = None
+
+    def __str__(self):
+        return f'QaJob({self.name})'
+
+    def _claim(self):
+        """Return True the first time we are asked: only one outcome is reported. """
+
+        with self.lock:
+            if self.reported:
+                return False
+            self.reported = True
+            return True
+
+    def run(self):
+        if self.timeout is not None and self.timeout > 0:
+            self.timer = threading.Timer(self.timeout, self.timedOut)
+            self.timer.daemon = True
+            self.timer.start()
+
+        try:
+            ret = self.func(*self.args, **self.kwargs)
+        except Exception as e:
+            if self._claim() and self.onFail is not None:
+                self.onFail(e)
+        else:
+            if self._claim() and self.onDone is not None:
+                self.onDone(ret)
+        finally:
+            if self.timer is not None:
+                self.timer.cancel()
+            if self.onFinished is not None:
+                self.onFinished()
+
+    def timedOut(self):
+        if self._claim() and self.onTimeout is not None:
+            self.onTimeout()
+
+
+class QaPool(object):
+    """Run post-readout QA on worker threads.
+
+    The inputs (images, mostly) are shared with the caller, not copied:
+    callers must keep them valid until the job's onFinished is called.
+
+    Args
+    ----
+    nWorkers : `int`
+      Number of worker threads.
+    queueDepth : `int`
+      How many jobs can be queued or running. Beyond that, new jobs are
+      refused rather than delaying the caller.
+    timeout : `float`
+      Seconds after a job starts running at which its onTimeout is
+      called, and its eventual result dropped.
+    """
+
+    def __init__(self, nWorkers=2, queueDepth=4, timeout=30.0):
+        self.logger = logging.getLogger('qaPool')
+        self.nWorkers = nWorkers
+        self.queueDepth = queueDepth
+        self.timeout = timeout
+
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=nWorkers,
+                                                              thread_name_prefix='qa')
+        self.slots = threading.BoundedSemaphore(queueDepth)
+
+    def __str__(self):
+        return (f'QaPool(nWorkers={self.nWorkers}, queueDepth={self.queueDepth}, '
+                f'timeout={self.timeout})')
+
+    def stop(self):
+        self.executor.shutdown(wait=True)
+
+    def submit(self, name, func, *args,
+               onDone=None, onFail=None, onTimeout=None, onFinished=None,
+               **kwargs):
+        """Queue func(*args, **kwargs).
+
+        Args
+        ----
+        name : `str`
+          What to call the job in messages.
+        onDone : callable
+          Called with the function's return value.
+        onFail : callable
+          Called with the exception if the function raised one.
+        onTimeout : callable
+          Called with no arguments if the function has not returned in time.
+        onFinished : callable
+          Called with no arguments once the function has returned.
+
+        Returns
+        -------
+        queued : `bool`
+          False if the queue was full, in which case none of the callbacks
+          will be called.
+        """
+
+        if not self.slots.acquire(blocking=False):
+            self.logger.warning('QA queue full, dropping %s', name)
+            return False
+
+        job = QaJob(name, func, args, kwargs,
+                    onDone=onDone, onFail=onFail,
+                    onTimeout=onTimeout, onFinished=onFinished,
+                    timeout=self.timeout)
+
+        future = self.executor.submit(job.run)
+        future.add_done_callback(lambda f: self.slots.release())
+        return True
@@ -0,0 +1,221 @@
+import json
+import logging
+import os
+import pathlib
+import shutil
+import threading
+import time
+
+import ccdActor.utils.fitsWriter as fitsWriter
+
+
+class FileMover(object):
+    """Move files written to a fast local spool directory to their final paths.
+
+    Files are written and fsync-ed in the spool, then handed to us. A
+    single background thread copies each to a temporary file next to its
+    final path, fsyncs it, renames it into place, and only then deletes
+    the spool copy. A file is never missing from both places.
+
+    The queue of pending moves is saved to a JSON file every time it
+    changes, so a restarted actor picks up where the last one stopped.
+    Failed moves are retried with an exponential backoff; the others keep
+    moving meanwhile.
+
+    Args
+    ----
+    spoolDir : `str` or `pathlib.Path`
+      The local spool directory.
+    queuePath : `str` or `pathlib.Path`
+      Where to save the queue. By default, in the spool directory.
+    minBackoff, maxBackoff : `float`
+      The first and the longest wait before retrying a failed move, in seconds.
+    onMoved : callable
+      Called with (spoolPath, finalPath, info) after each move, info
+      being whatever was passed to `submit()`.
+    onDepth : callable
+      Called with the `depth()` tuple whenever it changes.
+    """
+
+    def __init__(self, spoolDir, queuePath=None, minBackoff=2.0, maxBackoff=300.0,
+                 onMoved=None, onDepth=None):
+        self.logger = logging.getLogger('spool')
+        self.spoolDir = pathlib.Path(spoolDir)
+        self.spoolDir.mkdir(mode=0o2755, parents=True, exist_ok=True)
+        self.queuePath = pathlib.Path(queuePath) if queuePath is not None else self.spoolDir / 'moveQueue.json'
+        self.minBackoff = minBackoff
+        self.maxBackoff = maxBackoff
+        self.onMoved = onMoved
+        self.onDepth = onDepth
+
+        self.cond = threading.Condition()
+        self.entries = []
+        self.thread = None
+        self.running = False
+
+        self.load()
+
+    def __str__(self):
+        nFiles, nBytes, nFailing = self.depth()
+        return (f'FileMover(spool={self.spoolDir}, pending={nFiles}, '
+                f'MB={nBytes/1e6:0.1f}, failing={nFailing})')
+
+    def spoolPath(self, finalPath):
+        """Return where to write a file which should end up at finalPath. """
+
+        return self.spoolDir / pathlib.Path(finalPath).name
+
+    def depth(self):
+        """Return the number of files waiting to be moved, their total size, and how many have failed. """
+
+        with self.cond:
+            entries = list(self.entries)
+        nBytes = 0
+        for entry in entries:
+            try:
+                nBytes += os.path.getsize(entry['spoolPath'])
+            except OSError:
+                pass
+        nFailing = sum(1 for entry in entries if entry['attempts'] > 0)
+        return len(entries), nBytes, nFailing
+
+    def start(self):
+        if self.thread is not None:
+            return
+
+        self.running = True
+        self.thread = threading.Thread(target=self._loop, name='fileMover', daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout=None):
+        """Stop after any move in progress. The rest stay queued for next time. """
+
+        if self.thread is None:
+            return
+
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        self.thread.join(timeout)
+        self.thread = None
+
+    def submit(self, spoolPath, finalPath, info=None):
+        """Queue a spooled file to be moved to its final path.
+
+        info, a JSON-able `dict`, is saved with the queue and handed to
+        onMoved, so that it survives an actor restart.
+        """
+
+        entry = dict(spoolPath=str(spoolPath), finalPath=str(finalPath),
+                     attempts=0, nextTry=0.0, error=None, info=info or dict())
+        with self.cond:
+            self.entries.append(entry)
+            self.save()
+            self.cond.notify()
+        self._reportDepth()
+
+    def retryNow(self):
+        """Retry all failed moves now, without waiting for their backoff. """
+
+        with self.cond:
+            for entry in self.entries:
+                entry['nextTry'] = 0.0
+            self.cond.notify()
+
+    def save(self):
+        """Save the queue, via a temporary file. Must be called with the lock held. """
+
+        tmpPath = f'{self.queuePath}.tmp'
+        with open(tmpPath, 'w') as f:
+            json.dump(self.entries, f, indent=1)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmpPath, self.queuePath)
+
+    def load(self):
+        """Load the queue saved by a previous actor, dropping moves which had completed. """
+
+        if not self.queuePath.exists():
+            return
+
+        with open(self.queuePath) as f:
+            entries = json.load(f)
+
+        with self.cond:
+            self.entries = []
+            for entry in entries:
+                if not os.path.exists(entry['spoolPath']):
+                    if not os.path.exists(entry['finalPath']):
+                        self.logger.error('%s was lost: neither it nor %s exist',
+                                          entry['spoolPath'], entry['finalPath'])
+                    continue
+                entry['nextTry'] = 0.0
+                self.entries.append(entry)
+            self.save()
+        self.logger.info('loaded %d pending moves from %s', len(self.entries), self.queuePath)
+
+    def _nextEntry(self):
+        """Wait for an entry which is due to be tried, or for a stop. Called with the lock held. """
+
+        while self.running:
+            now = time.time()
+            due = [entry for entry in self.entries if entry['nextTry'] <= now]
+            if due:
+                return due[0]
+            wait = min(entry['nextTry'] for entry in self.entries) - now if self.entries else None
+            self.cond.wait(wait)
+        return None
+
+    def _loop(self):
+        while True:
+            with self.cond:
+                entry = self._nextEntry()
+            if entry is None:
+                return
+
+            try:
+                self._move(entry['spoolPath'], entry['finalPath'])
+            except Exception as e:
+                self._failed(entry, e)
+                continue
+
+            with self.cond:
+                self.entries.remove(entry)
+                self.save()
+            self.logger.info('moved %s to %s', entry['spoolPath'], entry['finalPath'])
+            self._reportDepth()
+
+            if self.onMoved is not None:
+                try:
+                    self.onMoved(entry['spoolPath'], entry['finalPath'], entry.get('info', dict()))
+                except Exception as e:
+                    self.logger.warning('onMoved failed for %s: %s', entry['finalPath'], e)
+
+    def _move(self, spoolPath, finalPath):
+        finalPath = pathlib.Path(finalPath)
+        finalPath.parent.mkdir(mode=0o2755, parents=True, exist_ok=True)
+
+        tmpPath = finalPath.parent / f'.{finalPath.name}.tmp'
+        shutil.copyfile(spoolPath, tmpPath)
+        fitsWriter.fsyncPath(tmpPath)
+        os.replace(tmpPath, finalPath)
+        fitsWriter.fsyncPath(finalPath)
+        os.unlink(spoolPath)
+
+    def _failed(self, entry, e):
+        with self.cond:
+            entry['attempts'] += 1
+            backoff = min(self.maxBackoff, self.minBackoff * 2**(entry['attempts'] - 1))
+            entry['nextTry'] = time.time() + backoff
+            entry['error'] = str(e)
+            self.save()
+        self.logger.warning('failed to move %s to %s (attempt %d, retrying in %0.1fs): %s',
+                            entry['spoolPath'], entry['finalPath'], entry['attempts'], backoff, e)
+        self._reportDepth()
+
+    def _reportDepth(self):
+        if self.onDepth is not None:
+            try:
+                self.onDepth(self.depth())
+            except Exception as e:
+                self.logger.warning('onDepth failed: %s', e)
@@ -0,0 +1,144 @@
+import numpy as np
+
+import ccdActor.utils.basicQA as basicQA
+
+
+class StreamingOverscanQA(object):
+    """Accumulate per-amp overscan statistics while an image is being read.
+
+    Meant to be called from the readout row callback: every `bandRows`
+    rows the new band is folded into per-amp overscan histograms, and
+    checked for amps which have gone to zero or saturated. Once the last
+    row is in, `finish()` returns the same level/noise as
+    `basicQA.serialOverscanStats` would for the full image.
+
+    Args
+    ----
+    bandRows : `int`
+      How many rows to wait for before processing a band.
+    colTrim : (`int`, `int`)
+      Overscan columns to ignore at each side, as for `perAmpSerialOverScan`.
+    namps : `int`
+      Number of amps across the raw image.
+    zeroFrac, satFrac : `float`
+      Flag an amp if more than this fraction of a band's pixels are 0,
+      or at or above `saturation`.
+    saturation : `int`
+      The saturation level.
+    """
+
+    def __init__(self, bandRows=100, colTrim=(3, 3), namps=8,
+                 zeroFrac=0.5, satFrac=0.5, saturation=65535):
+        self.bandRows = bandRows
+        self.colTrim = colTrim
+        self.namps = namps
+        self.zeroFrac = zeroFrac
+        self.satFrac = satFrac
+        self.saturation = saturation
+
+        self.hist = None
+        self.doneRows = 0
+        self.flagged = set()
+        self.failed = None
+
+    def __str__(self):
+        return (f'StreamingOverscanQA(doneRows={self.doneRows}, '
+                f'flagged={sorted(self.flagged)}, failed={self.failed})')
+
+    def update(self, line, image):
+        """Process any complete band of rows.
+
+        Args
+        ----
+        line : `int`
+          The last row which has been read.
+        image : `numpy.ndarray`
+          The image being filled.
+
+        Returns
+        -------
+        anomalies : `list` of `str`
+          Descriptions of newly flagged amps.
+        """
+
+        if self.failed is not None:
+            return []
+
+        nrows = line + 1
+        if nrows - self.doneRows < self.bandRows and nrows < image.shape[0]:
+            return []
+
+        try:
+            anomalies = self._processBand(image, self.doneRows, nrows)
+        except Exception as e:
+            self.failed = e
+            return [f'streaming QA disabled: {e}']
+
+        self.doneRows = nrows
+        return anomalies
+
+    def _processBand(self, image, row0, row1):
+        osStack = basicQA.overscanStack(image)
+        if osStack is None:
+            raise RuntimeError('overscans are not one strided view')
+        osRow0 = basicQA.overscanGeometry(image)[0]
+
+        band = osStack[max(row0-osRow0, 0):max(row1-osRow0, 0)]
+        band = band[:, :, self.colTrim[0]:band.shape[2]-self.colTrim[1]]
+        if band.shape[0] > 0:
+            hist = basicQA.ampHistograms(band)
+            if self.hist is None:
+                self.hist = hist
+            else:
+                self.hist += hist
+
+        return self._checkBand(image[row0:row1], row0, row1)
+
+    def _checkBand(self, band, row0, row1):
+        """Flag amps whose pixels are mostly 0 or saturated. Samples every 4th column. """
+
+        ampCols = band.shape[1] // self.namps
+        amps = band[:, :ampCols*self.namps].reshape(band.shape[0], self.namps, ampCols)[:, :, ::4]
+        npix = amps.shape[0] * amps.shape[2]
+        if npix == 0:
+            return []
+
+        zeros = (amps == 0).sum(axis=(0, 2)) / npix
+        sats = (amps >= self.saturation).sum(axis=(0, 2)) / npix
+
+        anomalies = []
+        for amp in np.where(zeros > self.zeroFrac)[0]:
+            if (amp, 'zero') not in self.flagged:
+                self.flagged.add((amp, 'zero'))
+                anomalies.append(f'amp {amp} is reading 0 at rows {row0}-{row1-1}')
+        for amp in np.where(sats > self.satFrac)[0]:
+            if (amp, 'saturated') not in self.flagged:
+                self.flagged.add((amp, 'saturated'))
+                anomalies.append(f'amp {amp} is saturated at rows {row0}-{row1-1}')
+
+        return anomalies
+
+    def finish(self, ampOrder=None):
+        """Return the overscan statistics for all the rows seen.
+
+        Args
+        ----
+        ampOrder : sequence of `int`
+          If set, the raw amp index for each output amp, to follow any
+          amp reordering done after readout.
+
+        Returns
+        -------
+        stats : `numpy.recarray` or `None`
+          level and noise per amp, as from `basicQA.serialOverscanStats`.
+          None if we failed or saw no rows.
+        """
+
+        if self.failed is not None or self.hist is None:
+            return None
+
+        stats = basicQA.histogramStats(self.hist)
+        level, noise = stats.median, stats.stddev
+        if ampOrder is not None:
+            level, noise = level[ampOrder], noise[ampOrder]
+        return np.rec.fromarrays([level, noise], names='level,noise')
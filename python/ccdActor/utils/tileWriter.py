@@ -0,0 +1,328 @@
+import concurrent.futures
+import contextlib
+import gzip
+import logging
+import os
+import warnings
+
+import astropy.io.fits as pyfits
+import numpy as np
+
+import ccdActor.utils.fitsChecksum as fitsChecksum
+
+try:
+    from astropy.io.fits.hdu.compressed._compression import compress_rice_1_c
+except ImportError:
+    # astropy < 6
+    from astropy.io.fits._tiled_compression._compression import compress_rice_1_c
+
+# The codecs we can write ourselves. All of them release the GIL while
+# compressing, so threads are enough. None is an uncompressed image HDU.
+CODECS = {'RICE': 'RICE_1', 'RICE_1': 'RICE_1',
+          'GZIP': 'GZIP_1', 'GZIP_1': 'GZIP_1',
+          'GZIP_2': 'GZIP_2',
+          None: None}
+
+
+def canWrite(im, compression):
+    """Whether `TileWriter.write` can write this image with these fitsio compression arguments. """
+
+    if compression is None:
+        compression = dict(compress='RICE')
+    if compression.get('compress', None) not in CODECS:
+        return False
+    if set(compression.keys()) - {'compress', 'tile_dims'}:
+        return False
+    tileDims = compression.get('tile_dims', None)
+    if tileDims is not None and (len(tileDims) != 2 or tileDims[1] != im.shape[1]):
+        return False
+    return im.ndim == 2 and im.dtype in (np.uint16, np.int16)
+
+
+def _storedPixels(im):
+    """Return the int16 pixel values as stored in FITS: uint16 is offset by BZERO=32768. """
+
+    if im.dtype == np.uint16:
+        return (im ^ 0x8000).view('i2')
+    return im
+
+
+def _compressTile(stored, codec):
+    """Compress one tile of native int16 stored pixels. """
+
+    if codec == 'RICE_1':
+        return compress_rice_1_c(np.ascontiguousarray(stored).tobytes(), 32, 2)
+
+    bigEndian = np.ascontiguousarray(stored, dtype='>i2')
+    if codec == 'GZIP_2':
+        bigEndian = bigEndian.view('u1').reshape(-1, 2).T
+    return gzip.compress(bigEndian.tobytes(), compresslevel=6, mtime=0)
+
+
+def _plainBand(im, row0, row1):
+    """Return the big-endian stored bytes of some rows, and their checksum. """
+
+    band = np.ascontiguousarray(_storedPixels(im[row0:row1]), dtype='>i2')
+    return band, fitsChecksum.checksum(band)
+
+
+def _compressBand(im, row0, row1, tileRows, codec):
+    """Compress the tiles starting in rows row0..row1-1.
+
+    Returns
+    -------
+    tiles : `list` of `bytes`
+    sum : `int`
+      The checksum of all the tile bytes laid end to end.
+    """
+
+    tiles = []
+    running = fitsChecksum.RunningChecksum()
+    for r0 in range(row0, row1, tileRows):
+        tile = _compressTile(_storedPixels(im[r0:min(r0+tileRows, im.shape[0])]), codec)
+        running.update(tile)
+        tiles.append(tile)
+    return tiles, running.sum
+
+
+def _makeHeader(cards, required, checksum=None, datasum=None):
+    """Return the padded header bytes for the given required and user cards. """
+
+    hdr = pyfits.Header()
+    for name, value, comment in required:
+        hdr.append(pyfits.Card(name, value, comment))
+
+    with warnings.catch_warnings():
+        # Long keyword names become HIERARCH cards, as with fitsio.
+        warnings.simplefilter('ignore', pyfits.verify.VerifyWarning)
+        for card in cards or []:
+            name = card['name']
+            if name.upper() == 'COMMENT':
+                hdr.add_comment(card['value'])
+            elif name.upper() == 'HISTORY':
+                hdr.add_history(card['value'])
+            else:
+                hdr.append(pyfits.Card(name, card.get('value', None), card.get('comment', '')))
+
+    hdr.append(pyfits.Card('CHECKSUM', checksum or '0'*16, 'HDU checksum'))
+    hdr.append(pyfits.Card('DATASUM', str(datasum if datasum is not None else 0), 'data unit checksum'))
+
+    return hdr.tostring(endcard=True, padding=True).encode('ascii')
+
+
+def _writeHdu(f, required, cards, dataSum, writeData, dataSize):
+    """Write one HDU, with its checksum cards, and return its total checksum.
+
+    The data checksum must already be known: the header is written with
+    it, and only the header needs to be summed here.
+    """
+
+    header = _makeHeader(cards, required, datasum=dataSum)
+    hdrSum = fitsChecksum.checksum(header)
+    hduSum = fitsChecksum.add(hdrSum, dataSum)
+    header = _makeHeader(cards, required, checksum=fitsChecksum.encode(hduSum), datasum=dataSum)
+
+    f.write(header)
+    writeData(f)
+    pad = -dataSize % 2880
+    if pad:
+        f.write(b'\0' * pad)
+
+    return hduSum
+
+
+class TileWriter(object):
+    """Write PFS raw files with tile-compressed image HDUs, compressing tiles in parallel.
+
+    The tiles are compressed by a thread pool, then assembled in order
+    into a standard FITS tile-compressed binary table. The CHECKSUM and
+    DATASUM cards are calculated from the compressed bytes as they are
+    produced, so the file never needs to be re-read. Uncompressed images
+    are converted and summed in bands of rows, in the same way.
+
+    Args
+    ----
+    nThreads : `int`
+      Number of compression threads. By default, one per core.
+    bandRows : `int`
+      How many image rows each thread compresses at a time.
+    """
+
+    def __init__(self, nThreads=None, bandRows=128):
+        self.logger = logging.getLogger('tileWriter')
+        if nThreads is None:
+            nThreads = os.cpu_count() or 1
+        self.nThreads = nThreads
+        self.bandRows = bandRows
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=nThreads,
+                                                              thread_name_prefix='tiles')
+
+    def __str__(self):
+        return f'TileWriter(nThreads={self.nThreads}, bandRows={self.bandRows})'
+
+    def stop(self):
+        self.executor.shutdown(wait=True)
+
+    def compressTiles(self, im, tileRows=1, codec='RICE_1'):
+        """Compress all the tiles of an image.
+
+        Returns
+        -------
+        tiles : `list` of `bytes`
+          The compressed tiles, in order.
+        heapSum : `int`
+          The checksum of the tiles laid end to end.
+        """
+
+        bandRows = max(tileRows, self.bandRows // tileRows * tileRows)
+        futures = [self.executor.submit(_compressBand, im, r0, min(r0 + bandRows, im.shape[0]),
+                                        tileRows, codec)
+                   for r0 in range(0, im.shape[0], bandRows)]
+
+        tiles = []
+        heap = fitsChecksum.RunningChecksum()
+        for future in futures:
+            bandTiles, bandSum = future.result()
+            heap.addSum(bandSum, sum(len(t) for t in bandTiles))
+            tiles.extend(bandTiles)
+
+        return tiles, heap.sum
+
+    def plainBands(self, im):
+        """Convert an image to big-endian FITS pixels, in bands of rows.
+
+        Returns
+        -------
+        bands : `list` of `numpy.ndarray`
+          The stored pixels, in order.
+        dataSum : `int`
+          The checksum of the bands laid end to end.
+        """
+
+        futures = [self.executor.submit(_plainBand, im, r0, min(r0 + self.bandRows, im.shape[0]))
+                   for r0 in range(0, im.shape[0], self.bandRows)]
+
+        bands = []
+        data = fitsChecksum.RunningChecksum()
+        for future in futures:
+            band, bandSum = future.result()
+            data.addSum(bandSum, band.nbytes)
+            bands.append(band)
+
+        return bands, data.sum
+
+    def write(self, filepath, im, cards, imageCards, compression=None, timings=None):
+        """Write a PFS raw file: an empty PHDU and one image HDU.
+
+        Takes the same arguments as `fitsWriter.writeFits`, which calls
+        us for compressions we know (see `canWrite`). The file is fsync-ed
+        before we return.
+        """
+
+        def phase(name):
+            return timings.phase(name) if timings is not None else contextlib.nullcontext()
+
+        if compression is None:
+            compression = dict(compress='RICE')
+        codec = CODECS[compression['compress']]
+        tileDims = compression.get('tile_dims', None)
+        tileRows = tileDims[0] if tileDims is not None else 1
+
+        if codec is None:
+            imageHdu, dataSize, writeImageData, dataSum = self._plainHdu(im, phase)
+        else:
+            imageHdu, dataSize, writeImageData, dataSum = self._compressedHdu(im, codec, tileRows, phase)
+        if im.dtype == np.uint16:
+            imageHdu.extend([('BZERO', 32768, 'offset data range to that of unsigned short'),
+                             ('BSCALE', 1, 'default scaling factor')])
+        imageHdu.append(('EXTNAME', 'image', ''))
+
+        primary = [('SIMPLE', True, 'conforms to FITS standard'),
+                   ('BITPIX', 8, 'array data type'),
+                   ('NAXIS', 0, 'number of array dimensions'),
+                   ('EXTEND', True, '')]
+
+        with phase('write'):
+            with open(filepath, 'wb') as f:
+                _writeHdu(f, primary, cards, 0, lambda f: None, 0)
+                _writeHdu(f, imageHdu, imageCards, dataSum, writeImageData, dataSize)
+                f.flush()
+                os.fsync(f.fileno())
+
+            dirFd = os.open(os.path.dirname(str(filepath)) or '.', os.O_RDONLY)
+            try:
+                os.fsync(dirFd)
+            finally:
+                os.close(dirFd)
+
+        return filepath
+
+    def _plainHdu(self, im, phase):
+        """Prepare an uncompressed image HDU. """
+
+        with phase('write'):
+            bands, dataSum = self.plainBands(im)
+
+        nrows, ncols = im.shape
+        imageHdu = [('XTENSION', 'IMAGE', 'image extension'),
+                    ('BITPIX', 16, 'array data type'),
+                    ('NAXIS', 2, 'number of array dimensions'),
+                    ('NAXIS1', ncols, ''),
+                    ('NAXIS2', nrows, ''),
+                    ('PCOUNT', 0, 'number of parameters'),
+                    ('GCOUNT', 1, 'number of groups')]
+
+        def writeData(f):
+            for band in bands:
+                f.write(band.tobytes())
+
+        return imageHdu, im.size * 2, writeData, dataSum
+
+    def _compressedHdu(self, im, codec, tileRows, phase):
+        """Prepare a tile-compressed image HDU: a binary table of compressed tiles. """
+
+        with phase('write'):
+            tiles, heapSum = self.compressTiles(im, tileRows=tileRows, codec=codec)
+
+        with phase('checksum'):
+            sizes = np.array([len(t) for t in tiles], dtype='>i4')
+            offsets = np.zeros(len(tiles), dtype='>i4')
+            np.cumsum(sizes[:-1], out=offsets[1:])
+            descriptors = np.empty((len(tiles), 2), dtype='>i4')
+            descriptors[:, 0] = sizes
+            descriptors[:, 1] = offsets
+
+            heapSize = int(sizes.sum(dtype='i8'))
+            dataSum = fitsChecksum.add(fitsChecksum.checksum(descriptors), heapSum)
+
+        nrows, ncols = im.shape
+        imageHdu = [('XTENSION', 'BINTABLE', 'binary table extension'),
+                    ('BITPIX', 8, '8-bit bytes'),
+                    ('NAXIS', 2, '2-dimensional binary table'),
+                    ('NAXIS1', 8, 'width of table in bytes'),
+                    ('NAXIS2', len(tiles), 'number of rows in table'),
+                    ('PCOUNT', heapSize, 'size of special data area'),
+                    ('GCOUNT', 1, 'one data group (required keyword)'),
+                    ('TFIELDS', 1, 'number of fields in each row'),
+                    ('TTYPE1', 'COMPRESSED_DATA', 'label for field 1'),
+                    ('TFORM1', f'1PB({int(sizes.max())})', 'data format of field: variable length array'),
+                    ('ZIMAGE', True, 'extension contains compressed image'),
+                    ('ZBITPIX', 16, 'data type of original image'),
+                    ('ZNAXIS', 2, 'dimension of original image'),
+                    ('ZNAXIS1', ncols, 'length of original image axis'),
+                    ('ZNAXIS2', nrows, 'length of original image axis'),
+                    ('ZTILE1', ncols, 'size of tiles to be compressed'),
+                    ('ZTILE2', tileRows, 'size of tiles to be compressed'),
+                    ('ZCMPTYPE', codec, 'compression algorithm')]
+        if codec == 'RICE_1':
+            imageHdu.extend([('ZNAME1', 'BLOCKSIZE', 'compression block size'),
+                             ('ZVAL1', 32, 'pixels per block'),
+                             ('ZNAME2', 'BYTEPIX', 'bytes per pixel (1, 2, 4, or 8)'),
+                             ('ZVAL2', 2, 'bytes per pixel (1, 2, 4, or 8)')])
+
+        def writeData(f):
+            f.write(descriptors.tobytes())
+            for tile in tiles:
+                f.write(tile)
+
+        return imageHdu, descriptors.nbytes + heapSize, writeData, dataSum
@@ -0,0 +1,159 @@
+import collections
+import contextlib
+import threading
+import time
+
+import numpy as np
+
+# The phases of an exposure we time, in the order they are reported.
+# 'header' includes 'feeCards', and 'write' does not include 'checksum'.
+PHASES = ('wipe', 'integration', 'readout', 'fixup', 'qa',
+          'header', 'feeCards', 'write', 'checksum')
+
+
+class ExposureTimings(object):
+    """Monotonic timestamps for the phases of one exposure.
+
+    Phases can be timed from several threads. Repeated phases (the two
+    checksum passes, say) accumulate.
+
+    Args
+    ----
+    waitFor : sequence of `str`
+      Parts of the exposure which must call `finished()` before the
+      timings are complete. Used when these run in other threads.
+    onComplete : callable
+      Called with this object once all of waitFor are finished.
+    """
+
+    def __init__(self, waitFor=(), onComplete=None):
+        self.lock = threading.Lock()
+        self.starts = dict()
+        self.ends = dict()
+        self.durations = dict()
+
+        self.waitFor = set(waitFor)
+        self.onComplete = onComplete
+
+    def __str__(self):
+        return ' '.join([f'{p}={d:0.3f}' for p, d in zip(PHASES, self.getDurations())])
+
+    def start(self, phase, t=None):
+        """(Re)start timing a phase which will be closed by `end()`. """
+
+        if t is None:
+            t = time.monotonic()
+        with self.lock:
+            self.starts[phase] = t
+            self.ends[phase] = None
+
+    def end(self, phase, t=None):
+        if t is None:
+            t = time.monotonic()
+        with self.lock:
+            t0 = self.starts.get(phase, None)
+            if t0 is None or self.ends.get(phase, None) is not None:
+                return
+            self.ends[phase] = t
+            self.durations[phase] = self.durations.get(phase, 0.0) + (t - t0)
+
+    def add(self, phase, t0, t1):
+        """Add an interval which has already been measured. """
+
+        with self.lock:
+            self.starts.setdefault(phase, t0)
+            self.ends[phase] = t1
+            self.durations[phase] = self.durations.get(phase, 0.0) + (t1 - t0)
+
+    @contextlib.contextmanager
+    def phase(self, phase):
+        """Time the enclosed block as the given phase. """
+
+        t0 = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add(phase, t0, time.monotonic())
+
+    def getDurations(self, phases=PHASES):
+        """Return the phase durations, with NaN for phases which did not run. """
+
+        with self.lock:
+            return [self.durations.get(p, np.nan) for p in phases]
+
+    def getTotal(self):
+        """Return the time from the first start to the last end. """
+
+        with self.lock:
+            starts = list(self.starts.values())
+            ends = [t for t in self.ends.values() if t is not None]
+        if not starts or not ends:
+            return np.nan
+        return max(ends) - min(starts)
+
+    def finished(self, part):
+        """Declare that one of our waitFor parts is done. """
+
+        with self.lock:
+            if part not in self.waitFor:
+                return
+            self.waitFor.discard(part)
+            complete = not self.waitFor
+
+        if complete and self.onComplete is not None:
+            self.onComplete(self)
+
+
+class TimingHistory(object):
+    """A rolling history of exposure timings.
+
+    Args
+    ----
+    maxlen : `int`
+      How many exposures to keep.
+    """
+
+    def __init__(self, maxlen=500):
+        self.lock = threading.Lock()
+        self.history = collections.deque(maxlen=maxlen)
+
+    def __len__(self):
+        return len(self.history)
+
+    def add(self, visit, timings):
+        row = timings.getDurations() + [timings.getTotal()]
+        with self.lock:
+            self.history.append((visit, row))
+
+    def summary(self, nVisits=None):
+        """Summarize the recent history.
+
+        Args
+        ----
+        nVisits : `int`
+          How many of the most recent exposures to use. All by default.
+
+        Returns
+        -------
+        summary : `list` of (phase, n, p50, p95, max)
+          One entry per phase, then one for the total.
+        """
+
+        with self.lock:
+            rows = [r for v, r in self.history]
+        if nVisits is not None:
+            rows = rows[-nVisits:]
+        if not rows:
+            return []
+
+        allTimes = np.array(rows, dtype='f8')
+        summary = []
+        for p_i, phase in enumerate(PHASES + ('total',)):
+            times = allTimes[:, p_i]
+            times = times[np.isfinite(times)]
+            if len(times) == 0:
+                continue
+            p50, p95 = np.percentile(times, (50.0, 95.0))
+            summary.append((phase, len(times), p50, p95, times.max()))
+
+        return summary
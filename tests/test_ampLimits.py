@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+
+from ccdActor.utils import ampLimits
+
+
+def makeLimits(namps=3):
+    ampsConfig = {str(a): dict(serialOverscanLevelLim=(100, 1000),
+                               serialOverscanNoiseLim=(2, 10)) for a in range(namps)}
+    return ampLimits.AmpLimits(ampsConfig)
+
+
+def test_checkBitmask():
+    limits = makeLimits(6)
+    stats = dict(level=[500, 50, 1500, 500, 100, np.nan],
+                 noise=[5, 5, 5, 1, 20, 5])
+    mask = limits.check(stats)
+
+    # bit 0: level low, 1: level high, 2: noise low, 3: noise high.
+    assert list(mask) == [0, 0b0001, 0b0010, 0b0100, 0b1001, 0b0011]
+    assert limits.describe(mask[4]) == [('level', 'low'), ('noise', 'high')]
+    assert limits.describe(mask[0]) == []
+
+
+def test_recarrayStats():
+    limits = makeLimits()
+    stats = np.rec.fromarrays([[500, 500, 500], [5, 11, 5]], names='level,noise')
+    assert list(limits.check(stats)) == [0, 0b1000, 0]
+
+
+def test_badConfig():
+    with pytest.raises(ValueError):
+        ampLimits.AmpLimits({'0': dict(serialOverscanLevelLim=(100, 1000))})
+    with pytest.raises(ValueError):
+        ampLimits.AmpLimits({'0': dict(serialOverscanLevelLim=(1000, 100),
+                                       serialOverscanNoiseLim=(2, 10))})
@@ -0,0 +1,48 @@
+"""Check the one-pass histogram statistics against numpy. """
+
+import numpy as np
+import pytest
+
+pytest.importorskip('fpga.geom')
+
+from ccdActor.utils import basicQA
+
+
+@pytest.fixture
+def stack():
+    rng = np.random.default_rng(3)
+    stack = rng.normal(1000, 5, size=(200, 8, 64))
+    stack[:, 5] = rng.normal(20000, 300, size=(200, 64))
+    stack[:3, 7, :4] = 65535
+    stack[10, 2, 1] = 0
+    return np.round(stack).astype('u2')
+
+
+def test_ampStatsMatchNumpy(stack):
+    stats = basicQA.ampStats(stack)
+
+    for amp in range(stack.shape[1]):
+        pix = stack[:, amp].astype('f8')
+        assert stats.npix[amp] == pix.size
+        assert stats.average[amp] == pytest.approx(pix.mean())
+        assert stats.stddev[amp] == pytest.approx(pix.std())
+        assert stats.median[amp] == np.median(pix)
+        assert stats.rms[amp] == pytest.approx(basicQA.robustRms(pix))
+        assert stats.minval[amp] == pix.min()
+        assert stats.maxval[amp] == pix.max()
+    assert list(stats.nsat) == [0, 0, 0, 0, 0, 0, 0, 12]
+
+
+def test_evenCountMedianInterpolates():
+    stack = np.array([1, 2, 10, 11], dtype='u2').reshape(4, 1, 1)
+    stats = basicQA.ampStats(stack)
+    assert stats.median[0] == 6.0 == np.median(stack)
+
+
+def test_emptyAmpIsNan():
+    hist = np.zeros((2, 16), dtype='i8')
+    hist[0, 3] = 5
+    stats = basicQA.histogramStats(hist, saturation=15)
+    assert stats.median[0] == 3 and stats.stddev[0] == 0
+    assert stats.npix[1] == 0
+    assert np.isnan(stats.average[1]) and np.isnan(stats.median[1]) and np.isnan(stats.stddev[1])
@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('fitsio')
+
+from ccdActor.utils import combiner
+
+
+def makeStack(nFrames=7, shape=(50, 40)):
+    rng = np.random.default_rng(5)
+    stack = np.round(rng.normal(1000, 4, size=(nFrames,) + shape)).astype('u2')
+    stack[2, 10, 10] = 30000
+    stack[4, 20, 5] = 9000
+    stack[1, 30, 30] = 10
+    return stack
+
+
+def combine(stack, **kwargs):
+    comb = combiner.FrameCombiner(tileRows=16, **kwargs)
+    for visit, im in enumerate(stack):
+        assert comb.add(im, visit=visit)
+    return comb, comb.results()
+
+
+def test_meanAndVarianceMatchNumpy():
+    stack = makeStack()
+    comb, images = combine(stack)
+
+    pix = stack.astype('f8')
+    np.testing.assert_allclose(images['MEAN'], pix.mean(axis=0), rtol=1e-6)
+    np.testing.assert_allclose(images['VAR'], pix.var(axis=0, ddof=1), rtol=1e-4, atol=1e-3)
+
+
+def test_clippedMeanDropsOutliers():
+    stack = makeStack()
+    comb, images = combine(stack)
+
+    # Dropping each pixel's extremes if they are far from the mean of the
+    # others, with sigma the median noise of each band of rows.
+    pix = stack.astype('f8')
+    n = len(pix)
+    total, lo, hi = pix.sum(axis=0), pix.min(axis=0), pix.max(axis=0)
+    sigma = pix.std(axis=0, ddof=1)
+    limit = np.empty_like(sigma)
+    for r0 in range(0, len(sigma), comb.tileRows):
+        band = slice(r0, r0 + comb.tileRows)
+        limit[band] = comb.clipSigma * np.median(sigma[band])
+    dropHi = hi - (total - hi) / (n - 1) > limit
+    dropLo = (total - lo) / (n - 1) - lo > limit
+    expected = (total - np.where(dropHi, hi, 0) - np.where(dropLo, lo, 0)) / (n - dropHi - dropLo)
+
+    np.testing.assert_allclose(images['CLIPPED'], expected, rtol=1e-5)
+    assert dropHi[10, 10] and dropHi[20, 5] and dropLo[30, 30]
+    assert comb.nDropped.sum() == dropHi.sum() + dropLo.sum()
+
+    # A bright cosmic ray drags the mean of the others up, so the lowest value goes too.
+    assert dropLo[10, 10]
+    assert images['CLIPPED'][10, 10] == pytest.approx(np.sort(pix[:, 10, 10])[1:-1].mean(), rel=1e-6)
+
+
+def test_medianMatchesNumpy(tmp_path):
+    stack = makeStack(nFrames=6)
+    comb, images = combine(stack, nFrames=len(stack), doMedian=True, spoolDir=str(tmp_path))
+    try:
+        np.testing.assert_array_equal(images['MEDIAN'], np.median(stack, axis=0))
+    finally:
+        comb.close()
+
+
+def test_wrongShapeIsIgnored():
+    comb = combiner.FrameCombiner(shape=(4, 4))
+    assert not comb.add(np.zeros((4, 5), dtype='u2'))
+    assert comb.n == 0
@@ -0,0 +1,55 @@
+"""Check that reactor-side FEE status reads are answered from the cache during exposures. """
+
+import pytest
+
+pytest.importorskip('twisted')
+
+from ccdActor.utils import feeAsync
+from ccdActor.utils import feeCache
+from ccdActor.utils import feeScheduler
+
+
+class FakeFee(object):
+    """Just what AsyncFee needs. Any call which gets to the FEE is an error. """
+
+    def __init__(self):
+        self.statusCache = feeCache.StatusCache()
+        self.scheduler = feeScheduler.FeeScheduler(dropWhileBusy=True)
+        self.allCategories = ['voltage', 'temps']
+
+    def _noFee(self, *args, **kwargs):
+        raise AssertionError('the FEE should not have been asked')
+
+    getStatusSets = getAllStatus = getTemps = _noFee
+
+
+@pytest.fixture
+def fee():
+    fee = FakeFee()
+    fee.scheduler.start()
+    yield fee
+    fee.scheduler.stop()
+
+
+def results(d):
+    got = []
+    d.addBoth(got.append)
+    assert len(got) == 1, 'the Deferred should already have fired'
+    return got[0]
+
+
+def test_statusFromCacheWhileExposing(fee):
+    voltages = {'voltage.3V3': '3.31', 'voltage.5VP': '5.02'}
+    temps = {'temps.PA': '20.1', 'temps.ccd0': '-100.0'}
+    fee.statusCache.store('voltage', voltages)
+    fee.statusCache.store('temps', temps)
+    fee.statusCache.store('getTemps', dict(PA=20.1, ccd0=-100.0), category='temps')
+
+    asyncFee = feeAsync.AsyncFee(fee)
+    with fee.scheduler.exposing():
+        assert results(asyncFee.getStatusSets(['voltage', 'temps'])) == dict(**voltages, **temps)
+        assert results(asyncFee.getAllStatus()) == dict(**voltages, **temps)
+        assert results(asyncFee.getCommandStatus('voltage')) == voltages
+        assert results(asyncFee.getTemps()) == dict(PA=20.1, ccd0=-100.0)
+
+    assert fee.scheduler.nDropped == 0
@@ -0,0 +1,106 @@
+"""Check that batched FEE status reads return exactly what unbatched ones do.
+
+The hardware-free tests run feeBatch.pipelined with a toy exchange over
+the FEE emulator. The controller test needs xcu_fpga and a transcript
+recorded from a real FEE with "fee record" while running "fee status
+@fresh": point FEE_TRANSCRIPT at it, and optionally list the status sets
+to compare in FEE_TEST_SETS.
+"""
+
+import os
+
+import pytest
+
+serial = pytest.importorskip('serial')
+
+from ccdActor.utils import feeBatch
+from ccdActor.utils import feeSim
+
+
+def toyExchange(request, device):
+    """A feeControl-like exchange, which clears the input buffer first and checks the reply's echo. """
+
+    cmdStr, args, kwargs = request
+    device.reset_input_buffer()
+    device.write(f'~{cmdStr}\r'.encode('latin-1'))
+    reply = device.read_until(b'\n')
+    if not reply.endswith(b'\n'):
+        raise TimeoutError(f'no reply to {cmdStr}')
+    echo, value = reply.decode('latin-1').strip().split('=')
+    if echo != cmdStr:
+        raise ValueError(f'got the reply to {echo} for {cmdStr}')
+    return value
+
+
+@pytest.fixture
+def toySim():
+    exchanges = [dict(sent=f'~g{i}\r', reply=f'g{i}=value{i}\n', latency=0.002) for i in range(6)]
+    sim = feeSim.FeeSimulator(exchanges)
+    port = sim.start()
+    device = serial.Serial(port, timeout=1.0)
+    yield sim, device
+    device.close()
+    sim.stop()
+
+
+def test_pipelinedMatchesSequential(toySim):
+    sim, device = toySim
+    requests = [(f'g{i}', (), ()) for i in range(6)]
+
+    sequential = [toyExchange(r, device) for r in requests]
+    for depth in 1, 2, 4, 10:
+        assert feeBatch.pipelined(toyExchange, device, requests, depth=depth) == sequential
+    assert sim.nUnknown == 0
+
+
+def test_pipelinedStopsAtMissingReply(toySim):
+    sim, device = toySim
+    device.timeout = 0.2
+    requests = [('g0', (), ()), ('nope', (), ()), ('g2', (), ())]
+
+    replies = feeBatch.pipelined(toyExchange, device, requests, depth=4)
+    assert replies[0] == 'value0'
+    assert isinstance(replies[1], feeBatch.FeeReplyError)
+    assert replies[2] is None
+
+
+class FakeBcast(object):
+    def inform(self, *args, **kwargs):
+        pass
+
+    warn = inform
+
+
+class FakeActor(object):
+    def __init__(self, transcript, batchDepth):
+        self.bcast = FakeBcast()
+        self.controllers = dict()
+        self.actorConfig = dict(fee=dict(port=None,
+                                         simulator=dict(transcript=transcript, latency=0.0),
+                                         batchDepth=batchDepth,
+                                         scheduler=dict(enabled=False)))
+
+
+def test_batchedStatusMatchesUnbatched():
+    transcript = os.environ.get('FEE_TRANSCRIPT', None)
+    if transcript is None:
+        pytest.skip('needs FEE_TRANSCRIPT, recorded from a real FEE with "fee record"')
+    pytest.importorskip('twisted')
+    pytest.importorskip('xcu_fpga.fee.feeControl')
+    from ccdActor.Controllers import fee as feeController
+
+    csets = os.environ.get('FEE_TEST_SETS', 'voltage,bias,temps').split(',')
+
+    results = dict()
+    for batchDepth in 1, 4:
+        fee = feeController.fee(FakeActor(transcript, batchDepth), 'fee')
+        try:
+            # The first read of each set records its commands; the second is batched.
+            for cset in csets:
+                fee.getCommandStatus(cset, fresh=True)
+            results[batchDepth] = [fee.getCommandStatus(cset, fresh=True) for cset in csets]
+            assert fee.simulator.nUnknown == 0
+        finally:
+            fee.simulator.stop()
+
+    assert results[4] == results[1]
@@ -0,0 +1,55 @@
+from ccdActor.utils import feeCache
+
+
+def test_fetchAndTTL():
+    cache = feeCache.StatusCache(dict(voltage=100.0, temps=0.0))
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        return {'voltage.3V3': '3.3'}
+
+    assert cache.fetch('voltage', fetch) == ({'voltage.3V3': '3.3'}, 0.0)
+    value, age = cache.fetch('voltage', fetch)
+    assert value == {'voltage.3V3': '3.3'} and age > 0
+    cache.fetch('voltage', fetch, fresh=True)
+    assert len(calls) == 2
+
+    cache.store('temps', {'temps.PA': '20.0'})
+    assert cache.lookup('temps') is None
+
+
+def test_invalidateDropsEarlierFetches():
+    cache = feeCache.StatusCache()
+
+    # A fetch which read the FEE before a change must not be stored after it.
+    generation = cache.generation
+    cache.invalidate('voltage')
+    cache.store('voltage', {'voltage.3V3': 'old'}, generation=generation)
+    assert cache.lookup('voltage') is None
+    assert cache.nDropped == 1
+
+    # Other categories are not affected...
+    cache.store('temps', {'temps.PA': '20.0'}, generation=generation)
+    assert cache.lookup('temps') is not None
+
+    # ... unless everything was invalidated.
+    cache.invalidate()
+    cache.store('temps', {'temps.PA': 'old'}, generation=generation)
+    assert cache.lookup('temps') is None
+
+    # Fetches which started after the change are fine.
+    generation = cache.generation
+    cache.store('voltage', {'voltage.3V3': 'new'}, generation=generation)
+    assert cache.lookup('voltage')[0] == {'voltage.3V3': 'new'}
+
+
+def test_fetchAcrossInvalidation():
+    cache = feeCache.StatusCache()
+
+    def fetch():
+        cache.invalidate('bias')
+        return {'bias.3V3': 'stale'}
+
+    assert cache.fetch('bias', fetch)[0] == {'bias.3V3': 'stale'}
+    assert cache.lookup('bias') is None
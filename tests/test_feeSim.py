@@ -0,0 +1,91 @@
+"""Replay the FEE transcript kept with the package through the emulator's pty.
+
+The first test needs only pyserial. The second drives the fee controller,
+and so feeControl, against the emulator, and needs twisted and xcu_fpga.
+"""
+
+import pytest
+
+serial = pytest.importorskip('serial')
+
+from ccdActor.utils import feeSim
+
+
+def readReply(device):
+    return device.read_until(b'\n').decode('latin-1')
+
+
+def test_replaysTranscript():
+    info, exchanges = feeSim.loadTranscript(feeSim.defaultTranscript)
+    sim = feeSim.FeeSimulator(latency=0.0)
+    port = sim.start()
+    device = serial.Serial(port, timeout=1.0)
+    try:
+        for ex in exchanges:
+            device.write(ex['sent'].encode('latin-1'))
+            assert readReply(device) == ex['reply']
+        assert sim.nCommands == len(exchanges)
+        assert sim.nUnknown == 0
+    finally:
+        device.close()
+        sim.stop()
+
+
+def test_repeatedRequestsFollowRecordedOrder():
+    sim = feeSim.FeeSimulator(latency=0.0)
+    port = sim.start()
+    device = serial.Serial(port, timeout=1.0)
+    try:
+        def bias():
+            device.write(b'~gb,5VP\r')
+            return float(readReply(device))
+
+        idle = bias()
+        for mode in 'wipe', 'expose', 'read':
+            device.write(f'~sm,{mode}\r'.encode('latin-1'))
+            assert readReply(device).strip() == 'OK'
+            if mode == 'read':
+                assert bias() < idle
+        assert sim.nUnknown == 0
+    finally:
+        device.close()
+        sim.stop()
+
+
+class FakeBcast(object):
+    def inform(self, *args, **kwargs):
+        pass
+
+    warn = inform
+
+
+class FakeActor(object):
+    def __init__(self):
+        self.bcast = FakeBcast()
+        self.controllers = dict()
+        self.actorConfig = dict(fee=dict(port=None,
+                                         simulator=dict(latency=0.0),
+                                         batchDepth=4,
+                                         scheduler=dict(enabled=False)))
+
+
+def test_controllerAgainstEmulator():
+    pytest.importorskip('twisted')
+    pytest.importorskip('xcu_fpga.fee.feeControl')
+    from ccdActor.Controllers import fee as feeController
+
+    fee = feeController.fee(FakeActor(), 'fee')
+    try:
+        status = fee.getAllStatus(fresh=True)
+        assert status['revision.FEE'] == '1.2.3'
+
+        bias = dict()
+        for mode in 'wipe', 'expose', 'read', 'idle':
+            fee.setMode(mode)
+            values = fee.getStatusSets(['voltage', 'bias', 'temps'], fresh=True)
+            bias[mode] = float(values['bias.5VP'])
+        assert bias['read'] < bias['idle']
+        assert fee.simulator.nUnknown == 0
+    finally:
+        fee.stop()
+        fee.simulator.stop()
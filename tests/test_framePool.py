@@ -0,0 +1,48 @@
+import numpy as np
+
+from ccdActor.utils import framePool
+
+
+def test_refcounting():
+    pool = framePool.FramePool((4, 6), nFrames=2)
+    frame = pool.acquire()
+    pool.retain(frame[1:3])
+    assert len(pool.free) == 1
+
+    pool.release(frame)
+    assert len(pool.free) == 1
+    pool.release(frame[:, 2:])
+    assert len(pool.free) == 2
+
+    # Releasing once too often is harmless.
+    pool.release(frame)
+    assert len(pool.free) == 2
+
+
+def test_zeroingOnReuse():
+    pool = framePool.FramePool((4, 6), nFrames=1)
+    frame = pool.acquire()
+    frame[:] = 7
+    pool.release(frame)
+
+    stale = pool.acquire()
+    assert stale is frame and (stale == 7).all()
+    pool.release(stale)
+
+    zeroed = pool.acquire(zero=True)
+    assert zeroed is frame and (zeroed == 0).all()
+
+
+def test_missesAllocate():
+    pool = framePool.FramePool((4, 6), nFrames=1, dtype='i4')
+    pooled = pool.acquire()
+    extra = pool.acquire()
+    assert extra is not pooled and extra.dtype == np.int32 and (extra == 0).all()
+    assert pool.nMisses == 1
+
+    # Unpooled arrays are ignored.
+    pool.retain(extra)
+    pool.release(extra)
+    assert pool.free == []
+    pool.release(pooled)
+    assert pool.free == [pooled]
@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('fpga.geom')
+
+from ccdActor.utils import basicQA
+from ccdActor.utils import noiseQA
+
+NAMPS = 8
+AMPCOLS = 64
+OSCOL0 = 44                     # Each amp: 44 data columns, then 20 overscan columns.
+OSCOLS = 20
+
+
+@pytest.fixture
+def layout(monkeypatch):
+    """Replace fpga.geom's split with a synthetic layout, given the overscan column of each amp. """
+
+    def setLayout(osCol0s):
+        def splitOverscans(image):
+            return [image[:, c:c+OSCOLS] for c in osCol0s]
+
+        monkeypatch.setattr(basicQA, '_splitOverscans', splitOverscans)
+        monkeypatch.setattr(basicQA, '_overscanGeometries', dict())
+
+    return setLayout
+
+
+def makeImage(nrows=400, rms=2.0, sineAmp=None, sineRms=0.0, freq=9100.0, pixelTime=1e-5, seed=1):
+    rng = np.random.default_rng(seed)
+    image = 1000 + rng.normal(0, rms, (nrows, NAMPS * AMPCOLS))
+
+    # A sine in time, only in the overscan of one amp; the data columns get a big signal.
+    if sineAmp is not None:
+        t = np.arange(nrows * AMPCOLS).reshape(nrows, AMPCOLS) * pixelTime
+        sine = sineRms * np.sqrt(2) * np.sin(2 * np.pi * freq * t)
+        cols = slice(sineAmp * AMPCOLS + OSCOL0, (sineAmp + 1) * AMPCOLS)
+        image[:, cols] += sine[:, OSCOL0:]
+    for amp in range(NAMPS):
+        image[:, amp * AMPCOLS:amp * AMPCOLS + OSCOL0] += rng.uniform(0, 5000, (nrows, OSCOL0))
+
+    return image.astype('f4')
+
+
+def test_broadbandNoiseFindsOverscanPickup(layout):
+    layout([amp * AMPCOLS + OSCOL0 for amp in range(NAMPS)])
+
+    image = makeImage(sineAmp=3, sineRms=3.0)
+    rms = noiseQA.broadbandNoise(image, (0, image.shape[0]), 1e-5, colTrim=(0, 0),
+                                 nperseg=1024, minFreq=0.0)
+
+    quiet = np.delete(rms, 3)
+    assert np.allclose(quiet, 2.0, rtol=0.1)
+    assert rms[3] == pytest.approx(np.hypot(2.0, 3.0), rel=0.1)
+
+
+def test_broadbandNoiseRefusesMisplacedOverscans(layout):
+    # All the overscans together at the right, not one per amp.
+    layout([NAMPS * AMPCOLS - (NAMPS - amp) * OSCOLS for amp in range(NAMPS)])
+
+    image = makeImage()
+    with pytest.raises(RuntimeError):
+        noiseQA.broadbandNoise(image, (0, image.shape[0]), 1e-5)
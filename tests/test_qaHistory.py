@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+
+from ccdActor.utils import qaHistory
+
+
+def addVisits(history, visits):
+    for visit in visits:
+        history.add(visit, dict(level=np.full(history.namps, 1000.0 + visit),
+                                noise=np.full(history.namps, 3.0)), t=visit * 60.0)
+
+
+def test_ringWraps():
+    history = qaHistory.QaHistory(maxVisits=5, namps=2)
+    addVisits(history, range(3))
+    assert len(history) == 3
+    assert list(history.recent()[0]) == [0, 1, 2]
+
+    addVisits(history, range(3, 12))
+    assert len(history) == 5
+    visits, times, values = history.recent()
+    assert list(visits) == [7, 8, 9, 10, 11]
+    assert list(times) == [v * 60.0 for v in visits]
+    assert values.shape == (5, 2, 2)
+    np.testing.assert_array_equal(values[:, 0, 0], 1000.0 + visits)
+    assert list(history.recent(2)[0]) == [10, 11]
+
+
+def test_saveAndLoad(tmp_path):
+    path = str(tmp_path / 'qa' / 'history.npz')
+    history = qaHistory.QaHistory(maxVisits=4, namps=2, path=path)
+    addVisits(history, range(6))
+    history.save()
+
+    loaded = qaHistory.QaHistory(maxVisits=4, namps=2, path=path)
+    loaded.load()
+    for saved, restored in zip(history.recent(), loaded.recent()):
+        np.testing.assert_array_equal(saved, restored)
+
+    # Loading into a smaller ring keeps the newest visits.
+    small = qaHistory.QaHistory(maxVisits=3, namps=2, path=path)
+    small.load()
+    assert list(small.recent()[0]) == [3, 4, 5]
+
+    with pytest.raises(ValueError):
+        qaHistory.QaHistory(namps=8, path=path).load()
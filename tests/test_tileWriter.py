@@ -0,0 +1,69 @@
+"""Check that the tile writer's files read back exactly, with good checksums, in fitsio and astropy. """
+
+import warnings
+
+import numpy as np
+import pytest
+
+fitsio = pytest.importorskip('fitsio')
+pyfits = pytest.importorskip('astropy.io.fits')
+
+from ccdActor.utils import fitsChecksum
+from ccdActor.utils import fitsWriter
+from ccdActor.utils import tileWriter
+
+compressions = [dict(compress='RICE'),
+                dict(compress='GZIP_1'),
+                dict(compress='GZIP_2'),
+                dict(compress=None),
+                dict(compress='RICE', tile_dims=[7, 300]),
+                dict(compress='GZIP_2', tile_dims=[64, 300])]
+
+
+@pytest.fixture(scope='module')
+def writer():
+    tw = tileWriter.TileWriter(nThreads=2, bandRows=32)
+    yield tw
+    tw.stop()
+
+
+def makeImage(dtype):
+    rng = np.random.default_rng(17)
+    im = rng.normal(1000, 10, size=(251, 300))
+    im[10:20, 50:60] = 65000 if dtype == 'u2' else 32000
+    im[30, :] = 0 if dtype == 'u2' else -32000
+    return np.round(im).astype(dtype)
+
+
+@pytest.mark.parametrize('dtype', ['u2', 'i2'])
+@pytest.mark.parametrize('compression', compressions, ids=str)
+def test_roundTrip(writer, tmp_path, compression, dtype):
+    im = makeImage(dtype)
+    assert tileWriter.canWrite(im, compression)
+
+    path = tmp_path / 'PFSA00000112.fits'
+    cards = [dict(name='W_VISIT', value=1, comment='visit')]
+    imageCards = [dict(name='INHERIT', value=True, comment='')]
+    fitsWriter.writeFits(path, im, cards, imageCards, compression=compression, tileWriter=writer)
+
+    assert fitsChecksum.verifyFile(path) == []
+
+    with fitsio.FITS(str(path)) as ff:
+        data = ff[1].read()
+        assert ff[1].verify_checksum() is None
+        assert ff[0].read_header()['W_VISIT'] == 1
+    assert data.dtype == im.dtype
+    np.testing.assert_array_equal(data, im)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        with pyfits.open(path, checksum=True) as hdus:
+            data = hdus[1].data
+            assert hdus[1].name.upper() == 'IMAGE'
+            assert data.dtype.kind == im.dtype.kind
+            np.testing.assert_array_equal(data, im)
+
+    # 1 is astropy's "the checksum is good", for the HDUs as stored.
+    with pyfits.open(path, disable_image_compression=True) as hdus:
+        assert [hdu.verify_checksum() for hdu in hdus] == [1, 1]
+        assert [hdu.verify_datasum() for hdu in hdus] == [1, 1]